@@ -0,0 +1,42 @@
+"""Encode/decode cost and wire size of the request codecs.
+
+Run from the project root: ``python -m benchmarks.codec``
+"""
+import argparse
+import timeit
+
+from codec import CODECS
+from structs import RequestData
+
+
+SAMPLES = (
+    RequestData('Vupsen', message='Hi!'),
+    RequestData('Pupsen', target='one_to_one', receiver='Vupsen',
+                message='Private message ' * 8),
+    RequestData('Vupsen', target='status'),
+    RequestData('Пупсен', message='Сообщение в общий чат ' * 40),
+)
+
+
+def run(number: int) -> None:
+    print(f'{"codec":<8}{"bytes":>8}{"encode, us":>12}{"decode, us":>12}')
+    for name, codec in CODECS.items():
+        payloads = [codec.encode(request) for request in SAMPLES]
+        size = sum(map(len, payloads)) / len(payloads)
+        encode = timeit.timeit(
+            lambda: [codec.encode(request) for request in SAMPLES],
+            number=number
+        )
+        decode = timeit.timeit(
+            lambda: [codec.decode(payload) for payload in payloads],
+            number=number
+        )
+        per_call = 1e6 / (number * len(SAMPLES))
+        print(f'{name:<8}{size:>8.1f}'
+              f'{encode * per_call:>12.2f}{decode * per_call:>12.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    run(parser.parse_args().number)
@@ -0,0 +1,117 @@
+"""Bandwidth saved by stream compression and the CPU time it costs.
+
+Two workloads, each on fresh connections, as the server would write them:
+
+* ``replay`` - the history sent on HELLO, in pages of HISTORY_PAGE_SIZE
+  messages written at once;
+* ``burst`` - general chat messages written in drain cycles of a few
+  frames, the way a busy broadcast reaches a connection.
+
+For every compression level the wire bytes are compared with the plain
+frames, and the time to compress and decompress is given per KiB of
+plain frames. Nothing goes over the network.
+
+Run from the project root: ``python -m benchmarks.compression``
+"""
+import argparse
+import random
+import time
+
+from compression import StreamCompressor, StreamDecompressor
+from config import settings
+from protocol import COMPRESSED
+from structs import render_message
+
+
+WORDS = (
+    'hi hello ok thanks yes no maybe today tomorrow meeting lunch deploy '
+    'review build test merge release fixed broken server client chat please '
+    'see you soon great sounds good what when where why how'
+).split()
+
+
+def make_messages(count: int, users: int, seed: int) -> list[bytes]:
+    """Rendered chat messages, most of them to the general chat"""
+    rng = random.Random(seed)
+    usernames = [f'user_{i}' for i in range(users)]
+    # 2023-01-01 in microseconds since the epoch
+    send_date = 1672531200 * 1000000
+    frames = []
+    for message_id in range(1, count + 1):
+        send_date += int(rng.expovariate(0.2) * 1000000)
+        sender = rng.choice(usernames)
+        receiver = 'all' if rng.random() < 0.8 else rng.choice(usernames)
+        text = ' '.join(rng.choices(WORDS, k=rng.randint(2, 20)))
+        frames.append(
+            render_message(message_id, send_date, sender, receiver, text))
+    return frames
+
+
+def batches(frames: list[bytes], workload: str, rng: random.Random,
+            page_size: int) -> list[list[bytes]]:
+    if workload == 'replay':
+        return [frames[i:i + page_size]
+                for i in range(0, len(frames), page_size)]
+    result = []
+    start = 0
+    while start < len(frames):
+        size = rng.randint(1, 8)
+        result.append(frames[start:start + size])
+        start += size
+    return result
+
+
+def measure(connections: list[list[list[bytes]]], level: int,
+            threshold: int) -> tuple[int, int, float, float]:
+    plain = wire = 0
+    compress = decompress = 0.0
+    for connection in connections:
+        compressor = StreamCompressor(threshold, level)
+        decompressor = StreamDecompressor()
+        for batch in connection:
+            plain += sum(map(len, batch))
+            started = time.perf_counter()
+            written = compressor.compress(batch)
+            compress += time.perf_counter() - started
+            for frame in written:
+                wire += len(frame)
+                if frame[4:5] == COMPRESSED:
+                    started = time.perf_counter()
+                    decompressor.decompress(frame[4:])
+                    decompress += time.perf_counter() - started
+    return plain, wire, compress, decompress
+
+
+def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    history = make_messages(args.messages, args.users, args.seed)
+    print(f'{"workload":<9}{"level":>6}{"plain, KiB":>12}{"wire, KiB":>11}'
+          f'{"saved":>8}{"compress, us/KiB":>18}{"decompress, us/KiB":>20}')
+    for workload in ('replay', 'burst'):
+        connections = [
+            batches(history, workload, rng, args.page_size)
+            for _ in range(args.connections)
+        ]
+        for level in args.levels:
+            plain, wire, compress, decompress = measure(
+                connections, level, args.threshold)
+            kib = plain / 1024
+            print(f'{workload:<9}{level:>6}{kib:>12.0f}{wire / 1024:>11.0f}'
+                  f'{1 - wire / plain:>8.1%}'
+                  f'{compress * 1e6 / kib:>18.2f}'
+                  f'{decompress * 1e6 / kib:>20.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='messages sent to every connection')
+    parser.add_argument('--connections', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+    parser.add_argument('--threshold', type=int,
+                        default=settings.COMPRESSION_THRESHOLD)
+    parser.add_argument('--page-size', type=int,
+                        default=settings.HISTORY_PAGE_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    run(parser.parse_args())
@@ -0,0 +1,116 @@
+"""Throughput of file uploads and downloads, and the memory the server
+needs for them.
+
+One client uploads a file to the general chat, then every downloader
+fetches it at once. The server runs in its own process with its files
+in a temporary directory; its peak resident memory is read from /proc
+where there is one, and should not grow with the size of the file.
+
+Run from the project root: ``python -m benchmarks.files``
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.workers import HOST, wait_for_port
+from client import Client
+from log_storage import LogStorage
+
+
+def serve(port: int, directory: str) -> None:
+    os.chdir(directory)
+    from server import Server
+    Server(HOST, port, metrics_port=0,
+           storage=LogStorage(os.path.join(directory, 'log'))).listen()
+
+
+def peak_memory(pid: int) -> str:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return f'{int(line.split()[1]) / 1024:.1f} MiB'
+    except OSError:
+        pass
+    return 'unknown'
+
+
+async def wait_file_id(client: Client) -> str:
+    async for message in client.messages():
+        if message.file_id:
+            return message.file_id
+    raise ConnectionError('Connection lost before the file was announced')
+
+
+async def read(client: Client) -> None:
+    """The files come through ``messages``"""
+    async for _ in client.messages():
+        pass
+
+
+async def run(args: argparse.Namespace, port: int, directory: str,
+              pid: int) -> None:
+    path = os.path.join(directory, 'upload.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(args.size))
+    mib = args.size / 1024 / 1024
+
+    uploader = Client('uploader', HOST, port, acks=False)
+    await uploader.connect_to_server()
+    announced = asyncio.create_task(wait_file_id(uploader))
+    started = time.perf_counter()
+    await uploader.upload(path)
+    file_id = await announced
+    uploaded = time.perf_counter() - started
+    print(f'upload: {mib:.1f} MiB in {uploaded * 1000:.0f} ms, '
+          f'{mib / uploaded:.0f} MiB/s')
+
+    clients = [Client(f'user_{i}', HOST, port, acks=False)
+               for i in range(args.downloaders)]
+    for client in clients:
+        await client.connect_to_server()
+    readers = [asyncio.create_task(read(client))
+               for client in clients]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client.download(file_id, os.path.join(directory, f'{i}.bin'))
+        for i, client in enumerate(clients)))
+    downloaded = time.perf_counter() - started
+    total = mib * len(clients)
+    print(f'download: {len(clients)} x {mib:.1f} MiB in '
+          f'{downloaded * 1000:.0f} ms, {total / downloaded:.0f} MiB/s')
+    print(f'server peak memory: {peak_memory(pid)}')
+
+    for task in (announced, *readers):
+        task.cancel()
+    for client in (uploader, *clients):
+        await client.close()
+
+
+def main(args: argparse.Namespace) -> None:
+    directory = tempfile.mkdtemp()
+    # read by the settings of the server process
+    os.environ['MAX_FILE_SIZE'] = str(args.size)
+    process = multiprocessing.get_context('spawn').Process(
+        target=serve, args=(args.port, directory))
+    process.start()
+    try:
+        wait_for_port(args.port)
+        asyncio.run(run(args, args.port, directory, process.pid))
+    finally:
+        process.kill()
+        process.join()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=5 * 1024 * 1024,
+                        help='bytes in the file')
+    parser.add_argument('--downloaders', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8100)
+    main(parser.parse_args())
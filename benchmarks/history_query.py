@@ -0,0 +1,147 @@
+"""Query plans and timings of the history, user and expiry queries
+before the index migration and with the current schema, where the times
+are integer microseconds.
+
+Run from the project root: ``python -m benchmarks.history_query``
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+
+from config import settings
+from migration import migrate
+from sql_queries import (
+    get_message_query, get_user_query, delete_expired_messages_query
+)
+from structs import to_timestamp
+
+
+# get_message_query as it was before the indexes were introduced
+LEGACY_MESSAGE_QUERY = f'''
+    SELECT *
+    FROM (
+        SELECT send_date, sender, receiver, message
+        FROM main.messages
+        WHERE receiver in ('all', :user)
+            AND send_date >= :reg_date
+            OR sender = :user
+        ORDER BY send_date
+    )
+    UNION
+    SELECT *
+    FROM (
+        SELECT send_date, sender, receiver, message
+        FROM main.messages
+        WHERE receiver in ('all', :user)
+            AND send_date <= :reg_date
+        ORDER BY send_date
+        LIMIT {settings.LIMIT_SHOW_MESSAGES}
+    )
+    ORDER BY send_date;
+'''
+
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+# the schema version before the indexes
+LEGACY_VERSION = 2
+
+
+def as_datetime(seconds: int) -> datetime:
+    return START + timedelta(seconds=seconds)
+
+
+def as_timestamp(seconds: int) -> int:
+    return to_timestamp(START) + seconds * 1000000
+
+
+def seed(connection: sqlite3.Connection, rows: int, users: int) -> None:
+    """Fill the tables with ``rows`` messages between ``users`` users"""
+    names = [f'user_{i}' for i in range(users)]
+
+    def messages():
+        for i in range(rows):
+            receiver = 'all' if random.random() < 0.8 else random.choice(names)
+            yield (random.choice(names), receiver, f'message {i}',
+                   as_datetime(i))
+
+    with connection:
+        connection.executemany(
+            'INSERT INTO messages (sender, receiver, message, send_date) '
+            'VALUES (?, ?, ?, ?)', messages())
+        connection.executemany(
+            'INSERT INTO registrations (username, reg_date) VALUES (?, ?)',
+            ((name, START) for name in names))
+
+
+def plan(connection: sqlite3.Connection, query: str, params) -> list[str]:
+    return [row[-1] for row in
+            connection.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+
+
+def timed(connection: sqlite3.Connection, query: str, params_list,
+          rollback: bool = False) -> float:
+    """Average time of the query in milliseconds"""
+    started = time.perf_counter()
+    for params in params_list:
+        connection.execute(query, params).fetchall()
+        if rollback:
+            connection.rollback()
+    return (time.perf_counter() - started) * 1000 / len(params_list)
+
+
+def report(connection: sqlite3.Connection, title: str, message_query: str,
+           as_time: Callable[[int], Any], rows: int, samples: int,
+           users: int) -> None:
+    # the same users before and after, registered during the last 1%
+    # of the history like returning users
+    rng = random.Random(samples)
+    names = rng.sample([f'user_{i}' for i in range(users)], samples)
+    reg_dates = [as_time(rows - rng.randrange(rows // 100)) for _ in names]
+    history_params = [{'user': name, 'reg_date': reg_date}
+                      for name, reg_date in zip(names, reg_dates)]
+    user_params = [(name,) for name in names]
+    expiry_params = [(as_time(rows // 100), settings.EXPIRY_CHUNK_SIZE)]
+
+    print(f'\n== {title}')
+    for name, query, params_list, rollback in (
+            ('history', message_query, history_params, False),
+            ('get user', get_user_query, user_params, False),
+            ('expiry chunk', delete_expired_messages_query, expiry_params,
+             True),
+    ):
+        elapsed = timed(connection, query, params_list, rollback)
+        print(f'{name}: {elapsed:.2f} ms')
+        for line in plan(connection, query, params_list[0]):
+            print(f'    {line}')
+
+
+def run(rows: int, users: int, samples: int, db_name: str) -> None:
+    connection = sqlite3.connect(db_name)
+    migrate(connection, target=LEGACY_VERSION)
+    started = time.perf_counter()
+    seed(connection, rows, users)
+    print(f'Seeded {rows} messages in {time.perf_counter() - started:.1f} s')
+    report(connection, 'before', LEGACY_MESSAGE_QUERY, as_datetime, rows,
+           samples, users)
+    started = time.perf_counter()
+    migrate(connection)
+    print(f'Migrated in {time.perf_counter() - started:.1f} s')
+    report(connection, 'after', get_message_query, as_timestamp, rows,
+           samples, users)
+    connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        run(args.rows, args.users, args.samples,
+            os.path.join(directory, 'bench.db'))
@@ -0,0 +1,122 @@
+"""Requests per second of the HTTP front end with many concurrent
+keep-alive connections.
+
+Every connection sends ``--requests`` requests: a private message
+through ``POST /requests`` or a ``GET /messages`` poll that does not
+wait. Connections are measured three ways: one request at a time on a
+kept-alive connection, ``--depth`` requests pipelined in one write, and
+a new connection for every request for comparison.
+
+Run from the project root: ``python -m benchmarks.http_server``
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.workers import HOST, wait_for_port
+from log_storage import LogStorage
+
+
+def serve(port: int, http_port: int, directory: str) -> None:
+    os.chdir(directory)
+    from server import Server
+    Server(HOST, port, metrics_port=0, http_port=http_port,
+           storage=LogStorage(os.path.join(directory, 'log'))).listen()
+
+
+def make_request(kind: str, user: int) -> bytes:
+    if kind == 'poll':
+        return (f'GET /messages?username=user_{user}&after=0 HTTP/1.1\r\n'
+                f'Host: {HOST}\r\n\r\n').encode()
+    body = json.dumps({'username': f'user_{user}', 'target': 'one_to_one',
+                       'receiver': f'user_{user + 1}',
+                       'message': 'bench'}).encode()
+    return (f'POST /requests HTTP/1.1\r\nHost: {HOST}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n').encode() + body
+
+
+async def read_response(reader: asyncio.StreamReader) -> None:
+    head = await reader.readuntil(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.1 200'):
+        raise ConnectionError(head.split(b'\r\n', 1)[0].decode())
+    length = head.lower().split(b'content-length: ', 1)[1].split(b'\r\n')[0]
+    await reader.readexactly(int(length))
+
+
+async def keep_alive(port: int, request: bytes, count: int,
+                     depth: int) -> None:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    for start in range(0, count, depth):
+        batch = min(depth, count - start)
+        writer.write(request * batch)
+        for _ in range(batch):
+            await read_response(reader)
+    writer.close()
+
+
+async def new_connections(port: int, request: bytes, count: int) -> None:
+    close = request.replace(b'\r\n\r\n', b'\r\nConnection: close\r\n\r\n', 1)
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection(HOST, port)
+        writer.write(close)
+        await read_response(reader)
+        writer.close()
+
+
+async def measure(args: argparse.Namespace, mode: str) -> float:
+    """Requests per second of all the connections together"""
+    requests = [make_request(args.kind, i) for i in range(args.connections)]
+    started = time.perf_counter()
+    if mode == 'connection per request':
+        await asyncio.gather(*(
+            new_connections(args.http_port, request, args.requests)
+            for request in requests))
+    else:
+        depth = args.depth if mode == 'pipelined' else 1
+        await asyncio.gather(*(
+            keep_alive(args.http_port, request, args.requests, depth)
+            for request in requests))
+    elapsed = time.perf_counter() - started
+    return args.connections * args.requests / elapsed
+
+
+async def run(args: argparse.Namespace) -> None:
+    print(f'{args.connections} connections, {args.requests} '
+          f'"{args.kind}" requests each')
+    print(f'{"mode":<24}{"requests/s":>12}')
+    for mode in ('keep-alive', 'pipelined', 'connection per request'):
+        print(f'{mode:<24}{await measure(args, mode):>12.0f}')
+
+
+def main(args: argparse.Namespace) -> None:
+    directory = tempfile.mkdtemp()
+    process = multiprocessing.get_context('spawn').Process(
+        target=serve, args=(args.port, args.http_port, directory))
+    process.start()
+    try:
+        wait_for_port(args.http_port)
+        asyncio.run(run(args))
+    finally:
+        process.kill()
+        process.join()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests of every connection')
+    parser.add_argument('--kind', choices=('message', 'poll'),
+                        default='message')
+    parser.add_argument('--depth', type=int, default=16,
+                        help='requests pipelined in one write')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--http-port', type=int, default=8102)
+    main(parser.parse_args())
@@ -0,0 +1,231 @@
+"""Load test of a local server with thousands of simulated users.
+
+The users are ``client.Client`` instances sharing one event loop. Requests
+arrive at a fixed total rate, independently of how fast the server
+answers, and each picks a random user and an action: a message to the
+general chat, a private message, a STATUS request or a reconnect of the
+user's device. Chat messages carry the moment they were sent, so every
+delivery yields an end-to-end latency. Messages replayed to a device
+after a reconnect are counted separately and do not affect the latency.
+
+The server runs in its own process, its memory is read from ``/proc``.
+The load generator shares the machine with the server, so on a few cores
+it competes with it for the CPU.
+
+Run from the project root: ``python -m benchmarks.load --json run.json``
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+from benchmarks.workers import HOST, wait_for_port
+from client import Client
+from migration import create_db
+from protocol import iter_frames
+from server import Server
+
+
+MARKER = 'load'
+ACTIONS = {
+    'broadcast': 0.05,
+    'private': 0.8,
+    'status': 0.1,
+    'reconnect': 0.05,
+}
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.sent = dict.fromkeys(ACTIONS, 0)
+        self.latencies: list[float] = []
+        self.replayed = 0
+        self.statuses = 0
+        self.errors = 0
+
+
+class SimulatedUser:
+    """A client that records the latency of every chat message it gets"""
+
+    def __init__(self, username: str, port: int, stats: Stats) -> None:
+        self.client = Client(username, HOST, port, device='load', acks=False)
+        self.stats = stats
+        self.connected_at = 0.0
+        self.reader: asyncio.Task | None = None
+
+    async def connect(self) -> None:
+        await self.client.connect_to_server()
+        self.connected_at = time.perf_counter()
+        self.reader = asyncio.create_task(self.read())
+
+    async def reconnect(self) -> None:
+        self.reader.cancel()
+        self.client.writer.close()
+        await self.connect()
+
+    def close(self) -> None:
+        self.reader.cancel()
+        self.client.writer.close()
+
+    async def read(self) -> None:
+        marker = f': {MARKER} '.encode()
+        async for frame in iter_frames(self.client.reader):
+            received = time.perf_counter()
+            if marker in frame:
+                sent = float(frame.rsplit(b' ', 1)[1])
+                if sent < self.connected_at:
+                    self.stats.replayed += 1
+                else:
+                    self.stats.latencies.append(received - sent)
+            elif frame.startswith(b'Your username'):
+                self.stats.statuses += 1
+
+
+async def act(user: SimulatedUser, action: str, receiver: str,
+              stats: Stats) -> None:
+    message = f'{MARKER} {time.perf_counter()}'
+    try:
+        match action:
+            case 'broadcast':
+                await user.client.send_all(message)
+            case 'private':
+                await user.client.send_to(receiver, message)
+            case 'status':
+                await user.client.get_status()
+            case 'reconnect':
+                await user.reconnect()
+    except ConnectionError:
+        stats.errors += 1
+        return
+    stats.sent[action] += 1
+
+
+async def load(port: int, users: int, rate: float, duration: float,
+               drain: float, seed: int) -> tuple[Stats, float]:
+    rng = random.Random(seed)
+    stats = Stats()
+    simulated = [SimulatedUser(f'user_{i}', port, stats)
+                 for i in range(users)]
+    connecting = asyncio.Semaphore(100)
+
+    async def connect(user: SimulatedUser) -> None:
+        async with connecting:
+            await user.connect()
+
+    await asyncio.gather(*(connect(user) for user in simulated))
+    # the welcome notices of everybody joining are not part of the run
+    await asyncio.sleep(drain)
+    stats.latencies.clear()
+
+    actions, weights = zip(*ACTIONS.items())
+    started = time.perf_counter()
+    requests = int(rate * duration)
+    for number in range(requests):
+        delay = started + number / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sender, receiver = rng.sample(simulated, 2)
+        action = rng.choices(actions, weights)[0]
+        asyncio.create_task(
+            act(sender, action, receiver.client.username, stats))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(drain)
+    for user in simulated:
+        user.close()
+    return stats, elapsed
+
+
+def serve(port: int, db_name: str) -> None:
+    Server(HOST, port, db_name).listen()
+
+
+def memory(pid: int) -> dict[str, int | None]:
+    """Current and peak resident memory of the process in KiB"""
+    fields = {'VmRSS': None, 'VmHWM': None}
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                name, _, value = line.partition(':')
+                if name in fields:
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return {'rss_kb': fields['VmRSS'], 'peak_rss_kb': fields['VmHWM']}
+
+
+def percentiles(latencies: list[float]) -> dict[str, float | None]:
+    if len(latencies) < 2:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    cuts = statistics.quantiles(latencies, n=100)
+    return {f'p{p}_ms': round(cuts[p - 1] * 1000, 3) for p in (50, 95, 99)}
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> dict:
+    # the rate limit of the general chat is not what is measured here
+    os.environ['LIMIT_MESSAGES'] = str(10 ** 9)
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        db_name = os.path.join(directory, 'load.db')
+        create_db(db_name)
+        server = context.Process(target=serve, args=(args.port, db_name))
+        server.start()
+        try:
+            wait_for_port(args.port)
+            stats, elapsed = asyncio.run(load(
+                args.port, args.users, args.rate, args.duration, args.drain,
+                args.seed))
+            server_memory = memory(server.pid)
+        finally:
+            server.terminate()
+            server.join()
+
+    requests = sum(stats.sent.values())
+    return {
+        'commit': commit(),
+        'users': args.users,
+        'rate': args.rate,
+        'duration_s': round(elapsed, 3),
+        'requests': stats.sent,
+        'requests_per_s': round(requests / elapsed, 1),
+        'deliveries': len(stats.latencies),
+        'deliveries_per_s': round(len(stats.latencies) / elapsed, 1),
+        'replayed': stats.replayed,
+        'statuses': stats.statuses,
+        'errors': stats.errors,
+        'latency': percentiles(stats.latencies),
+        'server': server_memory,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='requests per second from all the users')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=2,
+                        help='seconds to wait for the last deliveries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8101)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(result, output, indent=2)
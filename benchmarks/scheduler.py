@@ -0,0 +1,99 @@
+"""Cost of holding, cancelling and sending a large number of scheduled
+messages.
+
+Messages from many users are scheduled over ``--spread`` seconds and a
+share of them is cancelled. Then a simulated clock moves tick by tick,
+and every tick sends all the messages due in it as one batch. The write
+queue drops the writes, so only the scheduler itself is measured.
+
+Run from the project root: ``python -m benchmarks.scheduler``
+"""
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+
+from typing import Any
+
+from scheduler import Scheduler
+from structs import ScheduledMessage
+
+
+class Discard:
+    """Write queue that keeps nothing"""
+
+    @staticmethod
+    def put(kind: str, params: tuple[Any, ...]) -> None:
+        pass
+
+
+def measure_memory(requests: list[tuple[str, int]]) -> float:
+    """Bytes a pending message takes"""
+    scheduler = Scheduler(Discard(), lambda batch: None, lambda: 0,
+                          user_limit=len(requests))
+    tracemalloc.start()
+    for sender, send_at in requests:
+        scheduler.schedule(sender, 'all', 'scheduled message', send_at)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    scheduler.stop()
+    return memory / len(requests)
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    clock = [0]
+    delivered = []
+
+    def deliver(batch: list[ScheduledMessage]) -> None:
+        delivered.append(len(batch))
+
+    scheduler = Scheduler(Discard(), deliver, lambda: clock[0],
+                          tick=args.tick, user_limit=args.messages)
+    spread = round(args.spread * 1000000)
+    senders = [f'user_{i}' for i in range(args.users)]
+    requests = [(rng.choice(senders), rng.randrange(1, spread))
+                for _ in range(args.messages)]
+
+    started = time.perf_counter()
+    for sender, send_at in requests:
+        scheduler.schedule(sender, 'all', 'scheduled message', send_at)
+    scheduled = time.perf_counter() - started
+    memory = measure_memory(requests[:100000])
+
+    cancelled = rng.sample(range(1, args.messages + 1),
+                           int(args.messages * args.cancel))
+    started = time.perf_counter()
+    for scheduled_id in cancelled:
+        scheduler.cancel(scheduler.pending[scheduled_id].sender, scheduled_id)
+    cancelling = time.perf_counter() - started
+
+    tick = round(args.tick * 1000000)
+    started = time.perf_counter()
+    for clock[0] in range(tick, spread + tick, tick):
+        scheduler.fire()
+    firing = time.perf_counter() - started
+    scheduler.stop()
+
+    count = args.messages
+    print(f'schedule: {scheduled * 1e6 / count:.2f} us per message, '
+          f'{memory:.0f} bytes per pending message')
+    print(f'cancel: {cancelling * 1e6 / max(1, len(cancelled)):.2f} us '
+          f'per message')
+    print(f'send: {len(delivered)} batches of {max(delivered)} messages '
+          f'at most, {firing * 1e6 / max(1, sum(delivered)):.2f} us per '
+          f'message')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--spread', type=float, default=600.0,
+                        help='seconds the send times are spread over')
+    parser.add_argument('--cancel', type=float, default=0.3,
+                        help='share of the messages cancelled')
+    parser.add_argument('--tick', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
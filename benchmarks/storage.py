@@ -0,0 +1,123 @@
+"""Write throughput and recovery time of the storage backends.
+
+Chat messages are put the way the server puts them, in bursts of a few
+between event loop turns, and the clock stops once everything is
+durable: committed by SQLite or fsynced to the log. Recovery is what a
+restarting server does before it accepts clients: open the storage,
+read the last message id, the saved rate limits and the recent history.
+The log backend recovers twice: from the log alone, as after a crash,
+and from the snapshot written on a clean shutdown. The snapshot pause
+is the time the event loop spends copying the state for the snapshot.
+
+Run from the project root: ``python -m benchmarks.storage``
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from database import SqliteStorage
+from history import HistoryBuffer
+from log_storage import LogStorage
+from migration import create_db
+from rate_limiter import RateLimiter
+from storage import Storage
+from structs import Write, now_timestamp
+
+
+def make_writes(count: int, users: int, seed: int
+                ) -> list[tuple[str, tuple]]:
+    """Chat messages with a registration for every new sender"""
+    rng = random.Random(seed)
+    usernames = [f'user_{i}' for i in range(users)]
+    send_date = now_timestamp() - 30 * 60 * 1000000
+    registered = set()
+    writes = []
+    for message_id in range(1, count + 1):
+        send_date += rng.randint(1000, 20000)
+        sender = rng.choice(usernames)
+        if sender not in registered:
+            registered.add(sender)
+            writes.append((Write.USER, (sender, send_date)))
+        receiver = 'all' if rng.random() < 0.8 else rng.choice(usernames)
+        writes.append((Write.MESSAGE, (
+            message_id, f'message {message_id} ' * rng.randint(1, 8),
+            sender, receiver, send_date)))
+    return writes
+
+
+async def write(storage: Storage, writes: list[tuple[str, tuple]],
+                burst: int) -> float:
+    """Seconds to put and persist all the writes"""
+    started = time.perf_counter()
+    for start in range(0, len(writes), burst):
+        for kind, params in writes[start:start + burst]:
+            storage.put(kind, params)
+        await asyncio.sleep(0)
+    await storage.flush()
+    return time.perf_counter() - started
+
+
+async def recover(storage: Storage) -> float:
+    """Seconds to get the storage ready for serving"""
+    started = time.perf_counter()
+    await storage.open()
+    await storage.get_last_message_id()
+    await RateLimiter().load(storage)
+    await HistoryBuffer().prime(storage)
+    elapsed = time.perf_counter() - started
+    await storage.close()
+    return elapsed
+
+
+def report(name: str, count: int, written: float | None,
+           recovered: float) -> None:
+    rate = f'{count / written:>12.0f}' if written else f'{"-":>12}'
+    print(f'{name:<16}{rate}{recovered:>14.3f}')
+
+
+async def run(args: argparse.Namespace) -> None:
+    writes = make_writes(args.messages, args.users, args.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        print(f'{"backend":<16}{"writes/s":>12}{"recovery, s":>14}')
+
+        db_name = os.path.join(directory, 'chat.db')
+        create_db(db_name)
+        storage = SqliteStorage(db_name)
+        await storage.open()
+        written = await write(storage, writes, args.burst)
+        await storage.close()
+        report('sqlite', len(writes), written,
+               await recover(SqliteStorage(db_name)))
+
+        path = os.path.join(directory, 'log')
+        storage = LogStorage(path)
+        await storage.open()
+        written = await write(storage, writes, args.burst)
+        # what a crash would leave: the log and no snapshot
+        shutil.copytree(path, f'{path}-crash')
+        started = time.perf_counter()
+        storage.state.copy()
+        pause = time.perf_counter() - started
+        await storage.close()
+        report('log, log only', len(writes), written,
+               await recover(LogStorage(f'{path}-crash')))
+        report('log, snapshot', len(writes), None,
+               await recover(LogStorage(path)))
+        print(f'snapshot pause: {pause * 1000:.1f} ms')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--burst', type=int, default=8,
+                        help='writes put between event loop turns')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,135 @@
+"""Private messages per second delivered by the server with different
+numbers of worker processes.
+
+Every load process connects its share of the users; each user sends
+private messages to a user of the next load process, so every message
+crosses the bus unless both users landed on the same worker.
+
+Run from the project root: ``python -m benchmarks.workers``
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from client import Client
+from migration import create_db
+from protocol import iter_frames
+from workers import run_workers
+
+
+HOST = '127.0.0.1'
+MESSAGE = 'bench'
+
+
+async def count_messages(client: Client, expected: int,
+                         received: list[float]) -> None:
+    suffix = f': {MESSAGE}'.encode()
+    async for frame in iter_frames(client.reader):
+        if frame.endswith(suffix):
+            received.append(time.perf_counter())
+            if len(received) == expected:
+                return
+
+
+async def load(port: int, process: int, processes: int, users: int,
+               messages: int, barrier, results) -> None:
+    clients = [Client(f'user_{process}_{i}', HOST, port, acks=False)
+               for i in range(users)]
+    for client in clients:
+        await client.connect_to_server()
+    receiver = (process + 1) % processes
+    received: list[float] = []
+    readers = [
+        asyncio.create_task(
+            count_messages(client, users * messages, received))
+        for client in clients
+    ]
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    started = time.time()
+    offset = time.perf_counter()
+    for _ in range(messages):
+        for i, client in enumerate(clients):
+            await client.send_to(f'user_{receiver}_{i}', MESSAGE)
+    try:
+        await asyncio.wait_for(asyncio.wait(readers), 30)
+    except asyncio.TimeoutError:
+        pass
+    finished = started + (received[-1] - offset) if received else started
+    results.put((started, finished, len(received)))
+    for client in clients:
+        client.writer.close()
+
+
+def run_load(*args) -> None:
+    asyncio.run(load(*args))
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run(workers: int, processes: int, users: int, messages: int,
+        port: int) -> float:
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        db_name = os.path.join(directory, 'bench.db')
+        create_db(db_name)
+        server = context.Process(
+            target=run_workers, args=(workers, HOST, port, db_name))
+        server.start()
+        try:
+            wait_for_port(port)
+            # give every worker the time to bind the port
+            time.sleep(1)
+            barrier = context.Barrier(processes)
+            results = context.Queue()
+            loaders = [
+                context.Process(target=run_load, args=(
+                    port, process, processes, users // processes, messages,
+                    barrier, results))
+                for process in range(processes)
+            ]
+            for loader in loaders:
+                loader.start()
+            stats = [results.get() for _ in loaders]
+            for loader in loaders:
+                loader.join()
+        finally:
+            server.terminate()
+            server.join()
+    started = min(s[0] for s in stats)
+    finished = max(s[1] for s in stats)
+    delivered = sum(s[2] for s in stats)
+    expected = users // processes * processes * messages
+    if delivered < expected:
+        print(f'lost {expected - delivered} of {expected} messages')
+    return delivered / (finished - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--port', type=int, default=8100)
+    args = parser.parse_args()
+    print(f'{os.cpu_count()} CPUs, {args.users} users, '
+          f'{args.messages} messages each')
+    print(f'{"workers":<8}{"messages/s":>12}')
+    for number in args.workers:
+        rate = run(number, args.processes, args.users, args.messages,
+                   args.port)
+        print(f'{number:<8}{rate:>12.0f}')
@@ -0,0 +1,402 @@
+import asyncio
+import itertools
+import pickle
+
+from asyncio.streams import StreamReader, StreamWriter
+from typing import Any, Callable, Iterable
+
+from config import settings
+from connection import Connection
+from database import SqliteStorage, StorageError
+from files import FileStore
+from protocol import FrameError, encode_frame, encode_text, iter_frames
+from rate_limiter import LIMIT_WARNING, RateLimiter
+from request_log import RequestLog
+from retention import RetentionEngine
+from scheduler import Scheduler
+from structs import Message, RequestData, ScheduledMessage, Target, Write
+from utils import server_logger
+
+
+# an event carries a client request together with its rendering
+MAX_EVENT_SIZE = 4 * settings.MAX_FRAME_SIZE
+
+
+def encode_event(*event: Any) -> bytes:
+    return encode_frame(pickle.dumps(event, pickle.HIGHEST_PROTOCOL))
+
+
+class OnlineUsers:
+    """Ordered set of the usernames online with the rendered list cached"""
+
+    def __init__(self, usernames: Iterable[str] = ()) -> None:
+        self._users: dict[str, None] = dict.fromkeys(usernames)
+        self._online_text: str | None = None
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._users
+
+    @property
+    def online_count(self) -> int:
+        return len(self._users)
+
+    @property
+    def online_text(self) -> str:
+        """Comma separated usernames online"""
+        if self._online_text is None:
+            self._online_text = ', '.join(self._users)
+        return self._online_text
+
+    def add(self, username: str) -> None:
+        self._users[username] = None
+        self._online_text = None
+
+    def discard(self, username: str) -> None:
+        if username in self._users:
+            del self._users[username]
+            self._online_text = None
+
+
+class Hub:
+    """Centre of a multi-worker server, runs in the supervisor process.
+
+    Workers connect over a Unix socket and exchange pickled events. The hub
+    assigns message ids, so they keep growing across the workers, is the
+    only writer to the database and tracks which users are online on any
+    worker. Every chat message goes through it and is published to all the
+    workers, which deliver it to their own connections. It also keeps the
+    scheduled messages and the rate limiter and answers the workers'
+    requests about them. A worker that does not read its events for
+    ``WRITE_TIMEOUT`` seconds is dropped from the bus.
+    """
+
+    def __init__(self, path: str, db_name: str,
+                 now: Callable[[], int]) -> None:
+        self.path = path
+        self.now = now
+        # the workers read the same database
+        self.storage = SqliteStorage(db_name)
+        # the hub stands in for the workers' history buffers
+        self.retention = RetentionEngine(
+            self.storage, self, now, files=FileStore())
+        self.scheduler = Scheduler(
+            self.storage, self.deliver_scheduled, now)
+        self.last_message_id = 0
+        # a client may send a message again to another worker
+        self.request_log = RequestLog()
+        # a user's messages may come through any worker
+        self.rate_limiter = RateLimiter()
+        self.workers: dict[int, StreamWriter] = dict()
+        # the workers with events waiting in the socket buffer
+        self._draining: set[int] = set()
+        # worker indexes by username of the users online
+        self.online: dict[str, set[int]] = dict()
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self) -> None:
+        """Open the database and start accepting workers"""
+        await self.storage.open()
+        self.last_message_id = await self.storage.get_last_message_id()
+        await self.scheduler.load(self.storage)
+        await self.rate_limiter.load(self.storage)
+        self._server = await asyncio.start_unix_server(
+            self.worker_connected, self.path)
+
+    async def serve(self) -> None:
+        """Run until cancelled, then flush the pending writes"""
+        try:
+            async with self._server:
+                await asyncio.gather(
+                    self._server.serve_forever(), self.retention.run(),
+                    self.snapshot_rate_limits())
+        finally:
+            self.scheduler.stop()
+            self.rate_limiter.snapshot(self.storage)
+            # let the worker handlers end before the loop cancels them
+            for writer in self.workers.values():
+                writer.close()
+            await self.storage.close()
+
+    async def worker_connected(
+            self, reader: StreamReader, writer: StreamWriter) -> None:
+        worker = None
+        try:
+            async for frame in iter_frames(reader, MAX_EVENT_SIZE):
+                event, *args = pickle.loads(frame)
+                match event:
+                    case 'hello':
+                        (worker,) = args
+                        self.workers[worker] = writer
+                        self.send(worker, 'online', list(self.online))
+                    case 'message':
+                        self.post_message(worker, *args)
+                    case 'schedule':
+                        token, request = args
+                        self.send(worker, 'reply', token,
+                                  self.schedule(request))
+                    case 'allow':
+                        token, username = args
+                        self.send(worker, 'allowed', token,
+                                  self.rate_limiter.allow(username))
+                    case 'write':
+                        self.storage.put(*args)
+                    case 'flush':
+                        try:
+                            await self.storage.flush()
+                            error = ''
+                        except StorageError as er:
+                            error = str(er)
+                        self.send(worker, 'flushed', *args, error)
+                    case 'join':
+                        self.join(worker, *args)
+                    case 'leave':
+                        self.leave(worker, *args)
+        except (FrameError, ConnectionError) as er:
+            server_logger.error('Bus error from worker %s: %s', worker, er)
+
+        server_logger.warning('Worker %s left the bus', worker)
+        self.workers.pop(worker, None)
+        for username in [u for u, w in self.online.items() if worker in w]:
+            self.leave(worker, username)
+        writer.close()
+
+    def publish(self, *event: Any) -> None:
+        """Send the event to every worker"""
+        frame = encode_event(*event)
+        for worker in list(self.workers):
+            self.write(worker, frame)
+
+    def send(self, worker: int, *event: Any) -> None:
+        """Send the event to one worker"""
+        self.write(worker, encode_event(*event))
+
+    def write(self, worker: int, frame: bytes) -> None:
+        """Write a frame to the worker and wait in the background for the
+        socket buffer to drain if the worker is behind"""
+        writer = self.workers.get(worker)
+        if writer is None:
+            return
+        writer.write(frame)
+        if worker not in self._draining \
+                and writer.transport.get_write_buffer_size():
+            self._draining.add(worker)
+            asyncio.get_running_loop().create_task(
+                self.drain(worker, writer))
+
+    async def drain(self, worker: int, writer: StreamWriter) -> None:
+        """Drop the worker from the bus if it does not read its events in
+        time"""
+        try:
+            await asyncio.wait_for(writer.drain(), settings.WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            server_logger.error(
+                'Worker %s stopped reading the bus, dropping it', worker)
+            writer.close()
+        except ConnectionError:
+            pass
+        finally:
+            self._draining.discard(worker)
+
+    def post_message(self, worker: int | None, token: int, sender: str,
+                     receiver: str, message: str, timestamp: int,
+                     request_id: int = 0, limited: bool = False) -> None:
+        """Number, store and publish a chat message. A message the client
+        sent again after losing the ack is only acked, and a ``limited``
+        one is refused once the sender is out of tokens"""
+        message_id = self.request_log.get(sender, request_id)
+        if message_id is not None:
+            self.send(worker, 'acked', token, message_id)
+            return
+        if limited and not self.rate_limiter.allow(sender):
+            self.send(worker, 'limited', token)
+            return
+        self.last_message_id += 1
+        message_id = self.last_message_id
+        self.storage.put(
+            Write.MESSAGE,
+            (message_id, message, sender, receiver, timestamp)
+        )
+        self.request_log.add(sender, request_id, message_id)
+        self.publish('message', Message.create(
+            message_id, timestamp, sender, receiver, message), worker, token)
+
+    def deliver_scheduled(self, batch: list[ScheduledMessage]) -> None:
+        """Post the scheduled messages that fell due in one tick"""
+        timestamp = self.now()
+        for scheduled in batch:
+            self.post_message(
+                None, 0, scheduled.sender, scheduled.receiver,
+                scheduled.message, timestamp)
+
+    def schedule(self, request: RequestData) -> str:
+        """Answer a request about scheduled messages, a message to the
+        general chat is counted by the rate limiter when it is scheduled"""
+        if request.target == Target.SCHEDULE \
+                and request.receiver in ('', 'all') \
+                and not self.rate_limiter.allow(request.username):
+            return LIMIT_WARNING
+        return self.scheduler.handle(request)
+
+    async def snapshot_rate_limits(self) -> None:
+        """Periodically save the rate limiter state"""
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_SNAPSHOT_INTERVAL)
+            self.rate_limiter.snapshot(self.storage)
+
+    def join(self, worker: int, username: str) -> None:
+        workers = self.online.setdefault(username, set())
+        if not workers:
+            self.publish('joined', username)
+        workers.add(worker)
+
+    def leave(self, worker: int, username: str) -> None:
+        workers = self.online.get(username)
+        if workers is None:
+            return
+        workers.discard(worker)
+        if not workers:
+            del self.online[username]
+            self.publish('left', username)
+
+    def expire(self, deadline: int) -> None:
+        """Tell the workers to trim their history buffers"""
+        self.publish('expire', deadline)
+
+
+class BusClient:
+    """Worker side of the bus.
+
+    It replaces the write queue of the worker's ``Server``: writes
+    are forwarded to the hub, and ``flush`` waits until the hub has written
+    everything this worker sent before.
+    """
+
+    def __init__(self, path: str, worker: int) -> None:
+        self.path = path
+        self.worker = worker
+        self.online = OnlineUsers()
+        self.writer: StreamWriter | None = None
+        self._tokens = itertools.count()
+        # connections waiting for the messages they sent to come back, with
+        # the numbers of the requests to ack
+        self._pending: dict[int, tuple[Connection, int]] = dict()
+        # connections waiting for the hub to answer about scheduled messages
+        self._replies: dict[int, Connection] = dict()
+        # flushes and rate limit checks waiting for the hub to answer
+        self._futures: dict[int, asyncio.Future] = dict()
+        # ends when the hub goes away
+        self.task: asyncio.Task | None = None
+
+    async def connect(self, server: Any) -> None:
+        """Join the hub and dispatch its events to ``server``"""
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self._send('hello', self.worker)
+        self.task = asyncio.get_running_loop().create_task(
+            self._run(reader, server))
+
+    async def stop(self) -> None:
+        """Hand the buffered events to the hub and disconnect"""
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def put(self, kind: str, params: tuple[Any, ...]) -> None:
+        self._send('write', kind, params)
+
+    async def flush(self) -> None:
+        """StorageError if the hub failed to write"""
+        await self._ask('flush')
+
+    async def allow(self, username: str) -> bool:
+        """Take a token from the user's bucket in the hub's rate limiter"""
+        return bool(await self._ask('allow', username))
+
+    def post_message(self, connection: Connection | None,
+                     request_number: int,
+                     sender: str, receiver: str, message: str,
+                     timestamp: int, request_id: int = 0,
+                     limited: bool = False) -> None:
+        """Send a chat message to the hub for numbering and delivery,
+        ``connection`` gets an ack and not the message itself, or the
+        limit warning if the message is ``limited`` and the hub refuses
+        it"""
+        token = next(self._tokens)
+        self._pending[token] = (connection, request_number)
+        self._send('message', token, sender, receiver, message, timestamp,
+                   request_id, limited)
+
+    def schedule(self, connection: Connection, request: RequestData) -> None:
+        """Pass a request about scheduled messages to the hub, the answer
+        goes to ``connection``"""
+        token = next(self._tokens)
+        self._replies[token] = connection
+        self._send('schedule', token, request)
+
+    def join(self, username: str) -> None:
+        self._send('join', username)
+
+    def leave(self, username: str) -> None:
+        self._send('leave', username)
+
+    def _send(self, *event: Any) -> None:
+        self.writer.write(encode_event(*event))
+
+    async def _ask(self, event: str, *args: Any) -> Any:
+        """Send the event and wait for the hub's answer, None if the hub
+        has gone"""
+        token = next(self._tokens)
+        future = self._futures[token] = \
+            asyncio.get_running_loop().create_future()
+        self._send(event, token, *args)
+        return await future
+
+    async def _run(self, reader: StreamReader, server: Any) -> None:
+        try:
+            async for frame in iter_frames(reader, MAX_EVENT_SIZE):
+                event, *args = pickle.loads(frame)
+                match event:
+                    case 'message':
+                        message, worker, token = args
+                        origin = self._pending.pop(token, (None, 0)) \
+                            if worker == self.worker else (None, 0)
+                        server.deliver_message(message, *origin)
+                    case 'allowed':
+                        token, allowed = args
+                        self._futures.pop(token).set_result(allowed)
+                    case 'limited':
+                        server.send_limit_warning(*self._pending.pop(args[0]))
+                    case 'acked':
+                        token, message_id = args
+                        server.send_ack(*self._pending.pop(token), message_id)
+                    case 'reply':
+                        token, text = args
+                        self._replies.pop(token).send(encode_text(text))
+                    case 'flushed':
+                        token, error = args
+                        future = self._futures.pop(token)
+                        if error:
+                            future.set_exception(StorageError(error))
+                        else:
+                            future.set_result(None)
+                    case 'joined':
+                        self.online.add(args[0])
+                        server.send_hello(args[0])
+                    case 'left':
+                        self.online.discard(args[0])
+                        server.send_left(args[0])
+                    case 'online':
+                        self.online = OnlineUsers(args[0])
+                    case 'expire':
+                        server.history.expire(args[0])
+        except (FrameError, ConnectionError) as er:
+            server_logger.error('Bus error: %s', er)
+        server_logger.error('Worker %s lost the bus', self.worker)
+        # nothing is going to be answered any more
+        for future in self._futures.values():
+            future.set_result(None)
+        self._futures.clear()
@@ -1,23 +1,146 @@
 import asyncio
+import itertools
+import os
+import secrets
 from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
+from datetime import datetime, timedelta
+from typing import AsyncIterator, BinaryIO, Callable, Iterable
 
-from structs import RequestData, Command
+from structs import (
+    TZ, Codec, IncomingMessage, RequestData, Command, Target, to_timestamp
+)
+from codec import get_codec
+from compression import StreamDecompressor
+from protocol import (
+    ACK, COMPRESSED, FILE_CHUNK, FILE_START, HEADER, NACK, FrameError,
+    encode_frame, iter_frames
+)
 from config import settings
 from utils import client_logger
 
 
+def parse_send_time(text: str) -> datetime:
+    """Time of the ``schedule`` commands: ``+<seconds>`` from now or an
+    ISO date and time, local to TZ unless it has an offset"""
+    if text.startswith('+'):
+        return datetime.now(TZ) + timedelta(seconds=float(text[1:]))
+    send_at = datetime.fromisoformat(text)
+    return TZ.localize(send_at) if send_at.tzinfo is None else send_at
+
+
+# called with the bytes sent or received so far and the size of the file
+Progress = Callable[[int, int], None]
+
+
+class Download:
+    """A file requested from the server"""
+
+    def __init__(self, path: str, progress: Progress | None) -> None:
+        self.path = path
+        self.progress = progress
+        self.size = 0
+        self.received = 0
+        self.file: BinaryIO | None = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    def start(self, name: str, size: int) -> None:
+        if os.path.isdir(self.path):
+            self.path = os.path.join(self.path, os.path.basename(name))
+        self.size = size
+        self.file = open(self.path, 'wb')
+
+    def write(self, chunk: memoryview) -> None:
+        self.file.write(chunk)
+        self.received += len(chunk)
+        if self.progress is not None:
+            self.progress(self.received, self.size)
+
+    def finish(self) -> None:
+        self.file.close()
+        if not self.done.done():
+            self.done.set_result(self.path)
+
+    def fail(self, error: Exception) -> None:
+        if self.file is not None:
+            self.file.close()
+        if not self.done.done():
+            self.done.set_exception(error)
+
+
 class Client:
+    """Chat client, interactive with ``connect`` or headless:
+
+        async with Client('bot', device='bot') as client:
+            await client.send_to('Vupsen', 'Hi!')
+            async for message in client.messages():
+                ...
+
+    Requests are written without waiting for the server, so many sends in
+    a row are pipelined. A lost connection is restored on the next send or
+    by ``messages``.
+
+    With ``acks`` the server answers every chat message with its id, and
+    the client acknowledges the ids it got every ``ACK_INTERVAL`` seconds.
+    After a reconnect the server resumes after the last id the client has,
+    and the messages it has not numbered yet are sent again. The acks come
+    through ``messages``, so it has to be iterated.
+
+    With ``compression='zlib'`` the server deflates large batches of frames
+    sent at once, such as the history, keeping one stream per connection.
+
+    Files are streamed in chunks both ways. The server announces a file
+    with a chat message, and ``download`` gets it by the id in the
+    message, ``IncomingMessage.file_id``. Files come through ``messages``
+    as well.
+    """
+
     def __init__(self, username: str, server_host: str = settings.HOST,
-                 server_port: int = settings.PORT) -> None:
+                 server_port: int = settings.PORT,
+                 codec: str = Codec.JSON, device: str = '',
+                 reconnect: bool = True, acks: bool = True,
+                 compression: str = '') -> None:
         self.username = username
+        self.device = device
+        self.codec = get_codec(codec)
         self.server_host = server_host
         self.server_port = server_port
+        self.reconnect = reconnect
+        self.acks = acks
+        self.compression = compression
+        self._decompressor: StreamDecompressor | None = None
         self.writer = None
         self.reader = None
-        self.event_loop = asyncio.new_event_loop()
+        self.event_loop = None
+        # id of the last chat message received or sent
+        self.last_id = 0
+        self._closed = False
+        self._reconnecting = asyncio.Lock()
+        # chat messages sent on the connection by their number
+        self._requests = 0
+        # the server drops a chat message sent again with the same request
+        # id, a random start keeps the ids of the clients apart
+        self._request_ids = itertools.count(secrets.randbits(62))
+        self._unacked: dict[int, bytes] = dict()
+        self._all_acked = asyncio.Event()
+        self._all_acked.set()
+        self._acked_id = 0
+        self._ack_task: asyncio.Task | None = None
+        # downloads requested, the server answers them in order, and the
+        # one being received
+        self._downloads: deque[Download] = deque()
+        self._download: Download | None = None
+
+    async def __aenter__(self) -> 'Client':
+        await self.connect_to_server()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
     def connect(self) -> None:
         """The main method of connecting to the server"""
+        self.event_loop = asyncio.new_event_loop()
         try:
             self.event_loop.run_until_complete(self.connect_to_server())
         except ConnectionRefusedError:
@@ -34,9 +157,200 @@ class Client:
             self.server_host, self.server_port
         )
         client_logger.info('Connect to server')
+        # every connection starts a new compressed stream
+        if self.compression:
+            self._decompressor = StreamDecompressor()
         await self.send_hello_message()
+        await self.resend_unacked()
         return self.reader, self.writer
 
+    async def close(self) -> None:
+        """Close the connection and stop reconnecting"""
+        self._closed = True
+        if self._ack_task is not None:
+            self._ack_task.cancel()
+        if self.writer is not None:
+            if self.is_connected():
+                self.send_ack()
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def is_connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing() \
+            and not self.reader.at_eof()
+
+    async def ensure_connected(self) -> None:
+        """Reconnect with a growing delay if the connection was lost"""
+        if self.is_connected():
+            return
+        async with self._reconnecting:
+            delay = settings.RECONNECT_DELAY
+            while not self.is_connected():
+                if self._closed or not self.reconnect:
+                    raise ConnectionError('Not connected to the server')
+                if self.writer is not None:
+                    self.writer.close()
+                try:
+                    await self.connect_to_server()
+                except OSError as er:
+                    client_logger.warning('Unable to reconnect: %s', er)
+                    await asyncio.sleep(delay)
+                    delay = min(2 * delay, settings.RECONNECT_MAX_DELAY)
+
+    async def messages(self) -> AsyncIterator[IncomingMessage]:
+        """Parsed frames from the server, across reconnects"""
+        while True:
+            try:
+                async for message in self._read_messages():
+                    yield message
+            except FrameError as er:
+                client_logger.error('Protocol error: %s', er)
+                # the rest of the stream can not be trusted
+                self.writer.close()
+            except ConnectionError as er:
+                client_logger.warning('Connection lost: %s', er)
+            self.fail_downloads()
+            if self._closed or not self.reconnect:
+                return
+            client_logger.info('Reconnect to server')
+            try:
+                await self.ensure_connected()
+            except ConnectionError:
+                return
+
+    async def _read_messages(self) -> AsyncIterator[IncomingMessage]:
+        """Parsed frames from the current connection"""
+        async for frame in iter_frames(self.reader):
+            for frame in self.unpack(frame):
+                message = self.receive(frame)
+                if message is not None:
+                    yield message
+
+    def unpack(self, frame: bytes) -> list[bytes]:
+        """Frames held in a compressed frame, or the frame itself"""
+        if frame[:1] == COMPRESSED and self._decompressor is not None:
+            return self._decompressor.decompress(frame)
+        return [frame]
+
+    def receive(self, frame: bytes) -> IncomingMessage | None:
+        """Parse a frame from the server, None for an ack or a part of
+        a file"""
+        if frame[:1] == FILE_CHUNK:
+            self.receive_chunk(frame)
+            return None
+        try:
+            if frame[:1] == FILE_START:
+                file_id, size, name = frame[1:].decode().split(' ', 2)
+                self.start_download(file_id, int(size), name)
+                return None
+            if frame[:1] == ACK:
+                number, message_id = frame[1:].split()
+                self.last_id = max(self.last_id, int(message_id))
+                self.acked(int(number))
+                self.schedule_ack()
+                return None
+            if frame[:1] == NACK:
+                number, reason = frame[1:].decode().split(' ', 1)
+                self.acked(int(number))
+                return IncomingMessage(reason)
+        except ValueError:
+            client_logger.error('Invalid control frame: %r', frame[:64])
+            return None
+        message = IncomingMessage.parse(frame)
+        if message.id:
+            self.last_id = max(self.last_id, message.id)
+            self.schedule_ack()
+        return message
+
+    def start_download(self, file_id: str, size: int, name: str) -> None:
+        if not self._downloads:
+            client_logger.warning('File %s was not requested', file_id)
+            return
+        download = self._downloads.popleft()
+        if size < 0:
+            download.fail(FileNotFoundError(f'{name}: {file_id}'))
+            return
+        try:
+            download.start(name, size)
+        except OSError as er:
+            download.fail(er)
+            return
+        self._download = download
+
+    def receive_chunk(self, frame: bytes) -> None:
+        """Write a chunk of the file being downloaded, an empty chunk
+        ends the file"""
+        download = self._download
+        if download is None:
+            # the file could not be saved, the chunks are dropped
+            return
+        if len(frame) == len(FILE_CHUNK):
+            self._download = None
+            download.finish()
+            return
+        try:
+            download.write(memoryview(frame)[len(FILE_CHUNK):])
+        except OSError as er:
+            self._download = None
+            download.fail(er)
+
+    def fail_downloads(self) -> None:
+        """Fail the downloads the lost connection will not bring"""
+        if self._download is not None:
+            self._downloads.appendleft(self._download)
+            self._download = None
+        while self._downloads:
+            self._downloads.popleft().fail(
+                ConnectionError('Connection lost during the download'))
+
+    def acked(self, number: int) -> None:
+        self._unacked.pop(number, None)
+        if not self._unacked:
+            self._all_acked.set()
+
+    async def wait_acked(self) -> None:
+        """Wait until the server has numbered or refused every chat
+        message sent"""
+        await self._all_acked.wait()
+
+    def schedule_ack(self) -> None:
+        if not self.acks:
+            return
+        if self._ack_task is None or self._ack_task.done():
+            self._ack_task = asyncio.get_running_loop().create_task(
+                self._ack_later())
+
+    async def _ack_later(self) -> None:
+        await asyncio.sleep(settings.ACK_INTERVAL)
+        if self.is_connected():
+            self.send_ack()
+
+    def send_ack(self) -> None:
+        """Acknowledge every message up to the last one received"""
+        if not self.acks or self.last_id <= self._acked_id:
+            return
+        self._acked_id = self.last_id
+        self.writer.write(self.codec.encode_frame(RequestData(
+            self.username, Target.ACK, message=str(self.last_id))))
+
+    async def resend_unacked(self) -> None:
+        """Send again, in order, the chat messages the server has not
+        numbered; they are counted anew on the new connection"""
+        frames = list(self._unacked.values())
+        self._unacked.clear()
+        self._requests = 0
+        if not frames:
+            return
+        client_logger.info('Send again %s messages', len(frames))
+        for frame in frames:
+            self._requests += 1
+            self._unacked[self._requests] = frame
+        self.writer.write(b''.join(frames))
+        await self.writer.drain()
+
     async def send_command(self) -> None:
         """Listen commands and execute"""
         print(
@@ -53,14 +367,35 @@ class Client:
             command = command.split()
             match command[0]:
                 case Command.EXIT | Command.QUIT:
-                    self.writer.close()
+                    await self.close()
                     break
                 case Command.SEND:
                     await self.send_all(' '.join(command[1:]))
-                case Command.SEND_TO:
-                    await self.send_all(' '.join(command[1:]))
+                case Command.SEND_TO if len(command) > 1:
+                    await self.send_to(command[1], ' '.join(command[2:]))
                 case Command.STATUS:
                     await self.get_status()
+                case Command.ADMIN:
+                    await self.send_admin(' '.join(command[1:]))
+                case Command.SCHEDULE if len(command) > 1:
+                    await self.schedule_command(
+                        command[1], ' '.join(command[2:]))
+                case Command.SCHEDULE_TO if len(command) > 2:
+                    await self.schedule_command(
+                        command[2], ' '.join(command[3:]), command[1])
+                case Command.SCHEDULED:
+                    await self.get_scheduled()
+                case Command.CANCEL if len(command) > 1:
+                    await self.cancel(command[1])
+                case Command.UPLOAD if len(command) > 1:
+                    await self.upload_command(' '.join(command[1:]))
+                case Command.UPLOAD_TO if len(command) > 2:
+                    await self.upload_command(
+                        ' '.join(command[2:]), command[1])
+                case Command.DOWNLOAD if len(command) > 1:
+                    # saved while the next commands are typed
+                    self.event_loop.create_task(self.download_command(
+                        command[1], ' '.join(command[2:]) or '.'))
                 case Command.HELP:
                     self.get_help()
                 case _:
@@ -68,47 +403,195 @@ class Client:
 
     async def read_data(self) -> None:
         """Receiving incoming data and printing"""
-        while data := await self.reader.read(1024):
-            print(f'\n{data.decode()}')
+        async for message in self.messages():
+            print(f'\n{message}')
 
         print('Close the connection')
         client_logger.info('Close the connection')
         self.writer.close()
 
-    async def send_all(self, message: str = '') -> None:
+    async def send(self, message: str = '') -> None:
         """Send message to all users"""
-        request_data = RequestData(
+        await self.send_request(RequestData(
             username=self.username,
             message=message,
-        )
-        self.writer.write(request_data.to_string_json().encode())
-        await self.writer.drain()
+        ))
+
+    send_all = send
+
+    async def send_batch(self, messages: Iterable[str],
+                         receiver: str = '') -> None:
+        """Send many messages to ``receiver`` or to all in one write"""
+        target = Target.ONE_TO_ONE if receiver else Target.ALL
+        await self._write([
+            self.codec.encode_frame(RequestData(
+                self.username, target, receiver, message,
+                request_id=self.next_request_id()))
+            for message in messages
+        ], chat=True)
+
+    async def send_request(self, request_data: RequestData) -> None:
+        chat = request_data.target in (Target.ALL, Target.ONE_TO_ONE)
+        if chat:
+            request_data.request_id = self.next_request_id()
+        await self._write([self.codec.encode_frame(request_data)], chat=chat)
+
+    def next_request_id(self) -> int:
+        """Id of a chat message, only a message that may be sent again
+        needs one"""
+        return next(self._request_ids) if self.acks else 0
+
+    async def _write(self, frames: list[bytes], chat: bool = False) -> None:
+        """Write frames, waiting only while the socket buffer is full. A
+        write refused because the connection was lost is repeated once
+        after reconnecting"""
+        await self.ensure_connected()
+        tracked = chat and self.acks
+        if tracked:
+            self._all_acked.clear()
+            for frame in frames:
+                self._requests += 1
+                self._unacked[self._requests] = frame
+        data = b''.join(frames)
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except ConnectionError:
+            if self._closed or not self.reconnect:
+                raise
+            await self.ensure_connected()
+            # chat messages without an ack are sent again on reconnect
+            if not tracked:
+                self.writer.write(data)
+                await self.writer.drain()
 
     async def send_hello_message(self) -> None:
         """Send notification to all users"""
-        request_data = RequestData(self.username, target='hello')
-        self.writer.write(request_data.to_string_json().encode())
+        request_data = RequestData(
+            self.username, target='hello', codec=self.codec.name,
+            device=self.device, acks=self.acks,
+            last_id=self.last_id if self.acks else 0,
+            compression=self.compression)
+        # HELLO is always JSON, it negotiates the codec for the next requests
+        self.writer.write(request_data.to_frame())
         await self.writer.drain()
 
     async def send_to(self, receiver: str, message: str = '') -> None:
         """Send private message"""
-        request_data = RequestData(
+        await self.send_request(RequestData(
             username=self.username,
             target='one_to_one',
             message=message,
             receiver=receiver,
-        )
-        self.writer.write(request_data.to_string_json().encode())
-        await self.writer.drain()
+        ))
 
     async def get_status(self) -> None:
         """Get status information about a chat"""
-        request_data = RequestData(
+        await self.send_request(RequestData(
             username=self.username,
             target='status'
-        )
-        self.writer.write(request_data.to_string_json().encode())
-        await self.writer.drain()
+        ))
+
+    async def send_admin(self, command: str = 'metrics') -> None:
+        """Send an admin command, the server answers to ADMIN_USERS only"""
+        await self.send_request(RequestData(
+            username=self.username,
+            target='admin',
+            message=command,
+        ))
+
+    async def schedule(self, message: str, send_at: datetime,
+                       receiver: str = '') -> None:
+        """Have the server send a message to ``receiver`` or to all at
+        ``send_at``, a naive time is local to TZ. The server answers with
+        the id to cancel it by"""
+        if send_at.tzinfo is None:
+            send_at = TZ.localize(send_at)
+        await self.send_request(RequestData(
+            username=self.username,
+            target=Target.SCHEDULE,
+            receiver=receiver,
+            message=message,
+            send_at=to_timestamp(send_at),
+        ))
+
+    async def schedule_command(self, send_time: str, message: str,
+                               receiver: str = '') -> None:
+        try:
+            send_at = parse_send_time(send_time)
+        except ValueError:
+            print(f'Invalid time "{send_time}"')
+            return
+        await self.schedule(message, send_at, receiver)
+
+    async def get_scheduled(self) -> None:
+        """Ask for the scheduled messages not sent yet"""
+        await self.send_request(RequestData(
+            username=self.username,
+            target=Target.SCHEDULED,
+        ))
+
+    async def cancel(self, scheduled_id: int | str) -> None:
+        """Cancel a scheduled message by its id"""
+        await self.send_request(RequestData(
+            username=self.username,
+            target=Target.CANCEL,
+            message=str(scheduled_id),
+        ))
+
+    async def upload(self, path: str, receiver: str = '',
+                     progress: Progress | None = None) -> None:
+        """Send a file to ``receiver`` or to all. The file is read and
+        sent chunk by chunk, waiting while the socket buffer is full; the
+        server announces it with a chat message or answers why not"""
+        loop = asyncio.get_running_loop()
+        file = await loop.run_in_executor(None, open, path, 'rb')
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            await self.send_request(RequestData(
+                username=self.username,
+                target=Target.FILE,
+                receiver=receiver,
+                message=os.path.basename(path),
+            ))
+            sent = 0
+            while chunk := await loop.run_in_executor(
+                    None, file.read, settings.FILE_CHUNK_SIZE):
+                await self._write([
+                    HEADER.pack(len(FILE_CHUNK) + len(chunk)), FILE_CHUNK,
+                    chunk])
+                sent += len(chunk)
+                if progress is not None:
+                    progress(sent, size)
+        await self._write([encode_frame(FILE_CHUNK)])
+
+    async def download(self, file_id: str, path: str = '.',
+                       progress: Progress | None = None) -> str:
+        """Save a file sent to the chat to ``path``, a directory keeps
+        its name. Return the path of the file, FileNotFoundError if the
+        server has no such file for the user"""
+        download = Download(path, progress)
+        self._downloads.append(download)
+        await self.send_request(RequestData(
+            username=self.username,
+            target=Target.DOWNLOAD,
+            message=file_id,
+        ))
+        return await download.done
+
+    async def upload_command(self, path: str, receiver: str = '') -> None:
+        try:
+            await self.upload(path, receiver)
+        except OSError as er:
+            print(f'Unable to send "{path}": {er}')
+
+    async def download_command(self, file_id: str, path: str) -> None:
+        try:
+            path = await self.download(file_id, path)
+        except OSError as er:
+            print(f'\nUnable to download {file_id}: {er}')
+            return
+        print(f'\nFile {file_id} is saved to {path}')
 
     @staticmethod
     def get_help() -> None:
@@ -116,5 +599,15 @@ class Client:
         print('status - get your username, address and users online')
         print('send <message> - send message to all')
         print('send-to <username> <message> - send private message to user')
+        print('schedule <time> <message> - send message to all at <time>: '
+              '+<seconds> or YYYY-MM-DDTHH:MM')
+        print('schedule-to <username> <time> <message> - send private '
+              'message at <time>')
+        print('scheduled - list your scheduled messages')
+        print('cancel <id> - cancel a scheduled message')
+        print('upload <path> - send a file to all')
+        print('upload-to <username> <path> - send a file to user')
+        print('download <id> [path] - save a file sent to the chat')
+        print('admin [metrics] - get server metrics (admins only)')
         print('quit or exit - leave the chat')
         print('help - get get available commands')
@@ -0,0 +1,121 @@
+import struct
+
+from protocol import encode_frame
+from structs import Codec, RequestData, Target
+
+
+# the codes stay below FILE_CHUNK, the first byte of the file data frames
+TARGET_CODES: dict[str, int] = {
+    Target.ALL: 0,
+    Target.ONE_TO_ONE: 1,
+    Target.HELLO: 2,
+    Target.STATUS: 3,
+    Target.ADMIN: 4,
+    Target.ACK: 5,
+    Target.SCHEDULE: 6,
+    Target.SCHEDULED: 7,
+    Target.CANCEL: 8,
+    Target.FILE: 9,
+    Target.DOWNLOAD: 10,
+}
+CODE_TARGETS: dict[int, Target] = {
+    code: Target(target) for target, code in TARGET_CODES.items()
+}
+# the number field that ends a binary request of the target
+TRAILERS: dict[str, str] = {
+    Target.ALL: 'request_id',
+    Target.ONE_TO_ONE: 'request_id',
+    Target.SCHEDULE: 'send_at',
+}
+
+
+class JsonCodec:
+    """RequestData as a JSON object, the default codec"""
+    name = Codec.JSON
+
+    @staticmethod
+    def encode(request: RequestData) -> bytes:
+        return request.to_string_json().encode()
+
+    @staticmethod
+    def decode(payload: bytes) -> RequestData:
+        return RequestData.from_frame(payload)
+
+    def encode_frame(self, request: RequestData) -> bytes:
+        return encode_frame(self.encode(request))
+
+
+class BinaryCodec:
+    """RequestData as a fixed header followed by UTF-8 strings.
+
+    The header holds the target as a one-byte code and the byte lengths
+    of the username, receiver and message that follow it. A SCHEDULE
+    request ends with its send time and a chat message with its request
+    id.
+    """
+    name = Codec.BINARY
+    header = struct.Struct('!BHHI')
+    trailer = struct.Struct('!q')
+
+    def encode(self, request: RequestData) -> bytes:
+        username = request.username.encode()
+        receiver = request.receiver.encode()
+        message = request.message.encode()
+        field = TRAILERS.get(request.target)
+        trailer = b'' if field is None \
+            else self.trailer.pack(getattr(request, field))
+        return b''.join((
+            self.header.pack(
+                TARGET_CODES[request.target],
+                len(username), len(receiver), len(message)
+            ),
+            username, receiver, message, trailer
+        ))
+
+    def decode(self, payload: bytes) -> RequestData:
+        try:
+            code, username_len, receiver_len, message_len = \
+                self.header.unpack_from(payload)
+        except struct.error as er:
+            raise ValueError(f'Invalid binary header: {er}') from er
+        if code not in CODE_TARGETS:
+            raise ValueError(f'Unknown target code {code}')
+        target = CODE_TARGETS[code]
+        receiver_start = self.header.size + username_len
+        message_start = receiver_start + receiver_len
+        message_end = message_start + message_len
+        field = TRAILERS.get(target)
+        trailer_size = 0 if field is None else self.trailer.size
+        if message_end + trailer_size != len(payload):
+            raise ValueError('Binary payload length mismatch')
+        view = memoryview(payload)
+        request = RequestData(
+            username=str(view[self.header.size:receiver_start], 'utf-8'),
+            target=target,
+            receiver=str(view[receiver_start:message_start], 'utf-8'),
+            message=str(view[message_start:message_end], 'utf-8'),
+            codec=Codec.BINARY,
+        )
+        if field is not None:
+            setattr(request, field,
+                    self.trailer.unpack_from(payload, message_end)[0])
+        return request
+
+    def encode_frame(self, request: RequestData) -> bytes:
+        return encode_frame(self.encode(request))
+
+
+RequestCodec = JsonCodec | BinaryCodec
+
+CODECS: dict[str, RequestCodec] = {
+    Codec.JSON: JsonCodec(),
+    Codec.BINARY: BinaryCodec(),
+}
+
+
+def get_codec(name: str) -> RequestCodec:
+    """Codec by its name, ValueError for unsupported codecs"""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'Unsupported codec "{name}"') from None
@@ -10,6 +10,52 @@ class Settings(BaseSettings):
     LIFETIME_MESSAGES: int = 60
     LIMIT_MESSAGES: int = 20
     UPDATE_PERIOD: int = 60
+    DB_POOL_SIZE: int = 4
+    DB_CACHED_STATEMENTS: int = 128
+    DB_CACHE_SIZE_KB: int = 16384
+    DB_BUSY_TIMEOUT_MS: int = 5000
+    WRITE_BATCH_SIZE: int = 256
+    WRITE_FLUSH_INTERVAL: float = 0.05
+    WRITE_RETRIES: int = 3
+    MAX_FRAME_SIZE: int = 1024 * 1024
+    WRITE_TIMEOUT: float = 5.0
+    OUTBOUND_QUEUE_MESSAGES: int = 1000
+    OUTBOUND_QUEUE_BYTES: int = 4 * 1024 * 1024
+    SLOW_CONSUMER_POLICY: str = 'drop_oldest'
+    USER_CACHE_SIZE: int = 10000
+    RATE_LIMIT_USERS: int = 100000
+    RATE_LIMIT_SNAPSHOT_INTERVAL: float = 60.0
+    HISTORY_PRIVATE_SIZE: int = 50
+    HISTORY_PRIVATE_USERS: int = 1000
+    EXPIRY_CHUNK_SIZE: int = 1000
+    EXPIRY_RETRY_INTERVAL: float = 60.0
+    HISTORY_PAGE_SIZE: int = 100
+    CURSOR_SAVE_INTERVAL: float = 5.0
+    WORKERS: int = 1
+    METRICS_HOST: str = '127.0.0.1'
+    METRICS_PORT: int = 8001
+    ADMIN_USERS: list[str] = []
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_MAX_BYTES: int = 10 * 1024 * 1024
+    LOG_BACKUP_COUNT: int = 5
+    RECONNECT_DELAY: float = 0.5
+    RECONNECT_MAX_DELAY: float = 30.0
+    ACK_INTERVAL: float = 0.2
+    REQUEST_LOG_SIZE: int = 100000
+    COMPRESSION_THRESHOLD: int = 512
+    COMPRESSION_LEVEL: int = 6
+    STORAGE: str = 'sqlite'
+    STORAGE_PATH: str = 'chat_data'
+    SNAPSHOT_INTERVAL: float = 300.0
+    SCHEDULE_TICK: float = 0.1
+    SCHEDULE_USER_LIMIT: int = 100
+    FILES_PATH: str = 'chat_files'
+    MAX_FILE_SIZE: int = 5 * 1024 * 1024
+    FILE_CHUNK_SIZE: int = 64 * 1024
+    HTTP_PORT: int = 8080
+    HTTP_KEEP_ALIVE: float = 30.0
+    HTTP_POLL_TIMEOUT: float = 30.0
+    HTTP_MAX_HEADER_SIZE: int = 16 * 1024
 
     class Config:
         case_sensitive = True
@@ -0,0 +1,313 @@
+import asyncio
+
+from asyncio.streams import StreamWriter
+from collections import deque
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator
+
+from compression import StreamCompressor
+from config import settings
+from metrics import fanout_frames, fanout_seconds, file_bytes
+from protocol import FILE_CHUNK, HEADER, encode_frame
+from structs import SlowConsumerPolicy
+from utils import server_logger
+
+
+@dataclass
+class QueueMetrics:
+    """Outbound queue counters shared by all connections of a server"""
+    enqueued: int = 0
+    dropped: int = 0
+    slow_disconnects: int = 0
+    max_depth: int = 0
+
+
+class Connection:
+    """Client connection with its own bounded outbound queue.
+
+    ``send`` never waits: it appends a frame to the queue and a writer task
+    flushes everything queued with one ``writelines`` per drain cycle.
+    When the queue exceeds ``max_messages`` frames or ``max_bytes`` bytes
+    the slow-consumer ``policy`` applies:
+
+    * ``drop_oldest`` - the oldest frames are discarded;
+    * ``coalesce`` - frames stay queued and are written together, only the
+      byte bound applies and the oldest frames are discarded above it;
+    * ``disconnect`` - the connection is closed.
+
+    Files skip the queue: ``send_file`` hands them to the socket with
+    ``loop.sendfile`` while the writer task waits.
+    """
+
+    def __init__(self, writer: StreamWriter, metrics: QueueMetrics,
+                 max_messages: int = settings.OUTBOUND_QUEUE_MESSAGES,
+                 max_bytes: int = settings.OUTBOUND_QUEUE_BYTES,
+                 policy: str = settings.SLOW_CONSUMER_POLICY,
+                 timeout: float = settings.WRITE_TIMEOUT) -> None:
+        self.writer = writer
+        self.address: tuple[str, int] = writer.get_extra_info('peername')
+        self.metrics = metrics
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = SlowConsumerPolicy(policy)
+        self.timeout = timeout
+        self.dropped = 0
+        self.username: str | None = None
+        self.device = ''
+        # id of the last chat message queued on this connection
+        self.last_id = 0
+        # a client with acks confirms the ids it got, up to ``acked_id``
+        self.acks = False
+        self.acked_id = 0
+        # chat messages received, the number of the request in an ack
+        self.requests = 0
+        # live frames kept back while the history is replayed
+        self._held: list[tuple[bytes, int | None]] | None = None
+        # set when the client asked for compression in its HELLO
+        self.compressor: StreamCompressor | None = None
+        self._queue: deque[bytes] = deque()
+        self._queued_bytes = 0
+        self._ready = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._flushed.set()
+        # held by the writer task and by a file being sent
+        self._writing = asyncio.Lock()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    @property
+    def depth(self) -> int:
+        """Number of frames waiting to be written"""
+        return len(self._queue)
+
+    @property
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    @property
+    def delivered_id(self) -> int:
+        """Id up to which the device has the messages: acknowledged by a
+        client with acks, queued for any other client"""
+        return self.acked_id if self.acks else self.last_id
+
+    def ack(self, message_id: int) -> None:
+        """Cumulative ack of the client, ids it was never sent are ignored"""
+        self.acked_id = max(self.acked_id, min(message_id, self.last_id))
+
+    def hold(self) -> None:
+        """Keep live frames back until ``release``, so that the history
+        replayed meanwhile comes first and the ids on the stream grow"""
+        self._held = []
+
+    def release(self) -> None:
+        """Queue the frames kept back except those already replayed"""
+        held, self._held = self._held, None
+        for payload, message_id in held or ():
+            if message_id is None or message_id > self.last_id:
+                self.send(payload, message_id)
+
+    def send(self, payload: bytes, message_id: int | None = None,
+             replay: bool = False) -> bool:
+        """Queue a frame, return False if it was not accepted. Frames of
+        the replayed history skip the hold."""
+        if self.writer.is_closing():
+            return False
+        if self._held is not None and not replay:
+            self._held.append((payload, message_id))
+            return True
+        if message_id is not None:
+            self.last_id = message_id
+        self._flushed.clear()
+        self._queue.append(payload)
+        self._queued_bytes += len(payload)
+        self.metrics.enqueued += 1
+        if self._is_full():
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                self.metrics.slow_disconnects += 1
+                server_logger.warning(
+                    'Disconnect slow consumer %s (%s frames queued)',
+                    self.address, len(self._queue))
+                self.close()
+                return False
+            self._drop_oldest()
+        self.metrics.max_depth = max(self.metrics.max_depth, len(self._queue))
+        self._ready.set()
+        return True
+
+    async def flushed(self) -> None:
+        """Wait until everything queued has been handed to the socket"""
+        while not self._flushed.is_set() and not self.writer.is_closing():
+            await self._flushed.wait()
+
+    async def send_file(self, header: bytes, file: BinaryIO, size: int,
+                        chunk_size: int = settings.FILE_CHUNK_SIZE) -> None:
+        """Write the frame ``header`` and ``size`` bytes of ``file`` in
+        ``FILE_CHUNK`` frames after the frames queued so far. The data goes
+        from the file to the socket in the kernel where the platform allows
+        it; frames queued meanwhile are written after the file"""
+        await self.flushed()
+        loop = asyncio.get_running_loop()
+        async with self._writing:
+            if self.writer.is_closing():
+                return
+            self.writer.write(header)
+            offset = 0
+            try:
+                while offset < size:
+                    count = min(chunk_size, size - offset)
+                    self.writer.write(HEADER.pack(count + 1) + FILE_CHUNK)
+                    await asyncio.wait_for(loop.sendfile(
+                        self.writer.transport, file, offset, count),
+                        self.timeout)
+                    offset += count
+                    file_bytes.labels('sent').inc(count)
+                self.writer.write(encode_frame(FILE_CHUNK))
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+            except asyncio.TimeoutError:
+                self.metrics.slow_disconnects += 1
+                server_logger.warning(
+                    'Close slow connection %s while sending a file',
+                    self.address)
+                self.close()
+            except ConnectionError as er:
+                server_logger.warning(
+                    'Unable to send a file to %s: %s', self.address, er)
+                self.close()
+
+    def close(self) -> None:
+        """Stop the writer task and close the socket"""
+        self._flushed.set()
+        self._task.cancel()
+        self._queue.clear()
+        self._queued_bytes = 0
+        self.writer.close()
+
+    def _is_full(self) -> bool:
+        if self._queued_bytes > self.max_bytes:
+            return True
+        return self.policy != SlowConsumerPolicy.COALESCE \
+            and len(self._queue) > self.max_messages
+
+    def _drop_oldest(self) -> None:
+        while len(self._queue) > 1 and self._is_full():
+            self._queued_bytes -= len(self._queue.popleft())
+            self.dropped += 1
+            self.metrics.dropped += 1
+
+    async def _run(self) -> None:
+        # ``wait_for`` swallows the cancellation from ``close`` if the
+        # drain completes at the same time, so check the writer as well
+        while not self.writer.is_closing():
+            await self._ready.wait()
+            self._ready.clear()
+            async with self._writing:
+                frames, self._queue = self._queue, deque()
+                self._queued_bytes = 0
+                if self.compressor is not None:
+                    frames = self.compressor.compress(frames)
+                self.writer.writelines(frames)
+                try:
+                    await asyncio.wait_for(self.writer.drain(), self.timeout)
+                except asyncio.TimeoutError:
+                    self.metrics.slow_disconnects += 1
+                    server_logger.warning(
+                        'Close slow connection %s', self.address)
+                    self.close()
+                    return
+                except ConnectionError as er:
+                    server_logger.warning(
+                        'Unable to deliver to %s: %s', self.address, er)
+                    self.close()
+                    return
+            if not self._queue:
+                self._flushed.set()
+
+
+class ConnectionRegistry:
+    """Connected clients indexed by connection and by username.
+
+    Every lookup, registration and removal is O(1). The usernames online
+    are kept in the order they joined, and the rendered list of them for
+    the status message is cached until somebody joins or leaves.
+    """
+
+    def __init__(self) -> None:
+        # dicts keep the insertion order and serve as ordered sets
+        self._sessions: dict[Connection, None] = dict()
+        self._users: dict[str, dict[Connection, None]] = dict()
+        self._online_text: str | None = None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, connection: Connection) -> bool:
+        return connection in self._sessions
+
+    @property
+    def online(self) -> list[str]:
+        """Usernames online in the order they joined"""
+        return list(self._users)
+
+    @property
+    def online_count(self) -> int:
+        return len(self._users)
+
+    @property
+    def online_text(self) -> str:
+        """Comma separated usernames online"""
+        if self._online_text is None:
+            self._online_text = ', '.join(self._users)
+        return self._online_text
+
+    def is_online(self, username: str) -> bool:
+        return username in self._users
+
+    def add(self, connection: Connection, username: str) -> bool:
+        """Register the user's connection, return True if the user was
+        offline before"""
+        if connection.username is not None and connection in self._sessions:
+            if connection.username == username:
+                return False
+            self.remove(connection)
+        connection.username = username
+        self._sessions[connection] = None
+        connections = self._users.get(username)
+        if connections is None:
+            self._users[username] = {connection: None}
+            self._online_text = None
+            return True
+        connections[connection] = None
+        return False
+
+    def remove(self, connection: Connection) -> str | None:
+        """Forget the connection, return the username if it was the last
+        connection of the user"""
+        if connection not in self._sessions:
+            return None
+        del self._sessions[connection]
+        username = connection.username
+        connections = self._users[username]
+        del connections[connection]
+        if connections:
+            return None
+        del self._users[username]
+        self._online_text = None
+        return username
+
+    def connections(self, username: str) -> Iterable[Connection]:
+        """Connections of the user"""
+        return self._users.get(username, {}).keys()
+
+    def all(self, exclude: Connection | None = None) -> Iterator[Connection]:
+        """Connections of all clients except ``exclude``"""
+        return (c for c in self._sessions if c is not exclude)
+
+
+def broadcast(connections: Iterable[Connection], payload: bytes,
+              message_id: int | None = None) -> None:
+    """Queue one pre-encoded payload on every connection"""
+    sent = 0
+    with fanout_seconds.time():
+        for connection in connections:
+            connection.send(payload, message_id)
+            sent += 1
+    fanout_frames.inc(sent)
@@ -0,0 +1,54 @@
+from config import settings
+from connection import Connection
+from storage import Storage, WriteQueue
+from structs import Write
+
+
+class CursorStore:
+    """Persisted id of the last message delivered to each user's device.
+
+    A connection keeps the id of the last chat message queued on it in
+    ``Connection.last_id``, or acknowledged by a client with acks in
+    ``Connection.acked_id``. Every message for a user is fanned out to all
+    of the user's connections, so each connected device moves its cursor
+    on its own; ``save`` persists it through the write queue. Unless
+    ``cached`` is false, ``get`` trusts the last cursor saved here instead
+    of reading it back from the storage.
+    """
+
+    def __init__(self, storage: Storage, write_queue: WriteQueue,
+                 cached: bool = True) -> None:
+        self.storage = storage
+        self.write_queue = write_queue
+        self.cached = cached
+        self._saved: dict[tuple[str, str], int] = dict()
+
+    async def get(self, username: str, device: str = '') -> int | None:
+        """Last delivered message id, None for a device seen the first time"""
+        key = (username, device)
+        if self.cached and key in self._saved:
+            return self._saved[key]
+        if not self.cached:
+            # the cursor may still be on its way to the storage
+            await self.write_queue.flush()
+        return await self.storage.get_cursor(*key)
+
+    def save(self, connection: Connection) -> None:
+        """Queue the connection's cursor for writing if it moved"""
+        # a device without any message keeps getting the recent history
+        if connection.username is None or not connection.delivered_id:
+            return
+        key = (connection.username, connection.device)
+        last_id = connection.delivered_id
+        if self._saved.get(key) == last_id:
+            return
+        self._saved.pop(key, None)
+        self._saved[key] = last_id
+        if len(self._saved) > settings.USER_CACHE_SIZE:
+            # forget the oldest saved cursor, the storage keeps it
+            del self._saved[next(iter(self._saved))]
+        self.write_queue.put(Write.CURSOR, (*key, last_id))
+
+    def save_all(self, connections: list[Connection]) -> None:
+        for connection in connections:
+            self.save(connection)
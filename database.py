@@ -0,0 +1,379 @@
+import asyncio
+import sqlite3
+import time
+import aiosqlite
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import groupby
+from typing import Any, AsyncIterator
+
+from config import settings
+from metrics import (
+    db_errors, db_seconds, db_wait_seconds, write_batch_seconds, writes
+)
+from sql_queries import (
+    delete_expired_messages_query, delete_scheduled_query, get_cursor_query,
+    get_last_general_query, get_last_message_id_query,
+    get_last_private_query, get_last_scheduled_id_query, get_message_query,
+    get_oldest_message_query, get_rate_limits_query, get_scheduled_query,
+    get_unread_messages_query, get_user_query, store_cursor_query,
+    store_message_query, store_rate_limit_query, store_scheduled_query,
+    store_user_query
+)
+from structs import Message, Write
+from utils import server_logger
+
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    f'PRAGMA cache_size = -{settings.DB_CACHE_SIZE_KB}',
+    f'PRAGMA busy_timeout = {settings.DB_BUSY_TIMEOUT_MS}',
+)
+
+WRITE_QUERIES: dict[str, str] = {
+    Write.MESSAGE: store_message_query,
+    Write.USER: store_user_query,
+    Write.CURSOR: store_cursor_query,
+    Write.RATE_LIMIT: store_rate_limit_query,
+    Write.SCHEDULE: store_scheduled_query,
+    Write.UNSCHEDULE: delete_scheduled_query,
+}
+
+
+class StorageError(Exception):
+    """A storage backend failed to read or write"""
+
+
+class ConnectionPool:
+    """Long-lived aiosqlite connections bound to a single database.
+
+    Every connection keeps its own sqlite3 statement cache, so the queries
+    from ``sql_queries`` are prepared once per connection and reused on
+    subsequent calls.
+    """
+
+    def __init__(self, db_name: str = settings.DB_NAME,
+                 size: int = settings.DB_POOL_SIZE) -> None:
+        self.db_name = db_name
+        self.size = size
+        self._connections: list[aiosqlite.Connection] = list()
+        self._idle: asyncio.Queue[aiosqlite.Connection] | None = None
+
+    async def open(self) -> None:
+        """Open all connections of the pool and apply the pragmas"""
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            db = await aiosqlite.connect(
+                self.db_name, cached_statements=settings.DB_CACHED_STATEMENTS
+            )
+            for pragma in PRAGMAS:
+                await db.execute(pragma)
+            self._connections.append(db)
+            self._idle.put_nowait(db)
+        server_logger.info(
+            'Open DB pool for %s (%s connections)', self.db_name, self.size)
+
+    async def close(self) -> None:
+        """Close all connections of the pool"""
+        for db in self._connections:
+            try:
+                await db.close()
+            except aiosqlite.Error as er:
+                server_logger.error('DB error - closing connection: %s', er)
+        self._connections.clear()
+        self._idle = None
+        server_logger.info('Close DB pool for %s', self.db_name)
+
+    @asynccontextmanager
+    async def acquire(self, operation: str = 'query'
+                      ) -> AsyncIterator[aiosqlite.Connection]:
+        """Take a connection from the pool for the duration of the block,
+        the time it is held is reported under ``operation``"""
+        idle = self._idle
+        if idle is None:
+            raise aiosqlite.OperationalError('Connection pool is not open')
+        started = time.perf_counter()
+        db = await idle.get()
+        acquired = time.perf_counter()
+        db_wait_seconds.observe(acquired - started)
+        try:
+            yield db
+        except aiosqlite.Error:
+            db_errors.labels(operation).inc()
+            await db.rollback()
+            raise
+        finally:
+            idle.put_nowait(db)
+            db_seconds.labels(operation).observe(
+                time.perf_counter() - acquired)
+
+
+class WriteBehindQueue:
+    """Group-commit stage for writes that are not needed on the request path.
+
+    Handlers enqueue ``(query, params)`` pairs with ``put``, a single writer
+    task collects them and flushes the batch in one transaction with
+    ``executemany`` on a dedicated connection living in ``executor``.
+    A flush happens when ``batch_size`` writes are pending or when the
+    oldest pending write is ``flush_interval`` seconds old.
+
+    A batch that fails stays in front of the later writes and is written
+    again with them, ``retries`` times at most before it is dropped.
+    """
+    # failures of a batch that are retried and raised as StorageError
+    errors: tuple[type[Exception], ...] = (sqlite3.DatabaseError,)
+
+    def __init__(self, db_name: str, executor: ThreadPoolExecutor,
+                 batch_size: int = settings.WRITE_BATCH_SIZE,
+                 flush_interval: float = settings.WRITE_FLUSH_INTERVAL,
+                 retries: int = settings.WRITE_RETRIES) -> None:
+        self.db_name = db_name
+        self.executor = executor
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        # held while a batch is written, so ``flush`` also waits for the
+        # batch the writer task has taken
+        self.writing = asyncio.Lock()
+        self._pending: list[tuple[str, tuple[Any, ...]]] = list()
+        # failed attempts of the writes at the head of ``_pending``
+        self._failures = 0
+        self._has_pending = asyncio.Event()
+        self._is_full = asyncio.Event()
+        self._connection: sqlite3.Connection | None = None
+        self._task: asyncio.Task | None = None
+
+    def put(self, query: str, params: tuple[Any, ...]) -> None:
+        """Schedule a write for the next flush"""
+        self._pending.append((query, params))
+        self._has_pending.set()
+        if len(self._pending) >= self.batch_size:
+            self._is_full.set()
+
+    async def start(self) -> None:
+        """Open the writer connection and start the writer task"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._connect)
+        self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the writer task, flush what is left and close the connection"""
+        if self._task is not None:
+            # not while it writes, the result of the batch would be lost
+            async with self.writing:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+            self._task = None
+        try:
+            await self.flush()
+        except StorageError:
+            # logged by ``flush``
+            pass
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._close)
+
+    async def flush(self) -> None:
+        """Write all pending queries in one transaction once the batch
+        being written is done, StorageError if the write failed"""
+        async with self.writing:
+            batch = self.take()
+            if not batch:
+                return
+            groups = [
+                (query, [params for _, params in items])
+                for query, items in groupby(batch, key=lambda item: item[0])
+            ]
+            loop = asyncio.get_running_loop()
+            try:
+                with write_batch_seconds.time():
+                    await loop.run_in_executor(
+                        self.executor, self._write, groups)
+            except self.errors as er:
+                db_errors.labels('write_batch').inc()
+                self._retry(batch, er)
+                raise StorageError(str(er)) from er
+            self._failures = 0
+            writes.inc(len(batch))
+
+    def take(self) -> list[tuple[str, tuple[Any, ...]]]:
+        """Remove the pending writes from the queue and return them"""
+        batch, self._pending = self._pending, list()
+        self._has_pending.clear()
+        self._is_full.clear()
+        return batch
+
+    def _retry(self, batch: list[tuple[str, tuple[Any, ...]]],
+               error: Exception) -> None:
+        """Put a failed batch back in front of the later writes"""
+        self._failures += 1
+        if self._failures > self.retries:
+            self._failures = 0
+            server_logger.error(
+                'DB error - dropping %s writes after %s attempts: %s',
+                len(batch), self.retries + 1, error)
+            return
+        server_logger.error('DB error - flushing %s writes, attempt %s: %s',
+                            len(batch), self._failures, error)
+        self._pending[:0] = batch
+        self._has_pending.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(
+                    self._is_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except StorageError:
+                # give the database a moment before the next attempt
+                await asyncio.sleep(self.flush_interval)
+
+    def _connect(self) -> None:
+        self._connection = sqlite3.connect(
+            self.db_name, cached_statements=settings.DB_CACHED_STATEMENTS)
+        for pragma in PRAGMAS:
+            self._connection.execute(pragma)
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _write(self, groups: list[tuple[str, list[tuple[Any, ...]]]]) -> None:
+        if self._connection is None:
+            raise sqlite3.OperationalError('Writer connection is not open')
+        with self._connection:
+            for query, params in groups:
+                self._connection.executemany(query, params)
+
+
+class SqliteStorage:
+    """Messages, users, read cursors and rate limits in SQLite.
+
+    Reads run on the connection pool, writes are queued with ``put`` and
+    written by the write-behind queue. A worker of a multi-process server
+    reads the database the hub writes to, so it has no queue of its own.
+    """
+
+    def __init__(self, db_name: str = settings.DB_NAME,
+                 writer: bool = True) -> None:
+        self.db_name = db_name
+        self.pool = ConnectionPool(db_name)
+        self.write_queue = WriteBehindQueue(db_name, ThreadPoolExecutor(1)) \
+            if writer else None
+
+    async def open(self) -> None:
+        await self.pool.open()
+        if self.write_queue is not None:
+            await self.write_queue.start()
+
+    async def close(self) -> None:
+        """Write what is pending and close the database"""
+        if self.write_queue is not None:
+            await self.write_queue.stop()
+        await self.pool.close()
+
+    def put(self, operation: str, params: tuple[Any, ...]) -> None:
+        """Queue a write of the kind ``operation``"""
+        self.write_queue.put(WRITE_QUERIES[operation], params)
+
+    async def flush(self) -> None:
+        if self.write_queue is not None:
+            await self.write_queue.flush()
+
+    async def get_user(self, username: str) -> tuple[str, int] | None:
+        rows = await self._fetch('get_user', get_user_query, (username,))
+        return rows[0] if rows else None
+
+    async def get_cursor(self, username: str, device: str) -> int | None:
+        rows = await self._fetch(
+            'get_cursor', get_cursor_query, (username, device))
+        return rows[0][0] if rows else None
+
+    async def get_last_message_id(self) -> int:
+        rows = await self._fetch(
+            'last_message_id', get_last_message_id_query, ())
+        return rows[0][0]
+
+    async def get_last_messages(self, general_limit: int, private_limit: int
+                                ) -> tuple[list[Message], list[Message]]:
+        """The latest general and private messages, newest first"""
+        async with self._acquire('prime_history') as db:
+            async with db.execute(
+                    get_last_general_query, (general_limit,)) as cursor:
+                general = await cursor.fetchall()
+            async with db.execute(
+                    get_last_private_query, (private_limit,)) as cursor:
+                private = await cursor.fetchall()
+        return ([Message.create(*row) for row in general],
+                [Message.create(*row) for row in private])
+
+    async def get_history(self, user: str, reg_date: int) -> list[Message]:
+        """Messages available to the user, see ``get_message_query``"""
+        rows = await self._fetch('get_history', get_message_query,
+                                 {'user': user, 'reg_date': reg_date})
+        return [Message.create(*row) for row in rows]
+
+    async def get_unread(self, user: str, last_id: int, until_id: int,
+                         page_size: int) -> list[Message]:
+        """Up to ``page_size`` of the user's messages after ``last_id``"""
+        rows = await self._fetch('get_unread', get_unread_messages_query, {
+            'user': user, 'last_id': last_id, 'until_id': until_id,
+            'page_size': page_size
+        })
+        return [Message.create(*row) for row in rows]
+
+    async def get_rate_limits(self, limit: int
+                              ) -> list[tuple[str, float, float]]:
+        """Saved token buckets, the most recently updated first"""
+        return await self._fetch(
+            'load_rate_limits', get_rate_limits_query, (limit,))
+
+    async def delete_expired(self, cutoff: int, limit: int) -> int:
+        """Delete up to ``limit`` of the oldest messages sent before
+        ``cutoff``, return how many were deleted"""
+        async with self._acquire('expire') as db:
+            cursor = await db.execute(
+                delete_expired_messages_query, (cutoff, limit))
+            await db.commit()
+        return cursor.rowcount
+
+    async def get_oldest_send_date(self) -> int | None:
+        rows = await self._fetch(
+            'oldest_message', get_oldest_message_query, ())
+        return rows[0][0] if rows else None
+
+    async def get_scheduled(self) -> list[tuple[int, str, str, str, int]]:
+        """Pending scheduled messages, as ``Write.SCHEDULE`` params"""
+        return await self._fetch('load_scheduled', get_scheduled_query, ())
+
+    async def get_last_scheduled_id(self) -> int:
+        rows = await self._fetch(
+            'last_scheduled_id', get_last_scheduled_id_query, ())
+        return rows[0][0]
+
+    async def _fetch(self, operation: str, query: str,
+                     params: tuple[Any, ...] | dict[str, Any]) -> list[Any]:
+        async with self._acquire(operation) as db:
+            async with db.execute(query, params) as cursor:
+                return await cursor.fetchall()
+
+    @asynccontextmanager
+    async def _acquire(self, operation: str
+                       ) -> AsyncIterator[aiosqlite.Connection]:
+        try:
+            async with self.pool.acquire(operation) as db:
+                yield db
+        except aiosqlite.DatabaseError as er:
+            raise StorageError(str(er)) from er
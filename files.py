@@ -0,0 +1,180 @@
+"""Files sent to the chat, spooled to a directory on disk.
+
+A client uploads a file with a FILE request followed by ``FILE_CHUNK``
+frames of at most ``FILE_CHUNK_SIZE`` bytes and an empty one at the end.
+Every chunk is written to a part file before the next frame is read, so
+a fast sender waits for the disk and the file is never held in memory.
+A finished file gets a random id, and the data and a small JSON file
+with its name, size, sender and receiver are kept under that id, so
+every worker of the server can send it. Files go away together with the
+messages announcing them.
+"""
+import asyncio
+import json
+import os
+import re
+import secrets
+
+from typing import BinaryIO
+
+from config import settings
+from metrics import file_bytes
+
+
+FILE_ID = re.compile(r'[0-9a-f]{16}')
+PART = '.part'
+INFO = '.json'
+
+
+def remove(*paths: str) -> None:
+    """Delete the files that are still there"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def modified(entry: os.DirEntry) -> int:
+    """Microseconds since the epoch, 0 for a file deleted meanwhile"""
+    try:
+        return entry.stat().st_mtime_ns // 1000
+    except FileNotFoundError:
+        return 0
+
+
+class FileInfo:
+    """A stored file and who may download it"""
+    __slots__ = ('id', 'name', 'size', 'sender', 'receiver')
+
+    def __init__(self, file_id: str, name: str, size: int, sender: str,
+                 receiver: str) -> None:
+        self.id = file_id
+        self.name = name
+        self.size = size
+        self.sender = sender
+        self.receiver = receiver
+
+    def allows(self, username: str) -> bool:
+        return self.receiver in ('all', username) or self.sender == username
+
+
+class Upload:
+    """A file being received from a client"""
+
+    def __init__(self, store: 'FileStore', sender: str, receiver: str,
+                 name: str) -> None:
+        self.store = store
+        self.info = FileInfo(
+            secrets.token_hex(8), name, 0, sender, receiver)
+        self.path = store.path(self.info.id)
+        self.error = ''
+        self._file: BinaryIO | None = None
+
+    async def open(self) -> None:
+        """Create the part file the chunks are written to"""
+        self._file = await asyncio.get_running_loop().run_in_executor(
+            None, open, self.path + PART, 'wb')
+
+    async def write(self, chunk: memoryview) -> None:
+        """Append a chunk, or drop it once the upload has failed"""
+        if self._file is None:
+            return
+        if self.info.size + len(chunk) > self.store.max_size:
+            self.abort(f'File "{self.info.name}" is larger than '
+                       f'{self.store.max_size} bytes')
+            return
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._file.write, chunk)
+        self.info.size += len(chunk)
+        file_bytes.labels('received').inc(len(chunk))
+
+    async def finish(self) -> FileInfo | None:
+        """Store the file received, None if the upload failed"""
+        if self._file is None:
+            return None
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._finish)
+        return self.info
+
+    def abort(self, error: str = 'Upload cancelled') -> None:
+        """Drop the data received so far"""
+        self.error = error
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        remove(self.path + PART)
+
+    def _finish(self) -> None:
+        self._file.close()
+        self._file = None
+        info = self.info
+        with open(self.path + INFO, 'w') as f:
+            json.dump({'name': info.name, 'size': info.size,
+                       'sender': info.sender, 'receiver': info.receiver}, f)
+        os.replace(self.path + PART, self.path)
+
+
+class FileStore:
+    """The directory of the files sent to the chat"""
+
+    def __init__(self, directory: str = settings.FILES_PATH,
+                 max_size: int = settings.MAX_FILE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, file_id: str) -> str:
+        return os.path.join(self.directory, file_id)
+
+    async def upload(self, sender: str, receiver: str,
+                     name: str) -> Upload:
+        """Start receiving a file, ValueError for an invalid name"""
+        name = os.path.basename(name.strip())
+        if not name or name in ('.', '..'):
+            raise ValueError('File name is required')
+        upload = Upload(self, sender, receiver, name)
+        await upload.open()
+        return upload
+
+    async def get(self, file_id: str) -> FileInfo | None:
+        """A stored file by its id, None if there is no such file"""
+        if FILE_ID.fullmatch(file_id) is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._get, file_id)
+
+    async def expire(self, cutoff: int) -> int:
+        """Delete the files stored before ``cutoff``, microseconds since
+        the epoch, return how many were deleted"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._expire, cutoff)
+
+    def _get(self, file_id: str) -> FileInfo | None:
+        try:
+            with open(self.path(file_id) + INFO) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return FileInfo(file_id, info['name'], info['size'], info['sender'],
+                        info['receiver'])
+
+    def _expire(self, cutoff: int) -> int:
+        deleted = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith(PART):
+                    # left by a server stopped during an upload
+                    paths = (entry.path,)
+                elif name.endswith(INFO) and FILE_ID.fullmatch(name[:-5]):
+                    # the data first, so a file is never without its info
+                    paths = (entry.path[:-5], entry.path)
+                else:
+                    # a data file goes with its info
+                    continue
+                if modified(entry) < cutoff:
+                    remove(*paths)
+                    deleted += name.endswith(INFO)
+        return deleted
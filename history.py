@@ -0,0 +1,182 @@
+import asyncio
+
+from collections import OrderedDict, deque
+from heapq import merge
+from operator import attrgetter
+
+from config import settings
+from storage import Storage
+from structs import Message
+
+
+# ids grow with time, so messages sort by id
+by_id = attrgetter('id')
+
+
+class HistoryBuffer:
+    """Recent messages kept in memory with their frames pre-encoded.
+
+    The general chat keeps the last ``general_size`` messages. Private
+    messages are kept per user, up to ``private_size`` per user for at
+    most ``private_users`` users. ``replay`` answers from memory while the
+    buffers hold everything the client is owed and returns None when the
+    caller has to fall back to the DB. ``wait`` lets a caller sleep until
+    the next message.
+    """
+
+    def __init__(self, general_size: int = settings.LIMIT_SHOW_MESSAGES,
+                 private_size: int = settings.HISTORY_PRIVATE_SIZE,
+                 private_users: int = settings.HISTORY_PRIVATE_USERS,
+                 earlier_size: int = settings.LIMIT_SHOW_MESSAGES
+                 ) -> None:
+        self.private_size = private_size
+        self.private_users = private_users
+        # messages sent before the registration that a new user gets
+        self.earlier_size = earlier_size
+        self.general: deque[Message] = deque(maxlen=general_size)
+        self.private: OrderedDict[str, deque[Message]] = OrderedDict()
+        self.ready = False
+        # highest id of a general message that no longer fits, 0 if none
+        self._general_dropped = 0
+        # the same per user whose private buffer lost messages
+        self._private_dropped: dict[str, int] = dict()
+        # users absent from ``private`` may still have private messages
+        self._private_evicted = False
+        self._waiters: set[asyncio.Future] = set()
+
+    def add(self, message: Message) -> None:
+        """Remember a message that has just been sent"""
+        if self._waiters:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._waiters.clear()
+        if message.receiver == 'all':
+            if len(self.general) == self.general.maxlen:
+                self._general_dropped = self.general[0].id
+            self.general.append(message)
+            return
+        for username in {message.sender, message.receiver}:
+            self._add_private(username, message)
+
+    def replay(self, username: str,
+               reg_date: int) -> list[Message] | None:
+        """Messages owed to the user on HELLO, None if the DB is needed.
+
+        The same messages as ``get_message_query``: every message since the
+        registration, the user's own ones and the last ``earlier_size``
+        messages before the registration. Once the general buffer is full
+        that answers from memory only for a user who has missed nothing
+        since the registration, such as a new one.
+        """
+        if not self.ready:
+            return None
+        if self._general_dropped and \
+                (not self.general or self.general[0].timestamp >= reg_date):
+            return None
+        private = self.private.get(username)
+        if private is None:
+            if self._private_evicted:
+                return None
+            private = deque()
+        elif username in self._private_dropped:
+            return None
+        else:
+            self.private.move_to_end(username)
+        messages = []
+        earlier = []
+        for message in merge(self.general, private, key=by_id):
+            if message.sender == username or message.timestamp >= reg_date:
+                messages.append(message)
+            else:
+                earlier.append(message)
+        earlier = earlier[-self.earlier_size:] if self.earlier_size else []
+        # a general message cut off may be newer than the earliest of them
+        if self._general_dropped and self.earlier_size and (
+                len(earlier) < self.earlier_size
+                or earlier[0].id < self.general[0].id):
+            return None
+        return list(merge(earlier, messages, key=by_id))
+
+    def replay_since(self, username: str,
+                     last_id: int) -> list[Message] | None:
+        """Messages for the user newer than ``last_id``, None if the
+        buffers may have lost some of them and the DB is needed"""
+        if not self.ready:
+            return None
+        if self._general_dropped > last_id:
+            return None
+        private = self.private.get(username)
+        if private is None:
+            if self._private_evicted:
+                return None
+            private = deque()
+        elif self._private_dropped.get(username, 0) > last_id:
+            return None
+        return [
+            message for message in merge(self.general, private, key=by_id)
+            if message.id > last_id
+        ]
+
+    async def wait(self, timeout: float) -> None:
+        """Wait until a message is added or ``timeout`` seconds pass"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=timeout)
+        finally:
+            self._waiters.discard(waiter)
+            waiter.cancel()
+
+    def expire(self, deadline: int) -> None:
+        """Forget messages older than ``deadline``"""
+        # once something expired, whatever was cut off before it expired too
+        while self.general and self.general[0].timestamp < deadline:
+            self.general.popleft()
+            self._general_dropped = 0
+        for username, messages in list(self.private.items()):
+            while messages and messages[0].timestamp < deadline:
+                messages.popleft()
+                self._private_dropped.pop(username, None)
+            if not messages:
+                del self.private[username]
+
+    async def prime(self, storage: Storage) -> None:
+        """Fill the buffers with the latest messages from the storage"""
+        private_limit = self.private_size * self.private_users
+        general, private = await storage.get_last_messages(
+            self.general.maxlen, private_limit + 1)
+
+        self.general.clear()
+        self.private.clear()
+        self._private_dropped.clear()
+        # older messages may exist before the oldest one loaded
+        self._general_dropped = general[-1].id - 1 \
+            if general and len(general) >= self.general.maxlen else 0
+        self._private_evicted = len(private) > private_limit
+        for message in (*reversed(general),
+                        *reversed(private[:private_limit])):
+            self.add(message)
+        if self._private_evicted:
+            # the users loaded may have private messages before the oldest
+            # one loaded as well
+            cutoff = private[private_limit - 1].id - 1
+            for username in self.private:
+                self._private_dropped[username] = max(
+                    self._private_dropped.get(username, 0), cutoff)
+        self.ready = True
+
+    def _add_private(self, username: str, message: Message) -> None:
+        messages = self.private.get(username)
+        if messages is None:
+            messages = self.private[username] = \
+                deque(maxlen=self.private_size)
+            while len(self.private) > self.private_users:
+                evicted, _ = self.private.popitem(last=False)
+                self._private_dropped.pop(evicted, None)
+                self._private_evicted = True
+        else:
+            self.private.move_to_end(username)
+        if len(messages) == messages.maxlen:
+            self._private_dropped[username] = messages[0].id
+        messages.append(message)
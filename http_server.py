@@ -0,0 +1,447 @@
+"""HTTP/1.1 front end of the chat for tools that do not speak the frame
+protocol.
+
+* ``POST /requests`` - the body is a request as JSON, the same as the
+  first codec of the frame protocol. It goes through
+  ``Server.process_data`` with a stand-in for a connection, and the answer
+  is the replies the server sent to it, with the id given to a chat
+  message;
+* ``GET /messages?username=&after=&timeout=`` - long poll: the messages
+  for the user after the id ``after``, waiting up to ``timeout`` seconds
+  for one to come;
+* ``GET /stream?username=&device=`` - the session of a client: the user
+  joins the chat like with HELLO, and every frame the server sends goes
+  out as an event of a ``text/event-stream`` response in chunked
+  transfer encoding until the client goes away.
+
+Connections are kept alive and may pipeline requests; every request read
+at once is answered in order with one write. The parser works on one
+buffer per connection: the search for the end of the headers resumes
+where the previous read stopped, and the consumed bytes are cut off once
+per read.
+"""
+import asyncio
+import json
+import math
+import re
+
+from asyncio.streams import StreamReader, StreamWriter
+from http import HTTPStatus
+from typing import Any, Iterable
+from urllib.parse import parse_qs, urlsplit
+
+from codec import get_codec
+from config import settings
+from connection import Connection
+from database import StorageError
+from metrics import http_requests
+from protocol import ACK, NACK, split_frames
+from structs import Codec, Message, RequestData, Target
+from utils import server_logger
+
+
+READ_SIZE = 64 * 1024
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+# the paths answered with a JSON body and their methods, ``/stream``
+# takes the connection over
+ROUTES = {'/requests': 'POST', '/messages': 'GET'}
+# requests that need a session of the frame protocol
+SESSION_TARGETS = frozenset(
+    (Target.HELLO, Target.ACK, Target.FILE, Target.DOWNLOAD))
+# every line break of an event's data starts a new ``data:`` field
+LINE_BREAK = re.compile(rb'\r\n|\r|\n')
+
+
+class HttpError(ValueError):
+    """A request that can not be answered, with the status to answer"""
+
+    def __init__(self, status: HTTPStatus, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class HttpRequest:
+    __slots__ = ('method', 'path', 'query', 'version', 'headers', 'body')
+
+    def __init__(self, method: str, target: str, version: str,
+                 headers: dict[str, str], body: bytes) -> None:
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def param(self, name: str, default: str = '') -> str:
+        return self.query.get(name, (default,))[0]
+
+
+class RequestParser:
+    """Requests of one connection from the bytes read, as they complete"""
+
+    def __init__(self, max_header_size: int = settings.HTTP_MAX_HEADER_SIZE,
+                 max_body_size: int = settings.MAX_FRAME_SIZE) -> None:
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        # set when a client waits for 100 Continue before the body
+        self.continue_expected = False
+        self._buffer = bytearray()
+        # where the request being parsed starts and where the search for
+        # the end of its headers resumes
+        self._start = 0
+        self._scanned = 0
+        # the headers of a request waiting for its body
+        self._head: tuple[str, str, str, dict[str, str], int] | None = None
+        self._body_start = 0
+
+    def feed(self, data: bytes) -> list[HttpRequest]:
+        """Requests completed by ``data``, HttpError for an invalid one"""
+        buffer = self._buffer
+        buffer += data
+        requests = []
+        while True:
+            if self._head is None:
+                end = buffer.find(b'\r\n\r\n', self._scanned)
+                if end < 0:
+                    if len(buffer) - self._start > self.max_header_size:
+                        raise HttpError(
+                            HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+                            'Request headers are too large')
+                    # the end may be split between reads
+                    self._scanned = max(self._start, len(buffer) - 3)
+                    break
+                self._head = self._parse_head(buffer[self._start:end])
+                self._body_start = end + 4
+            method, target, version, headers, length = self._head
+            body_end = self._body_start + length
+            if len(buffer) < body_end:
+                self.continue_expected = \
+                    headers.get('expect', '').lower() == '100-continue' \
+                    and len(buffer) == self._body_start
+                break
+            requests.append(HttpRequest(
+                method, target, version, headers,
+                bytes(buffer[self._body_start:body_end])))
+            self._head = None
+            self._start = self._scanned = body_end
+        if self._start:
+            del buffer[:self._start]
+            self._scanned -= self._start
+            self._body_start -= self._start
+            self._start = 0
+        return requests
+
+    def _parse_head(self, head: bytearray
+                    ) -> tuple[str, str, str, dict[str, str], int]:
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            'Invalid request line') from None
+        if not version.startswith('HTTP/1.'):
+            raise HttpError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED,
+                            f'{version} is not supported')
+        headers = dict()
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise HttpError(HTTPStatus.BAD_REQUEST,
+                                f'Invalid header "{line}"')
+            headers[name.strip().lower()] = value.strip()
+        if 'transfer-encoding' in headers:
+            raise HttpError(HTTPStatus.NOT_IMPLEMENTED,
+                            'Request bodies need a Content-Length')
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            'Invalid Content-Length') from None
+        if not 0 <= length <= self.max_body_size:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            f'Request bodies are limited to '
+                            f'{self.max_body_size} bytes')
+        return method, target, version, headers, length
+
+
+def render_response(status: HTTPStatus, body: bytes,
+                    content_type: str = 'application/json',
+                    keep_alive: bool = True) -> bytes:
+    http_requests.labels(str(status.value)).inc()
+    connection = '' if keep_alive else 'Connection: close\r\n'
+    return (
+        f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Length: {len(body)}\r\n{connection}\r\n'
+    ).encode() + body
+
+
+def render_json(data: Any) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+def frame_texts(data: Iterable[bytes]) -> list[str]:
+    """Texts of the frames the server wrote"""
+    return [frame.decode() for chunk in data for frame in split_frames(chunk)]
+
+
+class Reply:
+    """Stands for the connection of a request that lives for one HTTP
+    request, and keeps the frames the server sends to it"""
+    device = ''
+    is_closing = False
+
+    def __init__(self, username: str, address: tuple[str, int]) -> None:
+        self.username = username
+        self.address = address
+        # the id of a chat message comes back in an ack
+        self.acks = True
+        self.requests = 0
+        self.last_id = 0
+        self.frames: list[bytes] = []
+        self.answered = asyncio.Event()
+
+    def send(self, payload: bytes, message_id: int | None = None,
+             replay: bool = False) -> bool:
+        self.frames.append(payload)
+        self.answered.set()
+        return True
+
+    def answer(self) -> dict[str, Any]:
+        """The texts the server sent, and the id it gave a chat message
+        instead of its ack"""
+        answer = {'replies': []}
+        for text in frame_texts(self.frames):
+            if text[:1] == ACK.decode():
+                answer['id'] = int(text[1:].split()[1])
+            elif text[:1] == NACK.decode():
+                answer['replies'].append(text[1:].split(' ', 1)[1])
+            else:
+                answer['replies'].append(text)
+        return answer
+
+
+class EventStreamWriter:
+    """Writes the frames of a session as server-sent events, one chunk of
+    the response for every write of the connection"""
+
+    def __init__(self, writer: StreamWriter) -> None:
+        self.writer = writer
+
+    def get_extra_info(self, name: str) -> Any:
+        return self.writer.get_extra_info(name)
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    def writelines(self, frames: Iterable[bytes]) -> None:
+        events = b''.join(
+            b'data: ' + LINE_BREAK.sub(b'\ndata: ', frame) + b'\n\n'
+            for chunk in frames for frame in split_frames(chunk))
+        self.writer.write(b'%x\r\n%b\r\n' % (len(events), events))
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class HttpServer:
+    """Answers HTTP requests with the handlers of a chat server"""
+
+    def __init__(self, server: Any) -> None:
+        self.server = server
+        self.codec = get_codec(Codec.JSON)
+
+    async def serve(self, host: str, port: int,
+                    reuse_port: bool = False) -> None:
+        """Accept HTTP connections until cancelled"""
+        try:
+            srv = await asyncio.start_server(
+                self.client_connected, host, port, reuse_port=reuse_port)
+        except OSError as er:
+            server_logger.error('Unable to serve HTTP: %s', er)
+            return
+        server_logger.info('Serve HTTP on %s:%s', host, port)
+        async with srv:
+            await srv.serve_forever()
+
+    async def client_connected(
+            self, reader: StreamReader, writer: StreamWriter) -> None:
+        """Answer the requests of a connection until it is closed"""
+        address = writer.get_extra_info('peername')
+        parser = RequestParser()
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                        reader.read(READ_SIZE), settings.HTTP_KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    break
+                keep_alive = await self.answer(
+                    parser, data, reader, writer, address)
+                if writer.is_closing():
+                    break
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError as er:
+            server_logger.warning('HTTP connection %s failed: %s',
+                                  address, er)
+        finally:
+            writer.close()
+
+    async def answer(self, parser: RequestParser, data: bytes,
+                     reader: StreamReader, writer: StreamWriter,
+                     address: tuple[str, int]) -> bool:
+        """Answer the requests completed by ``data`` in order, False if
+        the connection is to be closed"""
+        try:
+            requests = parser.feed(data)
+        except HttpError as er:
+            writer.write(render_response(
+                er.status, render_json({'error': str(er)}), keep_alive=False))
+            return False
+        if parser.continue_expected:
+            parser.continue_expected = False
+            writer.write(CONTINUE)
+        for request in requests:
+            if request.method == 'GET' and request.path == '/stream':
+                # the rest of the connection belongs to the stream
+                await writer.drain()
+                await self.stream(request, reader, writer, address)
+                return False
+            status, body = await self.respond(request, address)
+            writer.write(render_response(
+                status, render_json(body), keep_alive=request.keep_alive))
+            if not request.keep_alive:
+                return False
+        return True
+
+    async def respond(self, request: HttpRequest, address: tuple[str, int]
+                      ) -> tuple[HTTPStatus, Any]:
+        """Status and JSON body of the answer"""
+        if request.path not in ROUTES:
+            return HTTPStatus.NOT_FOUND, {'error': 'Not found'}
+        if request.method != ROUTES[request.path]:
+            return HTTPStatus.METHOD_NOT_ALLOWED, \
+                {'error': f'Use {ROUTES[request.path]}'}
+        try:
+            if request.path == '/requests':
+                return await self.send_request(request, address)
+            return await self.poll(request)
+        except HttpError as er:
+            return er.status, {'error': str(er)}
+
+    async def send_request(self, http_request: HttpRequest,
+                           address: tuple[str, int]
+                           ) -> tuple[HTTPStatus, Any]:
+        """Process a request of the frame protocol and return what the
+        server answered"""
+        try:
+            request = self.codec.decode(http_request.body)
+        except (ValueError, TypeError) as er:
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            f'Invalid request: {er}') from None
+        if not request.username:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Username is required')
+        if request.target in SESSION_TARGETS:
+            raise HttpError(
+                HTTPStatus.BAD_REQUEST,
+                f'"{request.target}" needs a connection of the chat protocol')
+        reply = Reply(request.username, address)
+        await self.server.process_data(request, reply, address)
+        if not reply.answered.is_set():
+            # every request gets a reply, through the hub on a worker
+            try:
+                await asyncio.wait_for(
+                    reply.answered.wait(), settings.WRITE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise HttpError(HTTPStatus.GATEWAY_TIMEOUT,
+                                'The server did not answer') from None
+        return HTTPStatus.OK, reply.answer()
+
+    async def poll(self, request: HttpRequest) -> tuple[HTTPStatus, Any]:
+        """Messages for the user after ``after``, waiting for them up to
+        ``timeout`` seconds"""
+        username = request.param('username')
+        if not username:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'Username is required')
+        try:
+            after = int(request.param('after', '0'))
+            timeout = float(request.param('timeout', '0'))
+            # min() would let nan through
+            if not math.isfinite(timeout) or timeout < 0:
+                raise ValueError(timeout)
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            'Invalid "after" or "timeout"') from None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(timeout, settings.HTTP_POLL_TIMEOUT)
+        while True:
+            messages = await self.unread(username, after)
+            remaining = deadline - loop.time()
+            if messages or remaining <= 0:
+                break
+            await self.server.history.wait(remaining)
+        return HTTPStatus.OK, {
+            'last_id': messages[-1].id if messages else after,
+            'messages': frame_texts(m.payload for m in messages),
+        }
+
+    async def unread(self, username: str, after: int,
+                     page_size: int = settings.HISTORY_PAGE_SIZE
+                     ) -> list[Message]:
+        messages = self.server.history.replay_since(username, after)
+        if messages is not None:
+            return messages[:page_size]
+        try:
+            # the storage has to see the messages still in the write queue
+            await self.server.write_queue.flush()
+            return await self.server.storage.get_unread(
+                username, after, self.server.last_message_id, page_size)
+        except StorageError as er:
+            server_logger.error('DB error - get unread messages: %s', er)
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE,
+                            'Messages are not available') from None
+
+    async def stream(self, request: HttpRequest, reader: StreamReader,
+                     writer: StreamWriter, address: tuple[str, int]) -> None:
+        """Join the chat and send the session's frames as events until the
+        client goes away"""
+        username = request.param('username')
+        if not username:
+            writer.write(render_response(
+                HTTPStatus.BAD_REQUEST,
+                render_json({'error': 'Username is required'}),
+                keep_alive=False))
+            return
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+            b'Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n')
+        http_requests.labels(str(HTTPStatus.OK.value)).inc()
+        connection = Connection(
+            EventStreamWriter(writer), self.server.queue_metrics)
+        server_logger.info('Start streaming to %s', address)
+        try:
+            await self.server.process_data(RequestData(
+                username, Target.HELLO, device=request.param('device')),
+                connection, address)
+            # nothing more is read from the client, only its end
+            while await reader.read(READ_SIZE):
+                pass
+        finally:
+            server_logger.info('Stop streaming to %s', address)
+            self.server.cursors.save(connection)
+            self.server.disconnect_user(connection)
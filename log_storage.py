@@ -0,0 +1,457 @@
+"""Storage kept in memory and persisted as an append-only log.
+
+Every write is applied to the in-memory state at once and queued as a
+log record: the length and CRC32 of the payload followed by the pickled
+``(kind, params)`` pair. Records go through a write-behind queue, so a
+batch costs one ``write`` and one ``fsync``. Every ``snapshot_interval``
+seconds, if anything was written, a new log generation starts and a
+copy of the state is pickled into a snapshot in a thread; older files
+are removed once the snapshot is on disk. On start the newest snapshot
+is loaded and the logs of its generation and later are replayed; a
+record torn by a crash ends its log and is cut off.
+
+The directory holds ``snapshot-<generation>`` and ``log-<generation>``
+files and belongs to a single process, so the backend does not serve a
+multi-worker server. Messages stay in memory until retention deletes
+them.
+"""
+import asyncio
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge, nlargest
+from operator import attrgetter, itemgetter
+from typing import Any, Iterable, Iterator
+
+from config import settings
+from database import WriteBehindQueue
+from structs import Message, Write
+from utils import server_logger
+
+
+RECORD_HEADER = struct.Struct('!II')
+SNAPSHOT = 'snapshot'
+LOG = 'log'
+
+
+def encode_record(kind: str, params: tuple[Any, ...]) -> bytes:
+    payload = pickle.dumps((str(kind), params), pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(data: bytes
+                 ) -> Iterator[tuple[int, tuple[str, tuple[Any, ...]]]]:
+    """Records of a log with the offset after each one, up to the end of
+    the data or the first torn record"""
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        offset = start + length
+        yield offset, pickle.loads(payload)
+
+
+def ids_after(ids: list[int], last_id: int) -> Iterator[int]:
+    """Sorted ``ids`` greater than ``last_id``, without copying the list"""
+    return map(ids.__getitem__, range(bisect_right(ids, last_id), len(ids)))
+
+
+class MemoryState:
+    """The chat tables with the indexes their queries need.
+
+    Messages are kept in id order, and ids grow with the send dates, so
+    the oldest messages are always at the front of every index.
+    """
+
+    def __init__(self) -> None:
+        self.messages: dict[int, Message] = dict()
+        self.general: list[int] = list()
+        self.private: list[int] = list()
+        # ids of the private messages each user sent or received
+        self.by_user: dict[str, list[int]] = dict()
+        self.users: dict[str, int] = dict()
+        self.cursors: dict[tuple[str, str], int] = dict()
+        self.rate_limits: dict[str, tuple[float, float]] = dict()
+        self.scheduled: dict[int, tuple[int, str, str, str, int]] = dict()
+        # ids are not reused after the messages expire or are sent
+        self.last_message_id = 0
+        self.last_scheduled_id = 0
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        # snapshots saved before a table was added have no such attribute
+        self.__init__()
+        self.__dict__.update(state)
+
+    def copy(self) -> 'MemoryState':
+        """Copy of the indexes sharing the messages, which never change"""
+        state = MemoryState()
+        state.messages = self.messages.copy()
+        state.general = self.general.copy()
+        state.private = self.private.copy()
+        state.by_user = {u: ids.copy() for u, ids in self.by_user.items()}
+        state.users = self.users.copy()
+        state.cursors = self.cursors.copy()
+        state.rate_limits = self.rate_limits.copy()
+        state.scheduled = self.scheduled.copy()
+        state.last_message_id = self.last_message_id
+        state.last_scheduled_id = self.last_scheduled_id
+        return state
+
+    def apply(self, kind: str, params: tuple[Any, ...]) -> int:
+        """Apply a write, return the number of messages it deleted"""
+        match kind:
+            case Write.MESSAGE:
+                self.add_message(*params)
+            case Write.USER:
+                username, reg_date = params
+                self.users.setdefault(username, reg_date)
+            case Write.CURSOR:
+                username, device, last_id = params
+                self.cursors[(username, device)] = last_id
+            case Write.RATE_LIMIT:
+                username, *bucket = params
+                self.rate_limits[username] = tuple(bucket)
+            case Write.EXPIRE:
+                return self.expire(*params)
+            case Write.SCHEDULE:
+                self.scheduled[params[0]] = params
+                self.last_scheduled_id = max(
+                    self.last_scheduled_id, params[0])
+            case Write.UNSCHEDULE:
+                self.scheduled.pop(params[0], None)
+            case _:
+                raise ValueError(f'Unknown write "{kind}"')
+        return 0
+
+    def add_message(self, message_id: int, message: str, sender: str,
+                    receiver: str, send_date: int) -> None:
+        self.messages[message_id] = Message.create(
+            message_id, send_date, sender, receiver, message)
+        self.last_message_id = max(self.last_message_id, message_id)
+        if receiver == 'all':
+            self.general.append(message_id)
+            return
+        self.private.append(message_id)
+        for username in {sender, receiver}:
+            self.by_user.setdefault(username, []).append(message_id)
+
+    def expire(self, cutoff: int, limit: int) -> int:
+        """Delete up to ``limit`` of the oldest messages sent before
+        ``cutoff``"""
+        expired = []
+        for message in self.messages.values():
+            if len(expired) >= limit or message.timestamp >= cutoff:
+                break
+            expired.append(message)
+        if not expired:
+            return 0
+        general = 0
+        users = set()
+        for message in expired:
+            del self.messages[message.id]
+            if message.receiver == 'all':
+                general += 1
+            else:
+                users.update((message.sender, message.receiver))
+        del self.general[:general]
+        del self.private[:len(expired) - general]
+        last_id = expired[-1].id
+        for username in users:
+            ids = self.by_user[username]
+            del ids[:bisect_right(ids, last_id)]
+            if not ids:
+                del self.by_user[username]
+        return len(expired)
+
+    def newest(self, ids: list[int], limit: int) -> list[Message]:
+        return [self.messages[i] for i in ids[:-limit - 1:-1]]
+
+    def unread(self, user: str, last_id: int, until_id: int,
+               page_size: int) -> list[Message]:
+        messages = []
+        private = self.by_user.get(user, [])
+        for message_id in merge(ids_after(self.general, last_id),
+                                ids_after(private, last_id)):
+            if message_id > until_id or len(messages) >= page_size:
+                break
+            messages.append(self.messages[message_id])
+        return messages
+
+    def history(self, user: str, reg_date: int) -> list[Message]:
+        """Same rows as ``get_message_query``: the messages since the
+        registration, the user's own ones and a few earlier ones"""
+        rows = []
+        earlier = []
+        for message_id in merge(self.general, self.by_user.get(user, [])):
+            message = self.messages[message_id]
+            if message.sender == user or message.timestamp >= reg_date:
+                rows.append(message)
+            else:
+                earlier.append(message)
+        rows.extend(nlargest(settings.LIMIT_SHOW_MESSAGES, earlier,
+                             key=attrgetter('timestamp')))
+        rows.sort(key=attrgetter('timestamp', 'id'))
+        return rows
+
+
+class LogWriter(WriteBehindQueue):
+    """Write-behind queue appending records to the log file at ``path``"""
+    errors = (OSError,)
+
+    def __init__(self, path: str, executor: ThreadPoolExecutor,
+                 batch_size: int = settings.WRITE_BATCH_SIZE,
+                 flush_interval: float = settings.WRITE_FLUSH_INTERVAL
+                 ) -> None:
+        super().__init__(path, executor, batch_size, flush_interval)
+        self.path = path
+        self._file = None
+
+    def switch(self, records: list[tuple[str, tuple[Any, ...]]],
+               path: str) -> None:
+        """Write ``records`` and continue in the log file at ``path``"""
+        self._append(records)
+        self._close()
+        self.path = path
+        self._connect()
+
+    def _connect(self) -> None:
+        self._file = open(self.path, 'ab')
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, groups: list[tuple[str, list[tuple[Any, ...]]]]) -> None:
+        self._append(
+            (kind, params) for kind, batch in groups for params in batch)
+
+    def _append(self, records: Iterable[tuple[str, tuple[Any, ...]]]) -> None:
+        if self._file is None:
+            raise OSError('Log file is not open')
+        data = b''.join(encode_record(*record) for record in records)
+        if not data:
+            return
+        position = self._file.tell()
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError:
+            # do not leave a torn record in front of the next batch
+            self._file.truncate(position)
+            raise
+
+
+class LogStorage:
+    """Storage in memory with an append-only log and snapshots on disk"""
+
+    def __init__(self, path: str = settings.STORAGE_PATH,
+                 snapshot_interval: float = settings.SNAPSHOT_INTERVAL,
+                 batch_size: int = settings.WRITE_BATCH_SIZE,
+                 flush_interval: float = settings.WRITE_FLUSH_INTERVAL
+                 ) -> None:
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.state = MemoryState()
+        self.generation = 0
+        # records written since the last snapshot
+        self.written = 0
+        self.writer = LogWriter(self._file_name(LOG, 0), ThreadPoolExecutor(1),
+                                batch_size, flush_interval)
+        self._task: asyncio.Task | None = None
+
+    async def open(self) -> None:
+        """Recover the state and start writing the log"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        replayed = await loop.run_in_executor(
+            self.writer.executor, self._recover)
+        server_logger.info(
+            'Recovered %s: %s messages, %s log records in %.3f s',
+            self.path, len(self.state.messages), replayed,
+            time.perf_counter() - started)
+        self.writer.path = self._file_name(LOG, self.generation)
+        await self.writer.start()
+        self._task = loop.create_task(self._run())
+
+    async def close(self) -> None:
+        """Save a snapshot if anything changed and close the log"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.written:
+            await self.snapshot()
+        await self.writer.stop()
+
+    def put(self, kind: str, params: tuple[Any, ...]) -> None:
+        """Apply a write of the kind ``kind`` and queue it for the log"""
+        self.state.apply(kind, params)
+        self._log(kind, params)
+
+    async def flush(self) -> None:
+        """Write the queued records to the log"""
+        await self.writer.flush()
+
+    async def snapshot(self) -> None:
+        """Save the state and start a new log generation"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        self.generation += 1
+        generation = self.generation
+        try:
+            # the snapshot covers the records queued so far, they go to the
+            # old log after the batch being written; the records put from
+            # now on go to the new one
+            async with self.writer.writing:
+                records = self.writer.take()
+                state = self.state.copy()
+                self.written = 0
+                await loop.run_in_executor(
+                    self.writer.executor, self.writer.switch, records,
+                    self._file_name(LOG, generation))
+            size = await loop.run_in_executor(
+                None, self._save_snapshot, generation, state)
+        except OSError as er:
+            server_logger.error(
+                'Storage error - snapshot %s: %s', generation, er)
+            return
+        server_logger.info(
+            'Snapshot %s of %s bytes in %.3f s',
+            generation, size, time.perf_counter() - started)
+
+    async def get_user(self, username: str) -> tuple[str, int] | None:
+        reg_date = self.state.users.get(username)
+        return None if reg_date is None else (username, reg_date)
+
+    async def get_cursor(self, username: str, device: str) -> int | None:
+        return self.state.cursors.get((username, device))
+
+    async def get_last_message_id(self) -> int:
+        return self.state.last_message_id
+
+    async def get_last_messages(self, general_limit: int, private_limit: int
+                                ) -> tuple[list[Message], list[Message]]:
+        """The latest general and private messages, newest first"""
+        return (self.state.newest(self.state.general, general_limit),
+                self.state.newest(self.state.private, private_limit))
+
+    async def get_history(self, user: str, reg_date: int) -> list[Message]:
+        return self.state.history(user, reg_date)
+
+    async def get_unread(self, user: str, last_id: int, until_id: int,
+                         page_size: int) -> list[Message]:
+        return self.state.unread(user, last_id, until_id, page_size)
+
+    async def get_rate_limits(self, limit: int
+                              ) -> list[tuple[str, float, float]]:
+        """Saved token buckets, the most recently updated first"""
+        return nlargest(
+            limit,
+            ((u, *bucket) for u, bucket in self.state.rate_limits.items()),
+            key=itemgetter(2))
+
+    async def delete_expired(self, cutoff: int, limit: int) -> int:
+        """Delete up to ``limit`` of the oldest messages sent before
+        ``cutoff``, return how many were deleted"""
+        deleted = self.state.expire(cutoff, limit)
+        if deleted:
+            # replaying it deletes the same messages
+            self._log(Write.EXPIRE, (cutoff, limit))
+        return deleted
+
+    async def get_oldest_send_date(self) -> int | None:
+        for message in self.state.messages.values():
+            return message.timestamp
+        return None
+
+    async def get_scheduled(self) -> list[tuple[int, str, str, str, int]]:
+        return list(self.state.scheduled.values())
+
+    async def get_last_scheduled_id(self) -> int:
+        return self.state.last_scheduled_id
+
+    def _log(self, kind: str, params: tuple[Any, ...]) -> None:
+        self.writer.put(kind, params)
+        self.written += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            if self.written:
+                await self.snapshot()
+
+    def _file_name(self, prefix: str, generation: int) -> str:
+        return os.path.join(self.path, f'{prefix}-{generation:010d}')
+
+    def _generations(self, prefix: str) -> list[int]:
+        return sorted(
+            int(name[len(prefix) + 1:]) for name in os.listdir(self.path)
+            if name.startswith(f'{prefix}-')
+            and name[len(prefix) + 1:].isdigit()
+        )
+
+    def _recover(self) -> int:
+        """Load the newest snapshot and replay the logs written after it,
+        return the number of records replayed"""
+        os.makedirs(self.path, exist_ok=True)
+        snapshots = self._generations(SNAPSHOT)
+        if snapshots:
+            self.generation = snapshots[-1]
+            with open(self._file_name(SNAPSHOT, self.generation), 'rb') as f:
+                self.state = pickle.load(f)
+        oldest = self.generation
+        replayed = 0
+        for generation in self._generations(LOG):
+            if generation < oldest:
+                continue
+            name = self._file_name(LOG, generation)
+            with open(name, 'rb') as f:
+                data = f.read()
+            size = 0
+            for size, (kind, params) in read_records(data):
+                self.state.apply(kind, params)
+                replayed += 1
+            if size < len(data):
+                server_logger.warning(
+                    'Cut %s bytes of a torn record off %s',
+                    len(data) - size, name)
+                os.truncate(name, size)
+            self.generation = generation
+        self._remove_before(oldest)
+        return replayed
+
+    def _save_snapshot(self, generation: int, state: MemoryState) -> int:
+        name = self._file_name(SNAPSHOT, generation)
+        with open(f'{name}.tmp', 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(f'{name}.tmp', name)
+        # make the rename durable before the logs it replaces go away
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._remove_before(generation)
+        return size
+
+    def _remove_before(self, generation: int) -> None:
+        for prefix in (SNAPSHOT, LOG):
+            for old in self._generations(prefix):
+                if old < generation:
+                    os.remove(self._file_name(prefix, old))
@@ -0,0 +1,235 @@
+"""Counters and latency histograms of the server hot paths.
+
+Everything is updated from the event loop thread, so plain integer and
+float updates need no locks. Histograms have fixed buckets: an
+observation is one bisect and one increment. Values that are already
+kept elsewhere, such as connection counts and queue depths, are read by
+callbacks only when the metrics are rendered.
+"""
+import asyncio
+import time
+
+from asyncio.streams import StreamReader, StreamWriter
+from bisect import bisect_left
+from typing import Callable
+
+from utils import server_logger
+
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0,
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def samples(self, name: str, labels: str) -> list[str]:
+        return [f'{name}{{{labels}}} {self.value}' if labels
+                else f'{name} {self.value}']
+
+
+class Timer:
+    """Observes the time spent inside the ``with`` block"""
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: 'Histogram') -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # the last slot counts the values above the highest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def samples(self, name: str, labels: str) -> list[str]:
+        prefix = f'{labels},' if labels else ''
+        lines = []
+        total = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum}')
+        lines.append(f'{name}_count{suffix} {total}')
+        return lines
+
+
+class Family:
+    """Metrics of one name, one per combination of label values"""
+
+    def __init__(self, name: str, help_text: str, kind: str,
+                 factory: Callable[[], Counter | Histogram],
+                 labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.factory = factory
+        self.labelnames = labelnames
+        self.children: dict[tuple[str, ...], Counter | Histogram] = dict()
+        if not labelnames:
+            # report zeros before the first update
+            self.labels()
+
+    def labels(self, *values: str) -> Counter | Histogram:
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def inc(self, amount: int = 1) -> None:
+        self.labels().inc(amount)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} {self.kind}']
+        for values, child in self.children.items():
+            labels = ','.join(
+                f'{n}="{v}"' for n, v in zip(self.labelnames, values))
+            lines.extend(child.samples(self.name, labels))
+        return lines
+
+
+class Collected:
+    """A value read by a callback when the metrics are rendered"""
+
+    def __init__(self, name: str, help_text: str, kind: str,
+                 collect: Callable[[], float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help_text}',
+                f'# TYPE {self.name} {self.kind}',
+                f'{self.name} {self.collect()}']
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Family | Collected] = dict()
+
+    def counter(self, name: str, help_text: str,
+                labelnames: tuple[str, ...] = ()) -> Family:
+        family = Family(name, help_text, 'counter', Counter, labelnames)
+        self._metrics[name] = family
+        return family
+
+    def histogram(self, name: str, help_text: str,
+                  labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Family:
+        family = Family(name, help_text, 'histogram',
+                        lambda: Histogram(buckets), labelnames)
+        self._metrics[name] = family
+        return family
+
+    def collect(self, name: str, help_text: str,
+                collect: Callable[[], float], kind: str = 'gauge') -> None:
+        """Register a value read at render time, replacing an older one"""
+        self._metrics[name] = Collected(name, help_text, kind, collect)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str, port: int) -> None:
+        """Answer ``GET /metrics`` over HTTP until cancelled"""
+        try:
+            srv = await asyncio.start_server(self._http_request, host, port)
+        except OSError as er:
+            server_logger.error('Unable to serve metrics: %s', er)
+            return
+        server_logger.info('Serve metrics on %s:%s', host, port)
+        async with srv:
+            await srv.serve_forever()
+
+    async def _http_request(
+            self, reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            # the headers are not needed
+            while (await reader.readline()).strip():
+                pass
+            if request_line.split()[:2] == [b'GET', b'/metrics']:
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+                .encode() + body
+            )
+            await writer.drain()
+        except ConnectionError as er:
+            server_logger.warning('Metrics request failed: %s', er)
+        finally:
+            writer.close()
+
+
+metrics = MetricsRegistry()
+
+request_seconds = metrics.histogram(
+    'chat_request_seconds', 'Time to process a client request', ('target',))
+db_seconds = metrics.histogram(
+    'chat_db_seconds', 'Time a DB connection is held, by operation',
+    ('operation',))
+db_wait_seconds = metrics.histogram(
+    'chat_db_wait_seconds', 'Time spent waiting for a pooled DB connection')
+http_requests = metrics.counter(
+    'chat_http_requests_total', 'HTTP requests answered', ('status',))
+db_errors = metrics.counter(
+    'chat_db_errors_total', 'Failed DB operations', ('operation',))
+write_batch_seconds = metrics.histogram(
+    'chat_db_write_batch_seconds', 'Time to write a batch of queued writes')
+writes = metrics.counter(
+    'chat_db_writes_total', 'Queries written by the write-behind queue')
+fanout_seconds = metrics.histogram(
+    'chat_fanout_seconds', 'Time to queue a frame on all its receivers')
+fanout_frames = metrics.counter(
+    'chat_fanout_frames_total', 'Frames queued by fan-out')
+messages_expired = metrics.counter(
+    'chat_messages_expired_total', 'Messages deleted by retention')
+rate_limited = metrics.counter(
+    'chat_rate_limited_total', 'Messages rejected by the rate limiter')
+compression_seconds = metrics.histogram(
+    'chat_compression_seconds', 'Time to compress a batch of frames')
+compression_input_bytes = metrics.counter(
+    'chat_compression_input_bytes_total', 'Bytes of frames compressed')
+compression_output_bytes = metrics.counter(
+    'chat_compression_output_bytes_total', 'Bytes of compressed frames')
+scheduled_delivered = metrics.counter(
+    'chat_scheduled_delivered_total', 'Scheduled messages sent on time')
+file_bytes = metrics.counter(
+    'chat_file_bytes_total', 'Bytes of files received and sent',
+    ('direction',))
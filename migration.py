@@ -3,11 +3,22 @@ import sqlite3
 from config import settings
 
 
-def create_db(db_name: str = settings.DB_NAME):
-    sqlite_connection = None
-    try:
-        sqlite_connection = sqlite3.connect(db_name)
-        sqlite_create_table_query = '''
+def to_microseconds(column: str) -> str:
+    """SQL turning the text of a datetime stored by sqlite3 into
+    microseconds since the epoch"""
+    return f'''
+        COALESCE(CAST(strftime('%s', {column}) AS INTEGER) * 1000000
+            + CASE WHEN substr({column}, 20, 1) = '.'
+                THEN CAST(substr({column}, 21, 6) AS INTEGER) ELSE 0 END, 0)
+    '''
+
+
+# Every migration moves the schema one version up. The version of a
+# database is stored in ``PRAGMA user_version``; databases created before
+# versioning have version 0 and are upgraded in place.
+MIGRATIONS: list[tuple[str, tuple[str, ...]]] = [
+    ('Таблицы "messages" и "registrations"', (
+        '''
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 sender TEXT NOT NULL,
@@ -15,29 +26,172 @@ def create_db(db_name: str = settings.DB_NAME):
                 message TEXT,
                 send_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+        ''',
         '''
-
-        cursor = sqlite_connection.cursor()
-        print('Тестовая база данных подключена')
-        cursor.execute(sqlite_create_table_query)
-        sqlite_connection.commit()
-        print('Таблица "messages" создана')
-
-        sqlite_create_table_query = '''
             CREATE TABLE IF NOT EXISTS registrations (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 username TEXT NOT NULL,
                 reg_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 count_messages INTEGER DEFAULT 0 NOT NULL
             );
+        ''',
+    )),
+    ('Таблица "rate_limits"', (
+        '''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                username TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        ''',
+    )),
+    ('Индексы "messages" и уникальность "registrations.username"', (
+        '''
+            DELETE FROM registrations
+            WHERE id NOT IN (
+                SELECT MIN(id) FROM registrations GROUP BY username
+            );
+        ''',
+        '''
+            CREATE UNIQUE INDEX IF NOT EXISTS registrations_username_uindex
+            ON registrations (username);
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS messages_receiver_send_date_index
+            ON messages (receiver, send_date);
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS messages_sender_send_date_index
+            ON messages (sender, send_date);
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS messages_send_date_index
+            ON messages (send_date);
+        ''',
+    )),
+    ('Таблица "read_cursors"', (
+        '''
+            CREATE TABLE IF NOT EXISTS read_cursors (
+                username TEXT NOT NULL,
+                device TEXT NOT NULL DEFAULT '',
+                last_id INTEGER NOT NULL,
+                PRIMARY KEY (username, device)
+            );
+        ''',
+    )),
+    ('Время в "messages" и "registrations" в микросекундах', (
+        '''
+            CREATE TABLE messages_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                receiver TEXT NOT NULL DEFAULT 'all',
+                message TEXT,
+                send_date INTEGER NOT NULL
+            );
+        ''',
+        f'''
+            INSERT INTO messages_new (id, sender, receiver, message, send_date)
+            SELECT id, sender, receiver, message,
+                {to_microseconds('send_date')}
+            FROM messages;
+        ''',
+        # ids of deleted messages are not reused
+        '''
+            DELETE FROM sqlite_sequence WHERE name = 'messages_new';
+        ''',
+        '''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'messages_new', seq FROM sqlite_sequence
+            WHERE name = 'messages';
+        ''',
         '''
+            DROP TABLE messages;
+        ''',
+        '''
+            ALTER TABLE messages_new RENAME TO messages;
+        ''',
+        '''
+            CREATE INDEX messages_receiver_send_date_index
+            ON messages (receiver, send_date);
+        ''',
+        '''
+            CREATE INDEX messages_sender_send_date_index
+            ON messages (sender, send_date);
+        ''',
+        '''
+            CREATE INDEX messages_send_date_index
+            ON messages (send_date);
+        ''',
+        '''
+            CREATE TABLE registrations_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                reg_date INTEGER NOT NULL,
+                count_messages INTEGER DEFAULT 0 NOT NULL
+            );
+        ''',
+        f'''
+            INSERT INTO registrations_new (id, username, reg_date,
+                                           count_messages)
+            SELECT id, username, {to_microseconds('reg_date')}, count_messages
+            FROM registrations;
+        ''',
+        '''
+            DROP TABLE registrations;
+        ''',
+        '''
+            ALTER TABLE registrations_new RENAME TO registrations;
+        ''',
+        '''
+            CREATE UNIQUE INDEX registrations_username_uindex
+            ON registrations (username);
+        ''',
+    )),
+    ('Таблица "scheduled_messages"', (
+        '''
+            CREATE TABLE IF NOT EXISTS scheduled_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                receiver TEXT NOT NULL DEFAULT 'all',
+                message TEXT,
+                send_at INTEGER NOT NULL
+            );
+        ''',
+    )),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection: sqlite3.Connection) -> int:
+    return connection.execute('PRAGMA user_version').fetchone()[0]
 
-        cursor = sqlite_connection.cursor()
-        cursor.execute(sqlite_create_table_query)
-        sqlite_connection.commit()
-        print('Таблица "registrations" создана')
 
-        cursor.close()
+def migrate(connection: sqlite3.Connection,
+            target: int = SCHEMA_VERSION) -> int:
+    """Apply the pending migrations up to ``target``, return the version"""
+    version = get_version(connection)
+    for number, (title, statements) in enumerate(
+            MIGRATIONS[version:target], start=version + 1):
+        with connection:
+            # DDL does not open a transaction implicitly
+            connection.execute('BEGIN')
+            for statement in statements:
+                connection.execute(statement)
+            # PRAGMA does not accept parameters
+            connection.execute(f'PRAGMA user_version = {number:d}')
+        print(f'Миграция {number}: {title}')
+    return get_version(connection)
+
+
+def create_db(db_name: str = settings.DB_NAME,
+              target: int = SCHEMA_VERSION):
+    sqlite_connection = None
+    try:
+        sqlite_connection = sqlite3.connect(db_name)
+        print('Тестовая база данных подключена')
+        version = migrate(sqlite_connection, target)
+        print(f'Версия схемы базы данных: {version}')
 
     except sqlite3.Error as error:
         print('Ошибка при подключении к sqlite', error)
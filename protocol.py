@@ -0,0 +1,102 @@
+import struct
+
+from asyncio import IncompleteReadError
+from asyncio.streams import StreamReader
+from typing import AsyncIterator
+
+from config import settings
+
+
+HEADER = struct.Struct('!I')
+# first bytes of the frames answering a chat request of a client with acks
+ACK = b'\x06'
+NACK = b'\x15'
+# first byte of a frame holding other frames deflated, see compression.py
+COMPRESSED = b'\x0e'
+# first bytes of the frame starting a file sent to a client and of the
+# frames with the data of a file, in both directions, see files.py
+FILE_START = b'\x1c'
+FILE_CHUNK = b'\x1d'
+
+
+class FrameError(ValueError):
+    """The peer sent a frame that violates the protocol"""
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """Prefix the payload with its length"""
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_text(text: str) -> bytes:
+    """Encode a text message as a single frame"""
+    return encode_frame(text.encode())
+
+
+def encode_ack(request_number: int, message_id: int) -> bytes:
+    """Tell the sender the id its chat message got.
+
+    Requests are numbered by their order on the connection, counting only
+    the chat messages.
+    """
+    return encode_frame(ACK + f'{request_number} {message_id}'.encode())
+
+
+def encode_nack(request_number: int, reason: str) -> bytes:
+    """Tell the sender its chat message was refused"""
+    return encode_frame(NACK + f'{request_number} {reason}'.encode())
+
+
+def encode_file_start(file_id: str, size: int, name: str) -> bytes:
+    """Tell the client a file follows, or with the size of -1 that it
+    does not and why"""
+    return encode_frame(FILE_START + f'{file_id} {size} {name}'.encode())
+
+
+def split_frames(data: bytes,
+                 max_size: int = settings.MAX_FRAME_SIZE) -> list[bytes]:
+    """Frames packed one after another into ``data``"""
+    frames = []
+    offset = 0
+    while offset < len(data):
+        if offset + HEADER.size > len(data):
+            raise FrameError('Data ended inside a frame header')
+        (size,) = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if size > max_size:
+            raise FrameError(f'Frame of {size} bytes exceeds limit {max_size}')
+        if offset + size > len(data):
+            raise FrameError('Data ended inside a frame')
+        frames.append(data[offset:offset + size])
+        offset += size
+    return frames
+
+
+async def read_frame(reader: StreamReader,
+                     max_size: int = settings.MAX_FRAME_SIZE) -> bytes | None:
+    """Read one frame, return None if the stream ended between frames"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except IncompleteReadError as er:
+        if er.partial:
+            raise FrameError('Stream ended inside a frame header') from er
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > max_size:
+        raise FrameError(f'Frame of {size} bytes exceeds limit {max_size}')
+    try:
+        return await reader.readexactly(size)
+    except IncompleteReadError as er:
+        raise FrameError('Stream ended inside a frame') from er
+
+
+async def iter_frames(reader: StreamReader,
+                      max_size: int = settings.MAX_FRAME_SIZE
+                      ) -> AsyncIterator[bytes]:
+    """Yield frames until the peer closes the stream.
+
+    Frames are taken from the reader's buffer, so any number of them may
+    arrive in one TCP segment and a frame may span several segments.
+    """
+    while (frame := await read_frame(reader, max_size)) is not None:
+        yield frame
@@ -0,0 +1,84 @@
+import time
+
+from collections import OrderedDict
+
+from config import settings
+from metrics import rate_limited
+from storage import Storage, WriteQueue
+from structs import Write
+
+
+LIMIT_WARNING = 'You have reached the limit for sending messages to the ' \
+                'general chat'
+
+
+class RateLimiter:
+    """Per-user token bucket for messages to the general chat.
+
+    Every bucket holds up to ``capacity`` tokens and refills continuously
+    at ``capacity`` tokens per ``period`` seconds, so a user may send a
+    burst of ``capacity`` messages and then one more every
+    ``period / capacity`` seconds. A check is O(1). At most ``max_users``
+    buckets are kept; the least recently used one is evicted first, and
+    it has usually refilled by then. Buckets changed since the last
+    snapshot are written to the storage by ``snapshot`` and restored by
+    ``load``. The hub of a multi-worker server keeps the only limiter, so
+    the messages a user sends through every worker share one bucket.
+    """
+
+    def __init__(self, capacity: int = settings.LIMIT_MESSAGES,
+                 period: float = 60 * settings.UPDATE_PERIOD,
+                 max_users: int = settings.RATE_LIMIT_USERS) -> None:
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.max_users = max_users
+        self.limited = 0
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._dirty: set[str] = set()
+
+    def allow(self, username: str, now: float | None = None) -> bool:
+        """Take a token from the user's bucket if there is one"""
+        now = time.time() if now is None else now
+        tokens = self._refill(username, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.limited += 1
+            rate_limited.inc()
+        self._buckets[username] = (tokens, now)
+        self._buckets.move_to_end(username)
+        self._dirty.add(username)
+        while len(self._buckets) > self.max_users:
+            evicted, _ = self._buckets.popitem(last=False)
+            self._dirty.discard(evicted)
+        return allowed
+
+    def remaining(self, username: str, now: float | None = None) -> int:
+        """Number of messages the user may send right now"""
+        now = time.time() if now is None else now
+        return int(self._refill(username, now))
+
+    async def load(self, storage: Storage) -> None:
+        """Restore the buckets saved by the previous snapshot"""
+        rows = await storage.get_rate_limits(self.max_users)
+        for username, tokens, updated_at in reversed(rows):
+            self._buckets[username] = (tokens, updated_at)
+
+    def snapshot(self, write_queue: WriteQueue) -> None:
+        """Queue the buckets changed since the last snapshot for writing"""
+        for username in self._dirty:
+            bucket = self._buckets.get(username)
+            if bucket is not None:
+                write_queue.put(Write.RATE_LIMIT, (username, *bucket))
+        self._dirty.clear()
+
+    def _refill(self, username: str, now: float) -> float:
+        bucket = self._buckets.get(username)
+        if bucket is None:
+            return float(self.capacity)
+        tokens, updated_at = bucket
+        return min(
+            float(self.capacity),
+            tokens + max(0.0, now - updated_at) * self.rate
+        )
@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+from config import settings
+
+
+class RequestLog:
+    """Ids the latest chat messages got, by sender and request id.
+
+    A client that asked for acks gives every chat message a request id and
+    sends the messages without an ack again after reconnecting. The ack
+    may have been lost after the message was posted, so a request id seen
+    before is acked with the id its message got and is not posted twice.
+    At most ``capacity`` requests are kept, the oldest one is forgotten
+    first.
+    """
+
+    def __init__(self, capacity: int = settings.REQUEST_LOG_SIZE) -> None:
+        self.capacity = capacity
+        self._message_ids: OrderedDict[tuple[str, int], int] = OrderedDict()
+
+    def get(self, sender: str, request_id: int) -> int | None:
+        """Id of the message posted for the request, None if there is
+        none"""
+        if not request_id:
+            return None
+        return self._message_ids.get((sender, request_id))
+
+    def add(self, sender: str, request_id: int, message_id: int) -> None:
+        if not request_id:
+            return
+        self._message_ids[(sender, request_id)] = message_id
+        if len(self._message_ids) > self.capacity:
+            self._message_ids.popitem(last=False)
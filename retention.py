@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from datetime import timedelta
+from typing import Callable
+
+from config import settings
+from database import StorageError
+from files import FileStore
+from history import HistoryBuffer
+from metrics import messages_expired
+from storage import Storage
+from utils import server_logger
+
+
+class RetentionEngine:
+    """Deletes messages once they are older than ``lifetime``.
+
+    Every pass recomputes the cutoff, deletes the expired messages in chunks
+    of ``chunk_size``, each committed on its own, so the writers are not
+    locked out for long, and trims the in-memory history. Then it sleeps
+    until the oldest remaining message expires; a message sent while it
+    sleeps expires later than that. Files sent to the chat expire with
+    the messages.
+    """
+
+    def __init__(self, storage: Storage, history: HistoryBuffer,
+                 now: Callable[[], int],
+                 lifetime: timedelta = timedelta(
+                     minutes=settings.LIFETIME_MESSAGES),
+                 chunk_size: int = settings.EXPIRY_CHUNK_SIZE,
+                 files: FileStore | None = None) -> None:
+        self.storage = storage
+        self.history = history
+        self.files = files
+        self.now = now
+        self.lifetime = lifetime
+        # timestamps are in microseconds
+        self._lifetime = lifetime // timedelta(microseconds=1)
+        self.chunk_size = chunk_size
+        self.reclaimed = 0
+        self.last_reclaimed = 0
+        self.last_duration = 0.0
+
+    async def run(self) -> None:
+        """Expire messages until cancelled"""
+        while True:
+            try:
+                await self.purge()
+                delay = await self.seconds_until_next_expiry()
+            except StorageError as er:
+                server_logger.error('DB error - deleting messages: %s', er)
+                delay = settings.EXPIRY_RETRY_INTERVAL
+            await asyncio.sleep(delay)
+
+    async def purge(self) -> int:
+        """Delete everything older than the cutoff, return the row count"""
+        started = time.perf_counter()
+        cutoff = self.now() - self._lifetime
+        reclaimed = 0
+        while True:
+            deleted = await self.storage.delete_expired(
+                cutoff, self.chunk_size)
+            reclaimed += deleted
+            if deleted < self.chunk_size:
+                break
+            # let the other DB users in between the chunks
+            await asyncio.sleep(0)
+        self.history.expire(cutoff)
+        if self.files is not None:
+            await self.files.expire(cutoff)
+
+        self.last_reclaimed = reclaimed
+        self.last_duration = time.perf_counter() - started
+        self.reclaimed += reclaimed
+        messages_expired.inc(reclaimed)
+        if reclaimed:
+            server_logger.info(
+                'Deleted %s old messages in %.3f s',
+                reclaimed, self.last_duration)
+        return reclaimed
+
+    async def seconds_until_next_expiry(self) -> float:
+        """Time left before the oldest stored message expires"""
+        oldest = await self.storage.get_oldest_send_date()
+        if oldest is None:
+            return self.lifetime.total_seconds()
+        expires = oldest + self._lifetime
+        return max(0.0, (expires - self.now()) / 1000000)
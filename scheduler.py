@@ -0,0 +1,184 @@
+"""Messages sent at a time their senders chose.
+
+Pending messages are indexed by id and by sender, and their send times
+are kept in a heap of ``(send_at, id)`` pairs: scheduling is O(log n) and
+cancelling removes the message from the indexes only, O(1). A cancelled
+entry is skipped when it comes to the top of the heap, and the heap is
+rebuilt once most of it is cancelled. A single timer waits for the top
+of the heap. It fires on a ``tick`` boundary and delivers everything due
+by then in one batch, so a million pending messages cost no tasks and
+no polling.
+
+Scheduled messages are persisted through the write queue and loaded
+when the server starts; the ones that fell due while it was down are
+sent on the first tick.
+"""
+import asyncio
+import heapq
+
+from typing import Callable
+
+from config import settings
+from metrics import scheduled_delivered
+from storage import Storage, WriteQueue
+from structs import RequestData, ScheduledMessage, Target, Write, \
+    format_timestamp
+from utils import server_logger
+
+
+# the heap is rebuilt when it has more cancelled entries than this and
+# than live ones
+COMPACT_MIN = 1024
+
+
+class Scheduler:
+    """Pending scheduled messages and the one timer they share"""
+
+    def __init__(self, write_queue: WriteQueue,
+                 deliver: Callable[[list[ScheduledMessage]], None],
+                 now: Callable[[], int],
+                 tick: float = settings.SCHEDULE_TICK,
+                 user_limit: int = settings.SCHEDULE_USER_LIMIT) -> None:
+        self.write_queue = write_queue
+        self.deliver = deliver
+        self.now = now
+        self.user_limit = user_limit
+        self.pending: dict[int, ScheduledMessage] = dict()
+        # ids of the pending messages of every sender, in scheduling order
+        self.by_sender: dict[str, dict[int, None]] = dict()
+        self.last_id = 0
+        self._heap: list[tuple[int, int]] = list()
+        # the timer and the tick it fires at, in microseconds
+        self._tick = max(1, round(tick * 1000000))
+        self._timer: asyncio.TimerHandle | None = None
+        self._timer_at = 0
+
+    async def load(self, storage: Storage) -> None:
+        """Restore the pending messages and start the timer"""
+        self.last_id = await storage.get_last_scheduled_id()
+        for row in await storage.get_scheduled():
+            scheduled = ScheduledMessage(*row)
+            self.pending[scheduled.id] = scheduled
+            self.by_sender.setdefault(scheduled.sender, {})[scheduled.id] = \
+                None
+            self._heap.append((scheduled.send_at, scheduled.id))
+        heapq.heapify(self._heap)
+        server_logger.info('Loaded %s scheduled messages', len(self.pending))
+        self._arm()
+
+    def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def handle(self, request: RequestData) -> str:
+        """Answer a SCHEDULE, SCHEDULED or CANCEL request"""
+        match request.target:
+            case Target.SCHEDULE:
+                try:
+                    scheduled = self.schedule(
+                        request.username, request.receiver or 'all',
+                        request.message, request.send_at)
+                except ValueError as er:
+                    return str(er)
+                return f'Scheduled message #{scheduled.id} to ' \
+                       f'{scheduled.receiver} will be sent at ' \
+                       f'{format_timestamp(scheduled.send_at)}'
+            case Target.SCHEDULED:
+                pending = self.scheduled(request.username)
+                if not pending:
+                    return 'You have no scheduled messages'
+                return '\n'.join((f'Scheduled messages - {len(pending)}:',
+                                  *map(str, pending)))
+            case Target.CANCEL:
+                try:
+                    scheduled_id = int(request.message.lstrip('#'))
+                except ValueError:
+                    return f'Invalid scheduled message id "{request.message}"'
+                if not self.cancel(request.username, scheduled_id):
+                    return f'You have no scheduled message #{scheduled_id}'
+                return f'Scheduled message #{scheduled_id} is cancelled'
+        return f'Unknown target "{request.target}"'
+
+    def schedule(self, sender: str, receiver: str, message: str,
+                 send_at: int) -> ScheduledMessage:
+        """Queue a message to be sent at ``send_at``, ValueError if the
+        request can not be scheduled"""
+        if send_at <= 0:
+            raise ValueError('The time to send the message is required')
+        if len(self.by_sender.get(sender, ())) >= self.user_limit:
+            raise ValueError(
+                f'You can not have more than {self.user_limit} scheduled '
+                f'messages')
+        self.last_id += 1
+        scheduled = ScheduledMessage(
+            self.last_id, sender, receiver, message, send_at)
+        self.pending[scheduled.id] = scheduled
+        self.by_sender.setdefault(sender, {})[scheduled.id] = None
+        heapq.heappush(self._heap, (send_at, scheduled.id))
+        self.write_queue.put(Write.SCHEDULE, scheduled.params)
+        self._arm()
+        return scheduled
+
+    def cancel(self, sender: str, scheduled_id: int) -> bool:
+        """Cancel a pending message of ``sender``, False if there is none"""
+        scheduled = self.pending.get(scheduled_id)
+        if scheduled is None or scheduled.sender != sender:
+            return False
+        self._remove(scheduled)
+        self.write_queue.put(Write.UNSCHEDULE, (scheduled_id,))
+        cancelled = len(self._heap) - len(self.pending)
+        if cancelled > COMPACT_MIN and cancelled > len(self.pending):
+            self._heap = [(s.send_at, s.id) for s in self.pending.values()]
+            heapq.heapify(self._heap)
+        return True
+
+    def scheduled(self, sender: str) -> list[ScheduledMessage]:
+        """Pending messages of ``sender``, the earliest first"""
+        return sorted(
+            (self.pending[i] for i in self.by_sender.get(sender, ())),
+            key=lambda scheduled: (scheduled.send_at, scheduled.id))
+
+    def _remove(self, scheduled: ScheduledMessage) -> None:
+        del self.pending[scheduled.id]
+        ids = self.by_sender[scheduled.sender]
+        del ids[scheduled.id]
+        if not ids:
+            del self.by_sender[scheduled.sender]
+
+    def _arm(self) -> None:
+        """Set the timer for the tick of the earliest pending message"""
+        heap = self._heap
+        while heap and heap[0][1] not in self.pending:
+            heapq.heappop(heap)
+        if not heap:
+            self.stop()
+            return
+        # the end of the tick the message falls in
+        at = -(-heap[0][0] // self._tick) * self._tick
+        if self._timer is not None and self._timer_at <= at:
+            return
+        self.stop()
+        self._timer_at = at
+        self._timer = asyncio.get_running_loop().call_later(
+            max(0.0, (at - self.now()) / 1000000), self.fire)
+
+    def fire(self) -> None:
+        """Deliver everything due and wait for the next tick"""
+        self._timer = None
+        now = self.now()
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, scheduled_id = heapq.heappop(heap)
+            scheduled = self.pending.get(scheduled_id)
+            if scheduled is not None:
+                self._remove(scheduled)
+                due.append(scheduled)
+        for scheduled in due:
+            self.write_queue.put(Write.UNSCHEDULE, (scheduled.id,))
+        # the next tick does not depend on this one's delivery
+        self._arm()
+        if due:
+            self.deliver(due)
+            scheduled_delivered.inc(len(due))
@@ -1,300 +1,701 @@
 import asyncio
-import aiosqlite
-import json
 
-from datetime import datetime, timedelta
-from pytz import timezone
 from asyncio.streams import StreamReader, StreamWriter
-from concurrent.futures import ThreadPoolExecutor
 
-from utils import server_logger
+from utils import dropped_log_records, server_logger
 from config import settings
-from structs import Target
-from sql_queries import (
-    get_message_query, store_message_query, store_user_query, get_user_query,
-    delete_message_query, append_count_query, reset_limit_query
+from database import SqliteStorage, StorageError
+from storage import Storage, WriteQueue, get_storage
+from users import UserRegistry
+from rate_limiter import LIMIT_WARNING, RateLimiter
+from request_log import RequestLog
+from history import HistoryBuffer
+from retention import RetentionEngine
+from cursors import CursorStore
+from files import FileInfo, FileStore, Upload
+from scheduler import Scheduler
+from bus import BusClient
+from http_server import HttpServer
+from structs import (
+    Codec, Message, RequestData, ScheduledMessage, Target, Write,
+    file_notice, now_timestamp
+)
+from codec import RequestCodec, get_codec
+from compression import StreamCompressor, get_compressor
+from protocol import (
+    FILE_CHUNK, FrameError, encode_ack, encode_file_start, encode_nack,
+    encode_text, iter_frames
+)
+from metrics import metrics, request_seconds
+from connection import (
+    Connection, ConnectionRegistry, QueueMetrics, broadcast
 )
 
 
 class Server:
     def __init__(self, host: str = settings.HOST, port: int = settings.PORT,
-                 db_name: str = settings.DB_NAME) -> None:
+                 db_name: str = settings.DB_NAME,
+                 bus: BusClient | None = None,
+                 metrics_port: int = settings.METRICS_PORT,
+                 storage: Storage | None = None,
+                 http_port: int = settings.HTTP_PORT) -> None:
         self.host: str = host
         self.port: int = port
+        self.metrics_port = metrics_port
+        self.http_port = http_port
         self.db_name = db_name
-        self.users: dict[str, list[StreamWriter]] = dict()
-        self.db_executor = ThreadPoolExecutor(1)
-        self.online_users: list = list()
+        if storage is None:
+            # a worker only reads the database, the hub writes to it
+            storage = get_storage(db_name=db_name) if bus is None \
+                else SqliteStorage(db_name, writer=False)
+        self.storage = storage
+        self.connections = ConnectionRegistry()
+        self.queue_metrics = QueueMetrics()
+        # a worker of a multi-process server writes through the bus and
+        # learns who is online on the other workers from it
+        self.bus = bus
+        self.presence = self.connections if bus is None else bus.online
+        self.write_queue: WriteQueue = storage if bus is None else bus
+        self.user_registry = UserRegistry(storage, self.write_queue)
+        # the hub limits the messages of a multi-worker server
+        self.rate_limiter = RateLimiter()
+        self.request_log = RequestLog()
+        self.history = HistoryBuffer()
+        self.files = FileStore()
+        # files being received, by connection
+        self.uploads: dict[Connection, Upload] = dict()
+        self.retention = RetentionEngine(
+            storage, self.history, now_timestamp, files=self.files)
+        # a device may reconnect to another worker
+        self.cursors = CursorStore(
+            storage, self.write_queue, cached=bus is None)
+        # the hub sends the scheduled messages of a multi-worker server
+        self.scheduler = Scheduler(
+            storage, self.deliver_scheduled, now_timestamp) \
+            if bus is None else None
+        self.last_message_id = 0
+        self.register_metrics()
 
     def listen(self) -> None:
-        """Start server and run db tasks"""
+        """Start server and run storage tasks"""
         print(f'Start server {self.host}:{self.port}')
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        main_task = loop.create_task(self.main())
-        delete_messages_task = loop.create_task(self.delete_old_messages())
-        reset_limit_task = loop.create_task(self.reset_limit_messages())
-        loop.run_until_complete(asyncio.wait([
-            main_task, delete_messages_task, reset_limit_task
-        ]))
+        loop.run_until_complete(self.storage.open())
+        loop.run_until_complete(self.load_history())
+        loop.run_until_complete(self.load_last_message_id())
+        if self.bus is None:
+            loop.run_until_complete(self.load_rate_limits())
+            loop.run_until_complete(self.load_scheduled())
+        else:
+            loop.run_until_complete(self.bus.connect(self))
+        try:
+            tasks = [
+                loop.create_task(self.main()),
+                loop.create_task(self.save_cursors()),
+            ]
+            if self.bus is None:
+                tasks.append(loop.create_task(self.snapshot_rate_limits()))
+                tasks.append(loop.create_task(self.retention.run()))
+            else:
+                # the hub expires messages for all the workers, and the
+                # worker stops once the hub is gone
+                tasks.append(self.bus.task)
+            if self.metrics_port:
+                # the server keeps running if the port is busy
+                loop.create_task(
+                    metrics.serve(settings.METRICS_HOST, self.metrics_port))
+            if self.http_port:
+                loop.create_task(HttpServer(self).serve(
+                    self.host, self.http_port,
+                    reuse_port=self.bus is not None))
+            loop.run_until_complete(
+                asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED))
+        finally:
+            if self.bus is None:
+                self.scheduler.stop()
+                self.rate_limiter.snapshot(self.write_queue)
+            self.cursors.save_all(self.connections.all())
+            if self.bus is not None:
+                loop.run_until_complete(self.bus.stop())
+            loop.run_until_complete(self.storage.close())
+            # let the connection tasks finish before the loop goes away
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
 
     async def main(self) -> None:
         """Start server"""
         srv = await asyncio.start_server(
-            self.client_connected, self.host, self.port)
+            self.client_connected, self.host, self.port,
+            reuse_port=self.bus is not None)
         async with srv:
             await srv.serve_forever()
 
     async def client_connected(
             self, reader: StreamReader, writer: StreamWriter) -> None:
         """Start listening to the connected client"""
-        address = writer.get_extra_info('peername')
+        connection = Connection(writer, self.queue_metrics)
+        address = connection.address
         server_logger.info('Start serving %s', address)
 
-        while data := await reader.read(1024):
-            await self.process_data(data, writer, address)
-
-        server_logger.info('Stop serving %s', address)
-        await self.disconnect_user(writer)
-
-    async def disconnect_user(self, writer: StreamWriter) -> None:
-        """Close client StreamWriter and send notifications to other clients"""
-        offline_flag = False
-        username = None
-        for user, w_list in self.users.items():
-            if writer in w_list:
-                w_list.remove(writer)
-                if not w_list:
-                    offline_flag = True
-                    username = user
-                    try:
-                        self.online_users.remove(user)
-                        server_logger.info(f'User {user} has left the chat')
-                    except ValueError as er:
-                        server_logger.error(
-                            f'Unable to remove user {user} from the list: {er}'
-                        )
-                    break
-        writer.close()
-        if offline_flag:
-            for w_list in self.users.values():
-                for w in w_list:
-                    w.write(
-                        f'{username} has left the chat'.encode()
-                    )
-                    await w.drain()
-
-    async def send_to_all(
-            self, self_writer: StreamWriter, sender: str, message: bytes | str
-    ) -> None:
+        codec = get_codec(Codec.JSON)
+        try:
+            async for frame in iter_frames(reader):
+                if frame[:1] == FILE_CHUNK:
+                    await self.receive_chunk(connection, frame)
+                    continue
+                try:
+                    request = codec.decode(frame)
+                except (ValueError, TypeError) as er:
+                    server_logger.error(
+                        'Invalid request from %s: %s', address, er)
+                    connection.send(encode_text(f'Invalid request: {er}'))
+                    continue
+                if request.target == Target.HELLO:
+                    codec = self.negotiate_codec(
+                        codec, request.codec, connection)
+                await self.process_data(request, connection, address)
+        except FrameError as er:
+            server_logger.error('Protocol error from %s: %s', address, er)
+        except ConnectionError as er:
+            server_logger.warning('Connection lost %s: %s', address, er)
+        finally:
+            # also after an unexpected error, so no session is left behind
+            server_logger.info('Stop serving %s', address)
+            upload = self.uploads.pop(connection, None)
+            if upload is not None:
+                upload.abort()
+            self.cursors.save(connection)
+            self.disconnect_user(connection)
+
+    def disconnect_user(self, connection: Connection) -> None:
+        """Close client connection and send notifications to other clients"""
+        username = self.connections.remove(connection)
+        connection.close()
+        if username is None:
+            return
+        self.user_registry.unpin(username)
+        server_logger.info('User %s has left the chat', username)
+        if self.bus is None:
+            self.send_left(username)
+        else:
+            self.bus.leave(username)
+
+    def register_metrics(self) -> None:
+        """Expose the connection and queue state as metrics"""
+        metrics.collect('chat_connections', 'Open client connections',
+                        lambda: len(self.connections))
+        metrics.collect('chat_users_online', 'Users online',
+                        lambda: self.presence.online_count)
+        metrics.collect(
+            'chat_outbound_queued_frames', 'Frames in the outbound queues',
+            lambda: sum(c.depth for c in self.connections.all()))
+        metrics.collect(
+            'chat_outbound_max_queue_depth', 'Deepest outbound queue',
+            lambda: max((c.depth for c in self.connections.all()), default=0))
+        metrics.collect(
+            'chat_outbound_dropped_total', 'Frames dropped for slow clients',
+            lambda: self.queue_metrics.dropped, 'counter')
+        metrics.collect(
+            'chat_slow_disconnects_total', 'Slow clients disconnected',
+            lambda: self.queue_metrics.slow_disconnects, 'counter')
+        metrics.collect(
+            'chat_log_dropped_total', 'Log records dropped on overflow',
+            dropped_log_records, 'counter')
+        if self.scheduler is not None:
+            metrics.collect(
+                'chat_scheduled_pending', 'Scheduled messages not sent yet',
+                lambda: len(self.scheduler.pending))
+
+    def queue_stats(self) -> dict[str, int]:
+        """Outbound queue depths and drop counters"""
+        depths = [c.depth for c in self.connections.all()]
+        return {
+            'connections': len(depths),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'peak_queue_depth': self.queue_metrics.max_depth,
+            'enqueued': self.queue_metrics.enqueued,
+            'dropped': self.queue_metrics.dropped,
+            'slow_disconnects': self.queue_metrics.slow_disconnects,
+        }
+
+    def send_to_all(self, self_connection: Connection | None,
+                    payload: bytes, message_id: int) -> None:
         """Send message to all clients"""
-        if isinstance(message, bytes):
-            message = message.decode()
-        for w_list in self.users.values():
-            for w in w_list:
-                if w != self_writer:
-                    w.write(
-                        f'{datetime.now(timezone(settings.TZ))} '
-                        f'{sender} to all: '
-                        f'{message}'.encode()
-                    )
-                    await w.drain()
-
-    async def send_to_one(
-            self, self_writer: StreamWriter, sender: str,
-            message: str, receiver: str
+        broadcast(
+            self.connections.all(exclude=self_connection), payload, message_id)
+        if self_connection is not None:
+            self_connection.last_id = message_id
+
+    def send_to_one(
+            self, self_connection: Connection | None, sender: str,
+            receiver: str, payload: bytes, message_id: int
     ) -> None:
         """Send private message"""
-        for username, w_list in self.users.items():
-            if username in (receiver, sender):
-                for w in w_list:
-                    if w != self_writer:
-                        w.write(
-                            f'{datetime.now(timezone(settings.TZ))} '
-                            f'{sender} to {receiver}: '
-                            f'{message}'.encode()
-                        )
-                        await w.drain()
-
-    async def send_hello(self, sender: str) -> None:
+        connections = [
+            c for username in {receiver, sender}
+            for c in self.connections.connections(username)
+            if c is not self_connection
+        ]
+        broadcast(connections, payload, message_id)
+        if self_connection is not None:
+            self_connection.last_id = message_id
+
+    def send_hello(self, sender: str) -> None:
         """Send a welcome message"""
-        if sender in self.online_users:
-            return
-        self.online_users.append(sender)
-        for user, w_list in self.users.items():
-            if user != sender:
-                for w in w_list:
-                    w.write(f'New guest in the chat! - {sender}'.encode())
-                    await w.drain()
+        connections = (
+            c for c in self.connections.all() if c.username != sender)
+        broadcast(
+            connections, encode_text(f'New guest in the chat! - {sender}'))
+
+    def send_left(self, username: str) -> None:
+        """Tell everybody that the user has left"""
+        broadcast(
+            self.connections.all(),
+            encode_text(f'{username} has left the chat')
+        )
+
+    @staticmethod
+    def negotiate_codec(
+            current: RequestCodec, requested: str, connection: Connection
+    ) -> RequestCodec:
+        """Pick the codec the client asked for in its HELLO request"""
+        try:
+            return get_codec(requested)
+        except ValueError as er:
+            server_logger.warning('Codec negotiation failed: %s', er)
+            connection.send(encode_text(
+                f'Codec "{requested}" is not supported, using "{current.name}"'
+            ))
+            return current
+
+    @staticmethod
+    def negotiate_compression(
+            requested: str, connection: Connection
+    ) -> StreamCompressor | None:
+        """Start the compression the client asked for in its HELLO"""
+        try:
+            return get_compressor(requested)
+        except ValueError as er:
+            server_logger.warning('Compression negotiation failed: %s', er)
+            connection.send(encode_text(
+                f'Compression "{requested}" is not supported, frames are '
+                f'sent as they are'
+            ))
+            return None
 
     async def process_data(
-            self, data: bytes, writer: StreamWriter, address: tuple[str, int]
+            self, request: RequestData, connection: Connection,
+            address: tuple[str, int]
     ) -> None:
-        """Process the data received from the client"""
-        data: dict = json.loads(data.decode())
-        target = data['target']
-        user = data['username']
-        count_messages = 0
-
-        exist_user = await self.get_user(user)
-        if not exist_user:
-            await self.reg_user(user)
-            reg_date = datetime.now(timezone(settings.TZ))
-        else:
-            reg_date = exist_user[1]
-            count_messages = exist_user[2]
+        """Process the request received from the client"""
+        with request_seconds.labels(request.target).time():
+            await self.handle_request(request, connection, address)
+
+    async def handle_request(
+            self, request: RequestData, connection: Connection,
+            address: tuple[str, int]
+    ) -> None:
+        target = request.target
+        user = request.username
+        if target == Target.ACK:
+            # the most frequent request needs no user record
+            self.receive_ack(connection, request.message)
+            return
+        record = await self.user_registry.get(user, now_timestamp())
 
         match target:
             case Target.HELLO:
-                if user not in self.users:
-                    self.users[user] = [writer]
-                else:
-                    self.users[user].append(writer)
-                await self.send_available_messages(user, writer, reg_date)
-                await self.send_hello(user)
+                joined = self.connections.add(connection, user)
+                self.user_registry.pin(user)
+                connection.device = request.device
+                connection.acks = request.acks
+                if request.compression:
+                    connection.compressor = self.negotiate_compression(
+                        request.compression, connection)
+                await self.send_history(
+                    connection, record.reg_date, request.last_id)
+                if joined:
+                    if self.bus is None:
+                        self.send_hello(user)
+                    else:
+                        self.bus.join(user)
             case Target.ALL:
-                if count_messages >= settings.LIMIT_MESSAGES:
-                    await self.send_limit_warning(writer)
+                connection.requests += 1
+                if self.ack_repeated(request, connection):
+                    return
+                # the hub counts the messages of a multi-worker server
+                if self.bus is None and not self.rate_limiter.allow(user):
+                    self.send_limit_warning(connection, connection.requests)
                 else:
-                    await self.store_message(data)
-                    await self.send_to_all(writer, user, data['message'])
-                    await self.append_count_message(user, count_messages)
+                    self.post_message(request, connection)
             case Target.ONE_TO_ONE:
-                await self.store_message(data)
-                await self.send_to_one(
-                    writer, user, data['message'], data['receiver']
-                )
+                connection.requests += 1
+                if not self.ack_repeated(request, connection):
+                    self.post_message(request, connection)
             case Target.STATUS:
-                await self.send_status(writer, user, address)
+                self.send_status(connection, user, address)
+            case Target.ADMIN:
+                self.send_admin(connection, user, request.message)
+            case Target.SCHEDULE | Target.SCHEDULED | Target.CANCEL:
+                self.schedule(request, connection)
+            case Target.FILE:
+                await self.start_upload(request, connection)
+            case Target.DOWNLOAD:
+                await self.send_file(connection, user, request.message)
+
+    async def send_history(
+            self, connection: Connection, reg_date: int,
+            resume_id: int = 0
+    ) -> None:
+        """Send what the device missed, or the recent history to a device
+        connecting for the first time.
+
+        A client with acks may tell the last message id it has, otherwise
+        the device's cursor is used. Live messages are held back until the
+        history is sent, so the client sees every id once and in order.
+        """
+        until_id = self.last_message_id
+        connection.hold()
+        try:
+            if connection.acks and resume_id:
+                last_id = min(resume_id, until_id)
+            else:
+                try:
+                    last_id = await self.cursors.get(
+                        connection.username, connection.device)
+                except StorageError as er:
+                    server_logger.error('DB error - get cursor: %s', er)
+                    last_id = None
+            if last_id is None:
+                await self.send_available_messages(
+                    connection.username, connection, reg_date)
+            else:
+                connection.acked_id = max(connection.acked_id, last_id)
+                await self.send_unread_messages(
+                    connection.username, connection, last_id, until_id)
+        finally:
+            # the live messages held meanwhile that the history did not
+            # cover are sent now, the cursor moves only with what was sent
+            connection.release()
+        self.cursors.save(connection)
+
+    async def send_unread_messages(
+            self, user: str, connection: Connection, last_id: int,
+            until_id: int, page_size: int = settings.HISTORY_PAGE_SIZE
+    ) -> None:
+        """Stream messages after ``last_id`` in pages, waiting for every
+        page to reach the socket before sending the next one"""
+        messages = self.history.replay_since(user, last_id)
+        if messages is not None:
+            for start in range(0, len(messages), page_size):
+                page = messages[start:start + page_size]
+                connection.send(b''.join(m.payload for m in page),
+                                page[-1].id, replay=True)
+                await connection.flushed()
+            return
+
+        try:
+            # the storage has to see the messages still in the write queue
+            await self.write_queue.flush()
+            while last_id < until_id and not connection.is_closing:
+                page = await self.storage.get_unread(
+                    user, last_id, until_id, page_size)
+                if not page:
+                    return
+                connection.send(b''.join(m.payload for m in page),
+                                page[-1].id, replay=True)
+                last_id = page[-1].id
+                await connection.flushed()
+        except StorageError as er:
+            server_logger.error('DB error - get unread messages: %s', er)
 
-    @staticmethod
     async def send_available_messages(
-            user: str, writer: StreamWriter, reg_date: datetime) -> None:
+            self, user: str, connection: Connection, reg_date: int
+    ) -> None:
         """Get and send messages available to the client"""
+        messages = self.history.replay(user, reg_date)
+        if messages is None:
+            messages = await self.get_available_messages(user, reg_date)
+        if messages:
+            # live messages newer than the snapshot may be among them
+            connection.send(b''.join(m.payload for m in messages),
+                            max(m.id for m in messages), replay=True)
+
+    async def get_available_messages(
+            self, user: str, reg_date: int) -> list[Message]:
+        """Get messages available to the client from the storage"""
         messages = []
 
         try:
-            async with aiosqlite.connect(settings.DB_NAME) as db:
-                async with db.execute(
-                        get_message_query,
-                        (user, reg_date, user, user, reg_date)
-                ) as cursor:
-                    messages = await cursor.fetchall()
-        except aiosqlite.DatabaseError as er:
-            server_logger.error(f'DB error - get messages: {er}')
-
-        for m in messages:
-            message = f'{m[0]} {m[1]} to {m[2]}: {m[3]}\n'.encode()
-            writer.write(message)
-            await writer.drain()
+            await self.write_queue.flush()
+            messages = await self.storage.get_history(user, reg_date)
+        except StorageError as er:
+            server_logger.error('DB error - get messages: %s', er)
 
-    @staticmethod
-    async def store_message(data: dict) -> None:
-        """Store message in DB"""
-        receiver = data['receiver'] or 'all'
+        return messages
+
+    def post_message(self, request: RequestData,
+                     connection: Connection) -> None:
+        """Store the message and deliver it, through the hub if the server
+        has several workers"""
+        timestamp = now_timestamp()
+        receiver = request.receiver or 'all'
+        if self.bus is not None:
+            self.bus.post_message(
+                connection, connection.requests, request.username, receiver,
+                request.message, timestamp, request.request_id,
+                limited=request.target == Target.ALL)
+            return
+        message = self.store_message(
+            request.username, receiver, request.message, timestamp)
+        self.request_log.add(request.username, request.request_id, message.id)
+        self.deliver_message(message, connection, connection.requests)
+
+    def ack_repeated(self, request: RequestData,
+                     connection: Connection) -> bool:
+        """Ack a chat message posted before, which the client sent again
+        because the ack was lost. The hub of a multi-worker server does
+        it for the workers"""
+        message_id = self.request_log.get(
+            request.username, request.request_id)
+        if message_id is None:
+            return False
+        self.send_ack(connection, connection.requests, message_id)
+        return True
+
+    def schedule(self, request: RequestData, connection: Connection) -> None:
+        """Schedule, list or cancel the user's scheduled messages. A
+        message to the general chat is counted by the rate limiter when
+        it is scheduled, by the hub on a multi-worker server"""
+        if self.bus is not None:
+            self.bus.schedule(connection, request)
+            return
+        if request.target == Target.SCHEDULE \
+                and request.receiver in ('', 'all') \
+                and not self.rate_limiter.allow(request.username):
+            connection.send(encode_text(LIMIT_WARNING))
+            return
+        connection.send(encode_text(self.scheduler.handle(request)))
+
+    async def start_upload(self, request: RequestData,
+                           connection: Connection) -> None:
+        """Receive the file the ``FILE_CHUNK`` frames after the request
+        carry. A file to the general chat counts as a message for the rate
+        limiter"""
+        previous = self.uploads.pop(connection, None)
+        if previous is not None:
+            previous.abort()
+        receiver = request.receiver or 'all'
+        if receiver == 'all' and not (
+                self.rate_limiter.allow(request.username) if self.bus is None
+                else await self.bus.allow(request.username)):
+            connection.send(encode_text(LIMIT_WARNING))
+            return
         try:
-            async with aiosqlite.connect(settings.DB_NAME) as db:
-                await db.execute(
-                    store_message_query,
-                    (
-                        data['message'], data['username'], receiver,
-                        datetime.now(timezone(settings.TZ))
-                    )
-                )
-                await db.commit()
-        except aiosqlite.DatabaseError as er:
-            server_logger.error(f'DB error - record message: {er}')
+            self.uploads[connection] = await self.files.upload(
+                request.username, receiver, request.message)
+        except ValueError as er:
+            connection.send(encode_text(str(er)))
+        except OSError as er:
+            server_logger.error('Unable to store a file: %s', er)
+            connection.send(encode_text('Unable to receive the file'))
 
-    @staticmethod
-    async def reg_user(username: str) -> None:
-        """Register a user"""
+    async def receive_chunk(self, connection: Connection,
+                            frame: bytes) -> None:
+        """Spool a chunk of the file being received, an empty chunk ends
+        the file. Chunks of a refused file are dropped"""
+        upload = self.uploads.get(connection)
+        if upload is None:
+            return
+        if len(frame) > len(FILE_CHUNK):
+            if upload.error:
+                return
+            try:
+                await upload.write(memoryview(frame)[len(FILE_CHUNK):])
+            except OSError as er:
+                server_logger.error('Unable to store a file: %s', er)
+                upload.abort('Unable to receive the file')
+            if upload.error:
+                connection.send(encode_text(upload.error))
+            return
+        del self.uploads[connection]
         try:
-            async with aiosqlite.connect(settings.DB_NAME) as db:
-                await db.execute(
-                    store_user_query,
-                    (username, datetime.now(timezone(settings.TZ)))
-                )
-                await db.commit()
-                server_logger.info(f'Create new user in DB - {username}')
-        except aiosqlite.DatabaseError as er:
-            server_logger.error(f'DB error - registration: {er}')
+            info = await upload.finish()
+        except OSError as er:
+            server_logger.error('Unable to store a file: %s', er)
+            connection.send(encode_text('Unable to receive the file'))
+            return
+        if info is not None:
+            server_logger.info('Received file %s of %s bytes from %s',
+                               info.id, info.size, info.sender)
+            self.post_file_notice(info)
 
-    @staticmethod
-    async def get_user(username: str) -> tuple[str]:
-        """Get user from DB"""
-        user = tuple()
+    def post_file_notice(self, info: FileInfo) -> None:
+        """Announce a received file with a chat message from its sender,
+        who gets it too"""
+        text = file_notice(info.id, info.name, info.size)
+        timestamp = now_timestamp()
+        if self.bus is not None:
+            self.bus.post_message(
+                None, 0, info.sender, info.receiver, text, timestamp)
+            return
+        self.deliver_message(self.store_message(
+            info.sender, info.receiver, text, timestamp))
+
+    async def send_file(self, connection: Connection, username: str,
+                        file_id: str) -> None:
+        """Send a file to a user it was sent to"""
+        info = await self.files.get(file_id)
+        if info is None or not info.allows(username):
+            connection.send(encode_file_start(file_id, -1, 'No such file'))
+            return
         try:
-            async with aiosqlite.connect(settings.DB_NAME) as db:
-                async with db.execute(get_user_query, (username,)) as cursor:
-                    user = await cursor.fetchone()
-        except aiosqlite.DatabaseError as er:
-            server_logger.error(f'DB error - get user: {er}')
-        return user
+            file = await asyncio.get_running_loop().run_in_executor(
+                None, open, self.files.path(info.id), 'rb')
+            with file:
+                await connection.send_file(
+                    encode_file_start(info.id, info.size, info.name),
+                    file, info.size)
+        except OSError as er:
+            server_logger.error('Unable to send file %s: %s', file_id, er)
+            connection.send(
+                encode_file_start(file_id, -1, 'Unable to read the file'))
+
+    def deliver_scheduled(self, batch: list[ScheduledMessage]) -> None:
+        """Send the scheduled messages that fell due in one tick"""
+        timestamp = now_timestamp()
+        for scheduled in batch:
+            self.deliver_message(self.store_message(
+                scheduled.sender, scheduled.receiver, scheduled.message,
+                timestamp))
+
+    def deliver_message(
+            self, message: Message, origin: Connection | None = None,
+            request_number: int = 0
+    ) -> None:
+        """Send a stored message to everybody it is meant for except the
+        connection it came from, which gets an ack if it asked for acks"""
+        self.last_message_id = max(self.last_message_id, message.id)
+        self.history.add(message)
+        if message.receiver == 'all':
+            self.send_to_all(origin, message.payload, message.id)
+        else:
+            self.send_to_one(origin, message.sender, message.receiver,
+                             message.payload, message.id)
+        self.send_ack(origin, request_number, message.id)
 
     @staticmethod
-    async def delete_old_messages() -> None:
-        """Delete old messages"""
-        deadline_date = datetime.now(timezone(settings.TZ)) - timedelta(
-            minutes=settings.LIFETIME_MESSAGES)
+    def send_ack(connection: Connection | None, request_number: int,
+                 message_id: int) -> None:
+        """Tell the sender the id its chat message got if it asked for
+        acks"""
+        if connection is not None and connection.acks:
+            connection.send(encode_ack(request_number, message_id))
 
-        while True:
-            try:
-                async with aiosqlite.connect(settings.DB_NAME) as db:
-                    await db.execute(delete_message_query, (deadline_date,))
-                    await db.commit()
-                    if db.total_changes != 0:
-                        server_logger.info('Deleting old messages')
-            except aiosqlite.DatabaseError as er:
-                server_logger.error(f'DB error - deleting messages: {er}')
-            await asyncio.sleep(60)
+    def store_message(self, sender: str, receiver: str, text: str,
+                      timestamp: int) -> Message:
+        """Queue the message for storing and return it"""
+        self.last_message_id += 1
+        message_id = self.last_message_id
+        self.write_queue.put(
+            Write.MESSAGE, (message_id, text, sender, receiver, timestamp))
+        return Message.create(message_id, timestamp, sender, receiver, text)
 
     @staticmethod
-    async def append_count_message(username: str, count_messages: int) -> None:
-        """Add to message counter for the user"""
-        count_messages += 1
+    def receive_ack(connection: Connection, message_id: str) -> None:
+        """Move the device's cursor to the id the client acknowledged"""
         try:
-            async with aiosqlite.connect(settings.DB_NAME) as db:
-                await db.execute(append_count_query, (count_messages, username))
-                await db.commit()
-        except aiosqlite.DatabaseError as er:
-            server_logger.error(f'DB error - updating count messages: {er}')
+            connection.ack(int(message_id))
+        except ValueError:
+            server_logger.warning(
+                'Invalid ack from %s: %r', connection.address, message_id)
 
-    @staticmethod
-    async def reset_limit_messages() -> None:
-        """Reset the message counter for the user"""
+    async def load_last_message_id(self) -> None:
+        """Continue message ids from the last one stored"""
+        self.last_message_id = await self.storage.get_last_message_id()
+
+    async def save_cursors(self) -> None:
+        """Periodically save the read cursors of connected devices"""
         while True:
-            try:
-                async with aiosqlite.connect(settings.DB_NAME) as db:
-                    await db.execute(
-                        reset_limit_query
-                    )
-                    await db.commit()
-                    server_logger.info('Reset message counter')
-            except aiosqlite.DatabaseError as er:
-                server_logger.error(f'DB error - reset limits: {er}')
-            await asyncio.sleep(60 * settings.UPDATE_PERIOD)
-
-    async def send_status(self, writer: StreamWriter, username: str,
-                          address: tuple[str, int]) -> None:
+            await asyncio.sleep(settings.CURSOR_SAVE_INTERVAL)
+            self.cursors.save_all(self.connections.all())
+
+    async def load_history(self) -> None:
+        """Fill the history buffers from the storage"""
+        try:
+            await self.history.prime(self.storage)
+        except StorageError as er:
+            server_logger.error('DB error - load history: %s', er)
+
+    async def load_scheduled(self) -> None:
+        """Restore the scheduled messages not sent before the restart"""
+        try:
+            await self.scheduler.load(self.storage)
+        except StorageError as er:
+            server_logger.error('DB error - load scheduled messages: %s', er)
+
+    async def load_rate_limits(self) -> None:
+        """Restore the rate limiter state saved before the restart"""
+        try:
+            await self.rate_limiter.load(self.storage)
+        except StorageError as er:
+            server_logger.error('DB error - load rate limits: %s', er)
+
+    async def snapshot_rate_limits(self) -> None:
+        """Periodically save the rate limiter state"""
+        while True:
+            await asyncio.sleep(settings.RATE_LIMIT_SNAPSHOT_INTERVAL)
+            self.rate_limiter.snapshot(self.write_queue)
+
+    def send_status(self, connection: Connection, username: str,
+                    address: tuple[str, int]) -> None:
         """Send status information about the chat"""
+        online = self.presence
         message = 'Your username - "{}"\nYour address - {}\nYour port - {}\n' \
                   'Users online - {}:\n{}'\
-            .format(username, address[0], address[1], len(self.online_users),
-                    ', '.join(self.online_users))
-        writer.write(message.encode())
-        await writer.drain()
+            .format(username, address[0], address[1], online.online_count,
+                    online.online_text)
+        connection.send(encode_text(message))
 
     @staticmethod
-    async def send_limit_warning(writer: StreamWriter):
+    def send_admin(connection: Connection, username: str,
+                   command: str) -> None:
+        """Answer an admin request of a user from ADMIN_USERS"""
+        if username not in settings.ADMIN_USERS \
+                or connection.username != username:
+            connection.send(encode_text('Admin requests are not allowed'))
+            return
+        match command or 'metrics':
+            case 'metrics':
+                connection.send(encode_text(metrics.render()))
+            case _:
+                connection.send(
+                    encode_text(f'Unknown admin command "{command}"'))
+
+    @staticmethod
+    def send_limit_warning(connection: Connection,
+                           request_number: int) -> None:
         """Send message counter alert"""
-        writer.write('You have reached the limit for sending messages '
-                     'to the general chat'.encode())
-        await writer.drain()
+        if connection.acks:
+            connection.send(encode_nack(request_number, LIMIT_WARNING))
+        else:
+            connection.send(encode_text(LIMIT_WARNING))
 
 
 if __name__ == '__main__':
-    server = Server()
-    try:
-        server.listen()
-    except KeyboardInterrupt:
-        print(f'\nStopping server {server.host}:{server.port}')
+    from workers import port_conflict, run_workers
+    if settings.WORKERS > 1:
+        run_workers()
+    elif error := port_conflict():
+        print(error)
+    else:
+        server = Server()
+        try:
+            server.listen()
+        except KeyboardInterrupt:
+            print(f'\nStopping server {server.host}:{server.port}')
@@ -1,45 +1,127 @@
 from config import settings
 
 
+# Every branch is served by an index on (receiver, send_date) or
+# (sender, send_date). The branches do not overlap, so they are joined with
+# UNION ALL: the user's own messages come only from the sender branch.
 get_message_query = f'''
-    SELECT *
+    SELECT
+        id,
+        send_date,
+        sender,
+        receiver,
+        message
     FROM (
-        SELECT
-            send_date,
-            sender,
-            receiver, 
-            message
+        SELECT id, send_date, sender, receiver, message
         FROM main.messages
-        WHERE receiver in ('all', ?)
-            AND send_date >= ?
-            OR sender = ?
-        ORDER BY send_date
-    )
-    UNION
-    SELECT *
-    FROM (
-        SELECT 
-            send_date,
-            sender,
-            receiver, 
-            message
+        WHERE receiver = 'all' AND send_date >= :reg_date
+            AND sender != :user
+        UNION ALL
+        SELECT id, send_date, sender, receiver, message
         FROM main.messages
-        WHERE receiver in ('all', ?)
-            AND send_date <= ?
-        ORDER BY send_date
-        LIMIT {settings.LIMIT_SHOW_MESSAGES}
+        WHERE receiver = :user AND send_date >= :reg_date
+            AND sender != :user
+        UNION ALL
+        SELECT id, send_date, sender, receiver, message
+        FROM main.messages
+        WHERE sender = :user
+        UNION ALL
+        SELECT * FROM (
+            SELECT id, send_date, sender, receiver, message
+            FROM (
+                SELECT * FROM (
+                    SELECT id, send_date, sender, receiver, message
+                    FROM main.messages
+                    WHERE receiver = 'all' AND send_date < :reg_date
+                        AND sender != :user
+                    ORDER BY send_date DESC
+                    LIMIT {settings.LIMIT_SHOW_MESSAGES}
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT id, send_date, sender, receiver, message
+                    FROM main.messages
+                    WHERE receiver = :user AND send_date < :reg_date
+                        AND sender != :user
+                    ORDER BY send_date DESC
+                    LIMIT {settings.LIMIT_SHOW_MESSAGES}
+                )
+            )
+            ORDER BY send_date DESC
+            LIMIT {settings.LIMIT_SHOW_MESSAGES}
+        )
     )
-    ORDER BY send_date;
+    ORDER BY send_date, id;
+'''
+
+get_last_general_query = '''
+    SELECT
+        id,
+        send_date,
+        sender,
+        receiver,
+        message
+    FROM main.messages
+    WHERE receiver = 'all'
+    ORDER BY send_date DESC
+    LIMIT ?;
+'''
+
+get_last_private_query = '''
+    SELECT
+        id,
+        send_date,
+        sender,
+        receiver,
+        message
+    FROM main.messages
+    WHERE receiver != 'all'
+    ORDER BY send_date DESC
+    LIMIT ?;
 '''
 
 store_message_query = '''
     INSERT INTO main.messages(
-        message, sender, receiver, send_date)
-        VALUES (?, ?, ?, ?);
+        id, message, sender, receiver, send_date)
+        VALUES (?, ?, ?, ?, ?);
+'''
+
+get_last_message_id_query = '''
+    SELECT MAX(
+        COALESCE((SELECT MAX(id) FROM main.messages), 0),
+        COALESCE((SELECT seq FROM main.sqlite_sequence
+                  WHERE name = 'messages'), 0)
+    );
+'''
+
+get_unread_messages_query = '''
+    SELECT
+        id,
+        send_date,
+        sender,
+        receiver,
+        message
+    FROM main.messages
+    WHERE id > :last_id AND id <= :until_id
+        AND (receiver IN ('all', :user) OR sender = :user)
+    ORDER BY id
+    LIMIT :page_size;
+'''
+
+get_cursor_query = '''
+    SELECT last_id
+    FROM main.read_cursors
+    WHERE username = ? AND device = ?;
+'''
+
+store_cursor_query = '''
+    INSERT OR REPLACE INTO main.read_cursors(
+        username, device, last_id)
+        VALUES (?, ?, ?);
 '''
 
 store_user_query = '''
-    INSERT INTO main.registrations(
+    INSERT OR IGNORE INTO main.registrations(
         username, reg_date)
         VALUES (?, ?);
 '''
@@ -47,24 +129,68 @@ store_user_query = '''
 get_user_query = '''
     SELECT 
         r.username,
-        r.reg_date,
-        r.count_messages
+        r.reg_date
     FROM main.registrations r
     WHERE r.username = ?;
 '''
 
-delete_message_query = f'''
-    DELETE FROM main.messages 
-    WHERE send_date < ?;
+delete_expired_messages_query = '''
+    DELETE FROM main.messages
+    WHERE id IN (
+        SELECT id
+        FROM main.messages
+        WHERE send_date < ?
+        ORDER BY send_date
+        LIMIT ?
+    );
+'''
+
+get_oldest_message_query = '''
+    SELECT MIN(send_date)
+    FROM main.messages;
+'''
+
+get_rate_limits_query = '''
+    SELECT
+        username,
+        tokens,
+        updated_at
+    FROM main.rate_limits
+    ORDER BY updated_at DESC
+    LIMIT ?;
+'''
+
+store_rate_limit_query = '''
+    INSERT OR REPLACE INTO main.rate_limits(
+        username, tokens, updated_at)
+        VALUES (?, ?, ?);
+'''
+
+store_scheduled_query = '''
+    INSERT OR REPLACE INTO main.scheduled_messages(
+        id, sender, receiver, message, send_at)
+        VALUES (?, ?, ?, ?, ?);
+'''
+
+delete_scheduled_query = '''
+    DELETE FROM main.scheduled_messages
+    WHERE id = ?;
 '''
 
-append_count_query = ''' 
-    UPDATE main.registrations
-    SET count_messages = ?
-    WHERE username = ?
+get_scheduled_query = '''
+    SELECT
+        id,
+        sender,
+        receiver,
+        message,
+        send_at
+    FROM main.scheduled_messages;
 '''
 
-reset_limit_query = ''' 
-    UPDATE main.registrations
-    SET count_messages = 0
+get_last_scheduled_id_query = '''
+    SELECT MAX(
+        COALESCE((SELECT MAX(id) FROM main.scheduled_messages), 0),
+        COALESCE((SELECT seq FROM main.sqlite_sequence
+                  WHERE name = 'scheduled_messages'), 0)
+    );
 '''
@@ -0,0 +1,75 @@
+from typing import Any, Protocol
+
+from config import settings
+from database import SqliteStorage
+from log_storage import LogStorage
+from structs import Message, StorageBackend
+
+
+class WriteQueue(Protocol):
+    """Takes the writes: kinds from ``structs.Write`` with the params of
+    their SQL queries. A storage or, on a worker, the bus to the hub"""
+
+    def put(self, kind: str, params: tuple[Any, ...]) -> None:
+        ...
+
+    async def flush(self) -> None:
+        ...
+
+
+class Storage(WriteQueue, Protocol):
+    """What every storage backend serves, StorageError when it fails"""
+
+    async def open(self) -> None:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+    async def get_user(self, username: str) -> tuple[str, int] | None:
+        ...
+
+    async def get_cursor(self, username: str, device: str) -> int | None:
+        ...
+
+    async def get_last_message_id(self) -> int:
+        ...
+
+    async def get_last_messages(self, general_limit: int, private_limit: int
+                                ) -> tuple[list[Message], list[Message]]:
+        ...
+
+    async def get_history(self, user: str, reg_date: int) -> list[Message]:
+        ...
+
+    async def get_unread(self, user: str, last_id: int, until_id: int,
+                         page_size: int) -> list[Message]:
+        ...
+
+    async def get_rate_limits(self, limit: int
+                              ) -> list[tuple[str, float, float]]:
+        ...
+
+    async def delete_expired(self, cutoff: int, limit: int) -> int:
+        ...
+
+    async def get_oldest_send_date(self) -> int | None:
+        ...
+
+    async def get_scheduled(self) -> list[tuple[int, str, str, str, int]]:
+        ...
+
+    async def get_last_scheduled_id(self) -> int:
+        ...
+
+
+def get_storage(name: str = settings.STORAGE,
+                db_name: str = settings.DB_NAME,
+                path: str = settings.STORAGE_PATH) -> Storage:
+    """Storage backend by its name, ValueError for unsupported backends"""
+    match name:
+        case StorageBackend.SQLITE:
+            return SqliteStorage(db_name)
+        case StorageBackend.LOG:
+            return LogStorage(path)
+    raise ValueError(f'Unsupported storage "{name}"')
@@ -1,14 +1,44 @@
 import json
+import re
+import sys
+import time
 
 from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Literal
 from enum import Enum
+from pytz import timezone, utc
+
+from config import settings
+from protocol import encode_frame, encode_text
+
+
+TZ = timezone(settings.TZ)
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
+# the way ``render_message`` shows a chat message
+CHAT_MESSAGE = re.compile(
+    r'#(\d+) (\d{4}-\d\d-\d\d[ T][\d:.]+(?:[+-]\d\d:\d\d)?) '
+    r'(\S+) to (\S+): (.*)',
+    re.DOTALL)
+# the chat message announcing a file, see ``file_notice``
+FILE_NOTICE = re.compile(r'File "(.*)", (\d+) bytes - download ([0-9a-f]+)')
 
 
 class Command(str, Enum):
     SEND = 'send'
     SEND_TO = 'send-to'
     STATUS = 'status'
+    ADMIN = 'admin'
+    SCHEDULE = 'schedule'
+    SCHEDULE_TO = 'schedule-to'
+    SCHEDULED = 'scheduled'
+    CANCEL = 'cancel'
+    UPLOAD = 'upload'
+    UPLOAD_TO = 'upload-to'
+    DOWNLOAD = 'download'
     EXIT = 'exit'
     QUIT = 'quit'
     HELP = 'help'
@@ -26,6 +56,13 @@ class Target(str, Enum):
     ONE_TO_ONE = 'one_to_one'
     HELLO = 'hello'
     STATUS = 'status'
+    ADMIN = 'admin'
+    ACK = 'ack'
+    SCHEDULE = 'schedule'
+    SCHEDULED = 'scheduled'
+    CANCEL = 'cancel'
+    FILE = 'file'
+    DOWNLOAD = 'download'
 
     @classmethod
     def list(cls):
@@ -35,16 +72,270 @@ class Target(str, Enum):
         return str(self.value)
 
 
+TARGETS = frozenset(Target.list())
+
+
+class Codec(str, Enum):
+    JSON = 'json'
+    BINARY = 'binary'
+
+    @classmethod
+    def list(cls):
+        return list(map(lambda c: c.value, cls))
+
+    def __str__(self):
+        return str(self.value)
+
+
+class Compression(str, Enum):
+    ZLIB = 'zlib'
+
+    @classmethod
+    def list(cls):
+        return list(map(lambda c: c.value, cls))
+
+    def __str__(self):
+        return str(self.value)
+
+
+class SlowConsumerPolicy(str, Enum):
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    DISCONNECT = 'disconnect'
+
+    @classmethod
+    def list(cls):
+        return list(map(lambda c: c.value, cls))
+
+    def __str__(self):
+        return str(self.value)
+
+
+class StorageBackend(str, Enum):
+    SQLITE = 'sqlite'
+    LOG = 'log'
+
+    @classmethod
+    def list(cls):
+        return list(map(lambda c: c.value, cls))
+
+    def __str__(self):
+        return str(self.value)
+
+
+class Write(str, Enum):
+    """Kinds of records written through a storage's write queue"""
+    MESSAGE = 'message'
+    USER = 'user'
+    CURSOR = 'cursor'
+    RATE_LIMIT = 'rate_limit'
+    EXPIRE = 'expire'
+    SCHEDULE = 'schedule'
+    UNSCHEDULE = 'unschedule'
+
+    def __str__(self):
+        return str(self.value)
+
+
 @dataclass
 class RequestData:
     username: str
     target: Literal[
-        Target.ALL, Target.ONE_TO_ONE, Target.HELLO, Target.STATUS] = Target.ALL
+        Target.ALL, Target.ONE_TO_ONE, Target.HELLO, Target.STATUS,
+        Target.ADMIN, Target.ACK, Target.SCHEDULE, Target.SCHEDULED,
+        Target.CANCEL, Target.FILE, Target.DOWNLOAD] = Target.ALL
     receiver: str = ''
+    # the command of ADMIN, the acknowledged message id of ACK, the id of
+    # the scheduled message to CANCEL, the name of the FILE sent and the
+    # id of the file to DOWNLOAD
     message: str = ''
+    codec: str = Codec.JSON
+    device: str = ''
+    # ask for acks and resume after the last message id the client has
+    acks: bool = False
+    last_id: int = 0
+    compression: str = ''
+    # the time to send a SCHEDULE message at, microseconds since the epoch
+    send_at: int = 0
+    # a number unique for the sender that a chat message sent again after
+    # reconnecting keeps, 0 for none
+    request_id: int = 0
 
     def to_json(self):
-        return asdict(self)
+        data = asdict(self)
+        # HELLO, SCHEDULE and request id fields are sent only when they
+        # differ from the defaults
+        if self.codec == Codec.JSON:
+            del data['codec']
+        for field in ('device', 'acks', 'last_id', 'compression', 'send_at',
+                      'request_id'):
+            if not data[field]:
+                del data[field]
+        return data
 
     def to_string_json(self):
         return json.dumps(self.to_json())
+
+    def to_frame(self) -> bytes:
+        return encode_frame(self.to_string_json().encode())
+
+    @classmethod
+    def from_frame(cls, frame: bytes) -> 'RequestData':
+        """Decode a JSON request, ValueError for a field of a wrong type
+        or an unknown target"""
+        data = json.loads(frame.decode())
+        if not isinstance(data, dict):
+            raise ValueError('Request must be a JSON object')
+        for name, value in data.items():
+            expected = REQUEST_FIELD_TYPES.get(name)
+            if expected is None:
+                raise ValueError(f'Unknown field "{name}"')
+            # bool is an int, but not a valid id or time
+            if type(value) is not expected:
+                raise ValueError(
+                    f'Field "{name}" must be {expected.__name__}')
+        if 'target' in data and data['target'] not in TARGETS:
+            raise ValueError(f'Unknown target "{data["target"]}"')
+        return cls(**data)
+
+
+# the JSON types of the request fields, enums come as strings
+REQUEST_FIELD_TYPES = {
+    'username': str, 'target': str, 'receiver': str, 'message': str,
+    'codec': str, 'device': str, 'acks': bool, 'last_id': int,
+    'compression': str, 'send_at': int, 'request_id': int,
+}
+
+
+def now_timestamp() -> int:
+    """Current time in microseconds since the epoch"""
+    return time.time_ns() // 1000
+
+
+def to_timestamp(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+@lru_cache(maxsize=4096)
+def utc_offset(minute: int) -> tuple[int, str]:
+    """Offset of TZ in microseconds and as text at a minute since the
+    epoch: zones change their offsets on whole minutes"""
+    local = TZ.fromutc(NAIVE_EPOCH + timedelta(minutes=minute))
+    return (local.utcoffset() // timedelta(microseconds=1),
+            local.replace(microsecond=0).isoformat()[19:])
+
+
+def format_timestamp(timestamp: int) -> str:
+    """Local time of a timestamp as the chat shows it, the same as
+    ``str`` of an aware datetime"""
+    offset, suffix = utc_offset(timestamp // 60000000)
+    return f'{NAIVE_EPOCH + timedelta(microseconds=timestamp + offset)}' \
+           f'{suffix}'
+
+
+def render_message(message_id: int, timestamp: int, sender: str,
+                   receiver: str, message: str) -> bytes:
+    """Frame of a chat message as clients see it"""
+    return encode_text(f'#{message_id} {format_timestamp(timestamp)} '
+                       f'{sender} to {receiver}: {message}')
+
+
+def file_notice(file_id: str, name: str, size: int) -> str:
+    """Text of the chat message announcing a file"""
+    return f'File "{name}", {size} bytes - download {file_id}'
+
+
+class Message:
+    """A stored chat message with its frame rendered once.
+
+    The timestamp is in microseconds since the epoch and the usernames
+    are interned, so the many records in memory share them.
+    """
+    __slots__ = ('id', 'timestamp', 'sender', 'receiver', 'payload')
+
+    def __init__(self, message_id: int, timestamp: int, sender: str,
+                 receiver: str, payload: bytes) -> None:
+        self.id = message_id
+        self.timestamp = timestamp
+        self.sender = sys.intern(sender)
+        self.receiver = sys.intern(receiver)
+        self.payload = payload
+
+    def __repr__(self):
+        return f'Message({self.id}, {self.timestamp}, {self.sender!r}, ' \
+               f'{self.receiver!r}, {self.payload!r})'
+
+    def __reduce__(self):
+        return Message, (self.id, self.timestamp, self.sender, self.receiver,
+                         self.payload)
+
+    @classmethod
+    def create(cls, message_id: int, timestamp: int, sender: str,
+               receiver: str, message: str) -> 'Message':
+        """Record of a message, as stored in rows, with its frame"""
+        return cls(message_id, timestamp, sender, receiver, render_message(
+            message_id, timestamp, sender, receiver, message))
+
+
+class ScheduledMessage:
+    """A message waiting for its time to be sent"""
+    __slots__ = ('id', 'sender', 'receiver', 'message', 'send_at')
+
+    def __init__(self, scheduled_id: int, sender: str, receiver: str,
+                 message: str, send_at: int) -> None:
+        self.id = scheduled_id
+        self.sender = sender
+        self.receiver = receiver
+        self.message = message
+        self.send_at = send_at
+
+    def __repr__(self):
+        return f'ScheduledMessage({self.id}, {self.sender!r}, ' \
+               f'{self.receiver!r}, {self.message!r}, {self.send_at})'
+
+    @property
+    def params(self) -> tuple[int, str, str, str, int]:
+        """The row as stored, and the params of ``Write.SCHEDULE``"""
+        return self.id, self.sender, self.receiver, self.message, self.send_at
+
+    def __str__(self):
+        return f'#{self.id} {format_timestamp(self.send_at)} ' \
+               f'to {self.receiver}: {self.message}'
+
+
+@dataclass
+class IncomingMessage:
+    """A frame from the server: a chat message or a notice such as a
+    greeting, a status or a warning"""
+    text: str
+    message: str = ''
+    sender: str = ''
+    receiver: str = ''
+    send_date: datetime | None = None
+    id: int = 0
+
+    def __str__(self):
+        return self.text
+
+    @property
+    def is_chat(self) -> bool:
+        return bool(self.sender)
+
+    @property
+    def file_id(self) -> str:
+        """Id of the file a chat message announces, or an empty string"""
+        match = FILE_NOTICE.fullmatch(self.message) if self.is_chat else None
+        return '' if match is None else match.group(3)
+
+    @classmethod
+    def parse(cls, frame: bytes) -> 'IncomingMessage':
+        text = frame.decode()
+        match = CHAT_MESSAGE.fullmatch(text)
+        if match is None:
+            return cls(text)
+        message_id, send_date, sender, receiver, message = match.groups()
+        try:
+            return cls(text, message, sender, receiver,
+                       datetime.fromisoformat(send_date), int(message_id))
+        except ValueError:
+            return cls(text)
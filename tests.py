@@ -1,21 +1,168 @@
+import asyncio
+import json
+import logging
 import time
 import aiounittest
 import unittest
 import os
+import shutil
+import sqlite3
+import tempfile
 import nest_asyncio
 import _thread
 
 from asyncio.streams import StreamReader, StreamWriter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from typing import Any, Callable
 
-from migration import create_db
+from benchmarks.history_query import LEGACY_VERSION
+from migration import SCHEMA_VERSION, create_db, migrate
+from bus import BusClient, Hub
 from client import Client
 from server import Server
 from config import settings
-from utils import get_cursor
+from protocol import (
+    ACK, COMPRESSED, FILE_CHUNK, HEADER, NACK, FrameError, encode_frame,
+    encode_text, iter_frames
+)
+from codec import get_codec
+from compression import StreamCompressor, StreamDecompressor
+from rate_limiter import RateLimiter
+from history import HistoryBuffer
+from database import SqliteStorage, StorageError, WriteBehindQueue
+from sql_queries import store_message_query
+from log_storage import LogStorage
+from retention import RetentionEngine
+from scheduler import Scheduler
+from files import FileStore
+from http_server import HttpError, RequestParser
+from connection import Connection, ConnectionRegistry, QueueMetrics
+from metrics import MetricsRegistry
+from structs import (
+    Codec, IncomingMessage, Message, RequestData, Target, Write,
+    now_timestamp, render_message, to_timestamp
+)
+from utils import QueueLogHandler, get_cursor
+from workers import port_conflict
 
 
 nest_asyncio.apply()
 test_db_name = 'test_db.db'
+# the storage directories of the servers started by ``start_server``
+test_server_path = 'test_server_{}'
+
+
+def start_server(port: int, http_port: int = 0) -> Server:
+    """Start a server with its own database in a thread"""
+    path = test_server_path.format(port)
+    # left by a test run that did not finish
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    db_name = os.path.join(path, 'chat.db')
+    create_db(db_name)
+    server = Server(port=port, db_name=db_name, metrics_port=0,
+                    http_port=http_port)
+    _thread.start_new_thread(server.listen, ())
+    time.sleep(1)
+    return server
+
+
+def start_hub(path: str, db_name: str) -> Hub:
+    """Start the hub of a multi-worker server in a thread"""
+    hub = Hub(path, db_name, now_timestamp)
+
+    async def serve() -> None:
+        await hub.start()
+        await hub.serve()
+
+    _thread.start_new_thread(
+        asyncio.new_event_loop().run_until_complete, (serve(),))
+    time.sleep(0.5)
+    return hub
+
+
+async def collect(client: Client, messages: list[IncomingMessage]) -> None:
+    """Keep the chat messages the client receives"""
+    async for message in client.messages():
+        if message.is_chat:
+            messages.append(message)
+
+
+async def wait_until(condition: Callable[[], bool],
+                     timeout: float = 5) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition() and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def open_session(port: int, username: str, last_id: int = 0
+                       ) -> tuple[StreamReader, StreamWriter]:
+    """A connection of a client with acks after its HELLO"""
+    reader, writer = await asyncio.open_connection(settings.HOST, port)
+    writer.write(RequestData(username, Target.HELLO, acks=True,
+                             last_id=last_id).to_frame())
+    return reader, writer
+
+
+async def read_chat(reader: StreamReader, count: int) -> list[bytes]:
+    """The next ``count`` chat messages and acks, the notices are skipped"""
+    frames = []
+    while len(frames) < count:
+        (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+        frame = await reader.readexactly(size)
+        if frame[:1] == ACK or IncomingMessage.parse(frame).is_chat:
+            frames.append(frame)
+    return frames
+
+
+async def read_answer(reader: StreamReader) -> bytes:
+    """The next ack or nack, the other frames are skipped"""
+    async for frame in iter_frames(reader):
+        if frame[:1] in (ACK, NACK):
+            return frame
+    raise ConnectionError('Connection closed before the answer')
+
+
+async def http_request(port: int, method: str, target: str,
+                       body: dict | None = None) -> tuple[int, Any]:
+    """Status and JSON body of the answer to one HTTP request"""
+    reader, writer = await asyncio.open_connection(settings.HOST, port)
+    data = b'' if body is None else json.dumps(body).encode()
+    writer.write(f'{method} {target} HTTP/1.1\r\nConnection: close\r\n'
+                 f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(data)
+
+
+class FakeWriter:
+    """Keeps the frames a connection writes, ``drain`` waits while
+    ``drained`` is clear"""
+
+    def __init__(self) -> None:
+        self.frames = []
+        self.closed = False
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def get_extra_info(self, name: str) -> tuple[str, int]:
+        return '127.0.0.1', 1
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def writelines(self, frames: list[bytes]) -> None:
+        self.frames.extend(frames)
+
+    async def drain(self) -> None:
+        await self.drained.wait()
+
+    def close(self) -> None:
+        self.closed = True
 
 
 class ChatTest(aiounittest.AsyncTestCase):
@@ -25,10 +172,370 @@ class ChatTest(aiounittest.AsyncTestCase):
 
     @classmethod
     def tearDownClass(cls) -> None:
+        for file_name in (test_db_name, f'{test_db_name}-wal',
+                          f'{test_db_name}-shm'):
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+        for name in os.listdir():
+            if name.startswith(test_server_path.format('')):
+                shutil.rmtree(name, ignore_errors=True)
+
+    async def test_workers_share_messages(self) -> None:
+        db_name = 'test_bus.db'
+        path = tempfile.mkdtemp()
+        create_db(db_name)
         try:
-            os.remove(test_db_name)
-        except FileNotFoundError:
-            pass
+            hub = start_hub(os.path.join(path, 'bus.sock'), db_name)
+            # the workers listen on their own ports to choose the worker
+            # of every client
+            for worker, port in enumerate((8120, 8121)):
+                _thread.start_new_thread(Server(
+                    port=port, db_name=db_name,
+                    bus=BusClient(os.path.join(path, 'bus.sock'), worker),
+                    metrics_port=0, http_port=0).listen, ())
+            time.sleep(1)
+            clients = {
+                'Vupsen': Client('Vupsen', server_port=8120),
+                'Lupsen': Client('Lupsen', server_port=8120),
+                'Pupsen': Client('Pupsen', server_port=8121),
+            }
+            received = {name: [] for name in clients}
+            readers = []
+            for name, client in clients.items():
+                await client.connect_to_server()
+                readers.append(asyncio.create_task(
+                    collect(client, received[name])))
+            await asyncio.sleep(0.2)
+
+            # messages sent on both workers reach both, one at a time as
+            # nothing orders the requests of different connections
+            for count, (name, text) in enumerate((
+                    ('Vupsen', 'from worker 0'), ('Pupsen', 'from worker 1'),
+                    ('Vupsen', 'from worker 0 again')), start=1):
+                await clients[name].send(text)
+                await wait_until(lambda: len(received['Lupsen']) == count)
+            texts = [m.message for m in received['Lupsen']]
+            self.assertEqual(texts, ['from worker 0', 'from worker 1',
+                                     'from worker 0 again'])
+            self.assertEqual([m.message for m in received['Pupsen']],
+                             [texts[0], texts[2]])
+            # the hub numbers the messages of all the workers
+            ids = [m.id for m in received['Lupsen']]
+            self.assertEqual(ids, sorted(set(ids)))
+
+            await clients['Pupsen'].send_to('Vupsen', 'private')
+            await wait_until(lambda: len(received['Vupsen']) == 2)
+            self.assertEqual([m.message for m in received['Vupsen']],
+                             ['from worker 1', 'private'])
+            self.assertGreater(received['Vupsen'][-1].id, ids[-1])
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(received['Lupsen']), 3)
+
+            # the hub acks a message sent again to the other worker
+            # without posting it twice
+            once = RequestData('Dupsen', message='once', request_id=9)
+            acks = []
+            for port in (8121, 8120):
+                reader, writer = await open_session(port, 'Dupsen')
+                writer.write(once.to_frame())
+                acks += await asyncio.wait_for(read_chat(reader, 1), 5)
+                writer.close()
+            self.assertEqual(acks[0], acks[1])
+            await asyncio.sleep(0.2)
+            self.assertEqual([m.message for m in received['Lupsen']][3:],
+                             ['once'])
+
+            # the messages a user sends through any worker share a bucket
+            hub.rate_limiter = RateLimiter(capacity=2, period=3600)
+            answers = []
+            for port in (8120, 8121, 8120):
+                reader, writer = await open_session(port, 'Limpsen')
+                writer.write(RequestData('Limpsen', message='hi').to_frame())
+                answers.append(await asyncio.wait_for(read_answer(reader), 5))
+                writer.close()
+            self.assertEqual([a[:1] for a in answers], [ACK, ACK, NACK])
+
+            for client in clients.values():
+                await client.close()
+            await asyncio.gather(*readers)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            for file_name in (db_name, f'{db_name}-wal', f'{db_name}-shm'):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    async def test_headless_client(self) -> None:
+        start_server(8130)
+        bot = Client('bot', server_port=8130, device='bot')
+        peer = Client('peer', server_port=8130)
+        received = {'bot': [], 'peer': []}
+        async with bot, peer:
+            readers = [asyncio.create_task(collect(client, received[name]))
+                       for name, client in (('bot', bot), ('peer', peer))]
+            await bot.send('to all')
+            await bot.send_to('peer', 'private')
+            await bot.send_batch(['one', 'two', 'three'], receiver='peer')
+            await bot.wait_acked()
+            await wait_until(lambda: len(received['peer']) == 5)
+            self.assertEqual(
+                [(m.receiver, m.message) for m in received['peer']],
+                [('all', 'to all'), ('peer', 'private'), ('peer', 'one'),
+                 ('peer', 'two'), ('peer', 'three')])
+            # the sender gets the ids of its messages in acks
+            self.assertEqual(bot.last_id, received['peer'][-1].id)
+
+            # ``messages`` reconnects and the server resumes after the
+            # last id the client has
+            bot.writer.transport.abort()
+            await peer.send_to('bot', 'while away')
+            await wait_until(lambda: len(received['bot']) == 1)
+            self.assertTrue(bot.is_connected())
+            await bot.send('back')
+            await wait_until(lambda: len(received['peer']) == 6)
+            self.assertEqual([m.message for m in received['bot']],
+                             ['while away'])
+            self.assertEqual(received['peer'][-1].message, 'back')
+        await asyncio.gather(*readers)
+
+    async def test_acks_and_resume(self) -> None:
+        server = start_server(8140)
+        async with Client('sender', server_port=8140,
+                          acks=False) as sender:
+            reader, writer = await open_session(8140, 'reader')
+            await asyncio.sleep(0.2)
+            await sender.send_batch(['m1', 'm2', 'm3'])
+            received = [IncomingMessage.parse(f) for f in
+                        await asyncio.wait_for(read_chat(reader, 3), 5)]
+            ids = [m.id for m in received]
+            self.assertEqual(ids, sorted(set(ids)))
+            # the server answers a chat message with its id
+            writer.write(RequestData('reader', message='mine').to_frame())
+            (ack,) = await asyncio.wait_for(read_chat(reader, 1), 5)
+            mine = ids[-1] + 1
+            self.assertEqual(ack, ACK + f'1 {mine}'.encode())
+            writer.close()
+
+            await sender.send_batch(['m4', 'm5'])
+            await asyncio.sleep(0.2)
+            # only the messages after the id the client has come again
+            reader, writer = await open_session(8140, 'reader', ids[1])
+            replayed = [IncomingMessage.parse(f) for f in
+                        await asyncio.wait_for(read_chat(reader, 4), 5)]
+            self.assertEqual([m.message for m in replayed],
+                             ['m3', 'mine', 'm4', 'm5'])
+            self.assertEqual([m.id for m in replayed][:2], [ids[2], mine])
+            self.assertEqual([m.id for m in replayed],
+                             sorted(set(m.id for m in replayed)))
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(read_chat(reader, 1), 0.3)
+
+            # a message sent again after its ack was lost is acked with
+            # the id it got and is not posted twice
+            again = RequestData('reader', message='again', request_id=7)
+            writer.write(again.to_frame())
+            (ack,) = await asyncio.wait_for(read_chat(reader, 1), 5)
+            writer.close()
+            last_id = server.last_message_id
+            self.assertEqual(ack, ACK + f'1 {last_id}'.encode())
+            reader, writer = await open_session(8140, 'reader', last_id)
+            writer.write(again.to_frame())
+            (ack,) = await asyncio.wait_for(read_chat(reader, 1), 5)
+            self.assertEqual(ack, ACK + f'1 {last_id}'.encode())
+            self.assertEqual(server.last_message_id, last_id)
+            writer.close()
+
+    async def test_file_transfer(self) -> None:
+        server = start_server(8160)
+        # the files go away with the server's storage
+        server.files = server.retention.files = FileStore(
+            os.path.join(test_server_path.format(8160), 'files'))
+        path = tempfile.mkdtemp()
+        data = os.urandom(3 * settings.FILE_CHUNK_SIZE + 100)
+        with open(os.path.join(path, 'data.bin'), 'wb') as f:
+            f.write(data)
+        sender = Client('sender', server_port=8160)
+        receiver = Client('receiver', server_port=8160)
+        received = []
+        try:
+            async with sender, receiver:
+                reader = asyncio.create_task(collect(receiver, received))
+                await sender.upload(os.path.join(path, 'data.bin'),
+                                    receiver='receiver')
+                await wait_until(lambda: received)
+                file_id = received[0].file_id
+                saved = await asyncio.wait_for(receiver.download(
+                    file_id, os.path.join(path, 'copy.bin')), 5)
+                with open(saved, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+                # a client gone in the middle of a file leaves nothing
+                _, writer = await asyncio.open_connection(
+                    settings.HOST, 8160)
+                writer.writelines((
+                    RequestData('sender', Target.HELLO).to_frame(),
+                    RequestData('sender', Target.FILE,
+                                message='part.bin').to_frame(),
+                    encode_frame(FILE_CHUNK + data[:1000])))
+                await wait_until(lambda: server.uploads)
+                directory = server.files.directory
+                self.assertTrue(any(name.endswith('.part')
+                                    for name in os.listdir(directory)))
+                writer.close()
+                await wait_until(lambda: not server.uploads)
+                self.assertEqual(sorted(os.listdir(directory)),
+                                 [file_id, f'{file_id}.json'])
+            await reader
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def test_devices_resume_from_cursors(self) -> None:
+        start_server(8170)
+
+        async def connect(device: str) -> tuple[Client, list, asyncio.Task]:
+            client = Client('Vupsen', server_port=8170, device=device,
+                            acks=False)
+            await client.connect_to_server()
+            received = []
+            return client, received, asyncio.create_task(
+                collect(client, received))
+
+        async with Client('sender', server_port=8170, acks=False) as sender:
+            devices = {device: await connect(device)
+                       for device in ('phone', 'laptop')}
+            for text, leaving in (('m1', 'phone'), ('m2', 'laptop')):
+                await sender.send(text)
+                await wait_until(lambda: all(
+                    received and received[-1].message == text
+                    for _, received, _ in devices.values()
+                    if received is not None))
+                # the device's cursor is saved when it disconnects
+                client, _, reader = devices[leaving]
+                await client.close()
+                await reader
+                devices[leaving] = (None, None, None)
+            await sender.send('m3')
+            await asyncio.sleep(0.2)
+
+            # every device gets what it missed
+            for device, unread in (('phone', ['m2', 'm3']),
+                                   ('laptop', ['m3'])):
+                client, received, reader = await connect(device)
+                await wait_until(lambda: len(received) == len(unread))
+                await asyncio.sleep(0.1)
+                self.assertEqual([m.message for m in received], unread)
+                await client.close()
+                await reader
+
+    async def test_resume_while_the_messages_are_written(self) -> None:
+        server = start_server(8180)
+        queue = server.storage.write_queue
+        write = queue._write
+
+        def slow_write(groups: list) -> None:
+            time.sleep(0.5)
+            write(groups)
+
+        async def connect() -> tuple[Client, list, asyncio.Task]:
+            client = Client('reader', server_port=8180, device='phone',
+                            acks=False)
+            await client.connect_to_server()
+            received = []
+            return client, received, asyncio.create_task(
+                collect(client, received))
+
+        async with Client('sender', server_port=8180, acks=False) as sender:
+            client, received, reader = await connect()
+            await sender.send('m1')
+            await wait_until(lambda: received)
+            await client.close()
+            await reader
+
+            # the device comes back while its message is being written, and
+            # the history has to come from the database
+            server.history.ready = False
+            queue._write = slow_write
+            await sender.send('m2')
+            await asyncio.sleep(0.2)
+            client, received, reader = await connect()
+            await wait_until(lambda: received)
+            await asyncio.sleep(0.1)
+            self.assertEqual([m.message for m in received], ['m2'])
+            await client.close()
+            await reader
+
+    async def test_http_front_end(self) -> None:
+        server = start_server(8110, http_port=8111)
+        status, answer = await http_request(
+            8111, 'POST', '/requests',
+            {'username': 'Vupsen', 'target': 'all', 'message': 'hi'})
+        self.assertEqual(status, 200)
+        first_id = answer['id']
+        for body in ({'username': 'Vupsen', 'target': 'bogus'},
+                     {'username': 'Vupsen', 'target': 'hello'},
+                     {'username': 'Vupsen', 'receiver': 5}):
+            status, _ = await asyncio.wait_for(
+                http_request(8111, 'POST', '/requests', body), 1)
+            self.assertEqual(status, 400)
+        # the chat protocol answers an unknown target with an error and
+        # does not register the user
+        users = len(server.user_registry)
+        reader, writer = await asyncio.open_connection(settings.HOST, 8110)
+        writer.write(encode_frame(
+            b'{"username": "Nobody", "target": "bogus"}'))
+        frame = await anext(iter_frames(reader))
+        writer.close()
+        self.assertEqual(frame, b'Invalid request: Unknown target "bogus"')
+        self.assertEqual(len(server.user_registry), users)
+
+        # a long poll is woken up by the message it waits for
+        started = time.monotonic()
+        poll = asyncio.create_task(http_request(
+            8111, 'GET', f'/messages?username=Pupsen&after={first_id}'
+                         f'&timeout=5'))
+        await asyncio.sleep(0.2)
+        status, answer = await http_request(
+            8111, 'POST', '/requests',
+            {'username': 'Vupsen', 'target': 'one_to_one',
+             'receiver': 'Pupsen', 'message': 'wake up'})
+        self.assertEqual(status, 200)
+        status, messages = await poll
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(messages['last_id'], answer['id'])
+        self.assertEqual(len(messages['messages']), 1)
+        self.assertIn('Vupsen to Pupsen: wake up', messages['messages'][0])
+        # and answered empty when nothing comes in time
+        started = time.monotonic()
+        status, messages = await http_request(
+            8111, 'GET', f'/messages?username=Pupsen&after={answer["id"]}'
+                         f'&timeout=0.3')
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(messages, {'last_id': answer['id'], 'messages': []})
+        for timeout in ('nan', 'inf', '-1'):
+            status, _ = await http_request(
+                8111, 'GET', f'/messages?username=Pupsen&timeout={timeout}')
+            self.assertEqual(status, 400)
+
+        # every line of a frame is a data field of the event
+        reader, writer = await asyncio.open_connection(settings.HOST, 8111)
+        writer.write(b'GET /stream?username=Pupsen HTTP/1.1\r\n\r\n')
+        head = await reader.readuntil(b'\r\n\r\n')
+        self.assertIn(b'Content-Type: text/event-stream', head)
+        self.assertIn(b'Transfer-Encoding: chunked', head)
+        await http_request(
+            8111, 'POST', '/requests',
+            {'username': 'Vupsen', 'target': 'one_to_one',
+             'receiver': 'Pupsen', 'message': 'one\r\ntwo\rthree'})
+        events = b''
+        while b'three' not in events:
+            size = int(await reader.readuntil(b'\r\n'), 16)
+            events += (await reader.readexactly(size + 2))[:-2]
+        writer.close()
+        event = events.split(b'\n\n')[-2]
+        self.assertNotIn(b'\r', event)
+        self.assertTrue(event.endswith(b'Vupsen to Pupsen: one\n'
+                                       b'data: two\ndata: three'))
 
     async def test_messaging(self) -> None:
         # start server
@@ -77,8 +584,10 @@ class ChatTest(aiounittest.AsyncTestCase):
             self.assertEqual(messages[0][1], 'test_user_1')
             self.assertEqual(messages[0][2], 'all')
             self.assertEqual(messages[0][3], 'test message')
-            users = cursor.execute(get_users_query).fetchall()
-            self.assertEqual(users[0][3], 1)
+        self.assertEqual(
+            server.rate_limiter.remaining('test_user_1'),
+            settings.LIMIT_MESSAGES - 1
+        )
 
         # testing sending private messages
         await client2.send_to('test_user_1', 'test private message')
@@ -89,8 +598,10 @@ class ChatTest(aiounittest.AsyncTestCase):
             self.assertEqual(messages[1][1], 'test_user_2')
             self.assertEqual(messages[1][2], 'test_user_1')
             self.assertEqual(messages[1][3], 'test private message')
-            users = cursor.execute(get_users_query).fetchall()
-            self.assertEqual(users[1][3], 0)
+        self.assertEqual(
+            server.rate_limiter.remaining('test_user_2'),
+            settings.LIMIT_MESSAGES
+        )
 
         # testing message limit
         for m in range(settings.LIMIT_MESSAGES + 2):
@@ -104,5 +615,525 @@ class ChatTest(aiounittest.AsyncTestCase):
             self.assertEqual(len(messages), settings.LIMIT_MESSAGES)
 
 
+class ComponentTest(aiounittest.AsyncTestCase):
+    async def test_many_frames_in_one_chunk(self) -> None:
+        requests = [
+            RequestData(f'user_{i}', message='x' * 2000) for i in range(50)
+        ]
+        reader = StreamReader()
+        reader.feed_data(b''.join(r.to_frame() for r in requests))
+        reader.feed_eof()
+        received = [RequestData.from_frame(f) async for f in iter_frames(reader)]
+        self.assertEqual(received, requests)
+
+    def test_binary_codec_round_trip(self) -> None:
+        codec = get_codec(Codec.BINARY)
+        request = RequestData('Пупсен', target='one_to_one',
+                              receiver='Vupsen', message='привет' * 300,
+                              codec=Codec.BINARY, request_id=2 ** 62 + 1)
+        self.assertEqual(codec.decode(codec.encode(request)), request)
+        with self.assertRaises(ValueError):
+            codec.decode(codec.encode(request)[:-1])
+        scheduled = RequestData('Пупсен', target=Target.SCHEDULE,
+                                message='позже', codec=Codec.BINARY,
+                                send_at=1672531200123456)
+        self.assertEqual(codec.decode(codec.encode(scheduled)), scheduled)
+
+    def test_json_codec_rejects_wrong_types(self) -> None:
+        codec = get_codec(Codec.JSON)
+        for fields in (
+                {'target': 'one_to_one', 'receiver': 5, 'message': 'hi'},
+                {'target': 'hello', 'acks': True, 'last_id': 'abc'},
+                {'target': 'hello', 'acks': 1},
+                {'target': 'hello', 'last_id': True},
+                {'target': 'schedule', 'message': 'hi', 'send_at': 'x'},
+                {'target': 'hello', 'codec': ['binary']},
+                {'target': 'download', 'message': 5},
+                {'target': 'all', 'message': 'hi', 'color': 'red'},
+                {'target': 'bogus', 'message': 'hi'}):
+            frame = json.dumps({'username': 'Vupsen', **fields}).encode()
+            with self.subTest(fields=fields), self.assertRaises(ValueError):
+                codec.decode(frame)
+        with self.assertRaises(ValueError):
+            codec.decode(b'["Vupsen"]')
+        request = codec.decode(
+            b'{"username": "Vupsen", "target": "hello", "last_id": 7}')
+        self.assertEqual(request.last_id, 7)
+
+    def test_stream_compression_round_trip(self) -> None:
+        compressor = StreamCompressor(threshold=100)
+        decompressor = StreamDecompressor()
+        small = [encode_text('New guest in the chat! - Vupsen')]
+        self.assertEqual(compressor.compress(small), small)
+        sent = []
+        for page in range(2):
+            frames = [
+                render_message(page * 50 + i, 1672531200 * 1000000,
+                               'Vupsen', 'all', f'message {i}')
+                for i in range(50)
+            ]
+            (packed,) = compressor.compress(frames)
+            self.assertEqual(packed[4:5], COMPRESSED)
+            # the second page refers back to the first one
+            sent.append(len(packed))
+            self.assertEqual(decompressor.decompress(packed[4:]),
+                             [f[4:] for f in frames])
+        self.assertLess(sent[1], sent[0])
+
+    def test_incoming_message_parse(self) -> None:
+        send_date = datetime(2023, 1, 2, 3, 4, 5, 6789,
+                             timezone(timedelta(hours=3)))
+        frame = render_message(
+            17, to_timestamp(send_date), 'Vupsen', 'all', 'hi: there\n!')
+        message = IncomingMessage.parse(frame[4:])
+        self.assertTrue(message.is_chat)
+        self.assertEqual(
+            (message.id, message.send_date, message.sender,
+             message.receiver, message.message),
+            (17, send_date, 'Vupsen', 'all', 'hi: there\n!'))
+        self.assertEqual(str(message), frame[4:].decode())
+        notice = IncomingMessage.parse('New guest: Pupsen'.encode())
+        self.assertFalse(notice.is_chat)
+        self.assertEqual(notice.text, 'New guest: Pupsen')
+
+    def test_rate_limiter_refill(self) -> None:
+        limiter = RateLimiter(capacity=2, period=10)
+        self.assertTrue(limiter.allow('user', now=0))
+        self.assertTrue(limiter.allow('user', now=0))
+        self.assertFalse(limiter.allow('user', now=1))
+        self.assertTrue(limiter.allow('user', now=5))
+        self.assertEqual(limiter.remaining('user', now=100), 2)
+
+    def test_connection_registry(self) -> None:
+        class Session:
+            username = None
+
+        registry = ConnectionRegistry()
+        phone, laptop, other = Session(), Session(), Session()
+        self.assertTrue(registry.add(phone, 'a'))
+        self.assertFalse(registry.add(laptop, 'a'))
+        self.assertTrue(registry.add(other, 'b'))
+        self.assertEqual(registry.online_text, 'a, b')
+        self.assertEqual(list(registry.all(exclude=laptop)), [phone, other])
+        self.assertIsNone(registry.remove(phone))
+        self.assertEqual(registry.remove(laptop), 'a')
+        self.assertIsNone(registry.remove(laptop))
+        self.assertEqual(list(registry.connections('a')), [])
+        self.assertEqual(registry.online_text, 'b')
+
+    async def test_connection_holds_live_frames(self) -> None:
+        writer = FakeWriter()
+        connection = Connection(writer, QueueMetrics())
+        connection.acks = True
+        connection.hold()
+        connection.send(b'live 3', 3)
+        connection.send(b'live 5', 5)
+        connection.send(b'replay 1-3', replay=True)
+        connection.last_id = 3
+        connection.release()
+        await connection.flushed()
+        self.assertEqual(writer.frames, [b'replay 1-3', b'live 5'])
+        # the client can not ack what it was never sent
+        connection.ack(9)
+        self.assertEqual(connection.delivered_id, 5)
+        connection.close()
+        await asyncio.sleep(0)
+
+    async def test_connection_slow_consumer_policies(self) -> None:
+        frames = [b'%03d' % i for i in range(5)]
+        for policy, sent, metrics in (
+                ('drop_oldest', frames[2:], QueueMetrics(5, 2, 0, 3)),
+                # only the byte bound applies
+                ('coalesce', frames[1:], QueueMetrics(5, 1, 0, 4)),
+                ('disconnect', [], QueueMetrics(4, 0, 1, 3))):
+            with self.subTest(policy=policy):
+                writer = FakeWriter()
+                connection = Connection(writer, QueueMetrics(),
+                                        max_messages=3, max_bytes=12,
+                                        policy=policy)
+                # the frames are queued before the writer task runs
+                accepted = [connection.send(frame) for frame in frames]
+                await connection.flushed()
+                self.assertEqual(writer.frames, sent)
+                self.assertEqual(connection.metrics, metrics)
+                self.assertEqual(writer.closed, policy == 'disconnect')
+                self.assertEqual(accepted.count(False),
+                                 2 if policy == 'disconnect' else 0)
+                connection.close()
+                await asyncio.sleep(0)
+
+    async def test_connection_closed_while_draining(self) -> None:
+        writer = FakeWriter()
+        writer.drained.clear()
+        connection = Connection(writer, QueueMetrics())
+        connection.send(b'frame')
+        await asyncio.sleep(0)
+        # the drain completes in the same loop iteration as the close
+        writer.drained.set()
+        connection.close()
+        await asyncio.sleep(0.01)
+        self.assertTrue(connection._task.done())
+
+    def test_metrics_histogram(self) -> None:
+        registry = MetricsRegistry()
+        latency = registry.histogram(
+            'latency_seconds', 'Latency', ('target',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            latency.labels('all').observe(value)
+        registry.collect('connections', 'Connections', lambda: 3)
+        lines = registry.render().splitlines()
+        self.assertIn('latency_seconds_bucket{target="all",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{target="all",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{target="all",le="+Inf"} 4',
+                      lines)
+        self.assertIn('latency_seconds_count{target="all"} 4', lines)
+        self.assertIn('connections 3', lines)
+
+    def test_log_rotation(self) -> None:
+        log_file = 'test_rotation.log'
+        handler = QueueLogHandler(log_file, max_bytes=300, backup_count=1)
+        logger = logging.getLogger('test_rotation')
+        logger.addHandler(handler)
+        try:
+            for i in range(10):
+                logger.warning('record %s', i, extra={'number': i})
+                # one record per batch
+                time.sleep(0.01)
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        with open(log_file) as current, open(f'{log_file}.1') as previous:
+            records = [json.loads(line) for line in previous] + \
+                [json.loads(line) for line in current]
+        os.remove(log_file)
+        os.remove(f'{log_file}.1')
+        self.assertEqual(records[-1]['message'], 'record 9')
+        self.assertEqual(records[-1]['number'], 9)
+        self.assertLess(len(records), 10)
+
+    def test_log_handler_survives_bad_records(self) -> None:
+        log_file = 'test_bad_records.log'
+        handler = QueueLogHandler(log_file)
+        failed = []
+        handler.handleError = failed.append
+        logger = logging.getLogger('test_bad_records')
+        # only to the handler tested
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.warning('record %d', 'not a number')
+            time.sleep(0.05)
+            logger.warning('record %d', 2)
+            time.sleep(0.05)
+            self.assertTrue(handler._thread.is_alive())
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        with open(log_file) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(log_file)
+        self.assertEqual([r.args for r in failed], [('not a number',)])
+        self.assertEqual([r['message'] for r in records], ['record 2'])
+
+    def test_history_buffer_fallback(self) -> None:
+        history = HistoryBuffer(general_size=2, private_size=1,
+                                earlier_size=1)
+        history.ready = True
+        start = 1672531200 * 1000000
+        minute = 60 * 1000000
+        history.add(Message(1, start, 'a', 'b', b'private'))
+        for i in range(3):
+            history.add(Message(i + 2, start + i * minute, 'a', 'all',
+                                f'm{i}'.encode()))
+        # the last message before the registration and the ones after it,
+        # like the DB
+        self.assertEqual(
+            [m.payload for m in history.replay('b', start + 2 * minute)],
+            [b'm1', b'm2'])
+        # the last message before the registration is gone
+        self.assertIsNone(history.replay('b', start + minute))
+        # and so is the general message sent at the registration moment
+        self.assertIsNone(history.replay('b', start))
+        self.assertEqual([m.id for m in history.replay_since('b', 2)], [3, 4])
+        self.assertIsNone(history.replay_since('b', 1))
+        history.add(Message(5, start, 'c', 'b', b'private 2'))
+        self.assertIsNone(history.replay('b', start + 2 * minute))
+
+    async def test_history_buffer_primed_from_truncated_rows(self) -> None:
+        start = 1672531200 * 1000000
+        # newest first, like the storage returns them
+        rows = [Message(9, start + 9, 'c', 'a', b'to a')]
+        rows += [Message(i, start + i, 'x', 'y', b'x to y')
+                 for i in range(8, 2, -1)]
+        rows += [Message(i, start + i, 'a', 'b', b'from a')
+                 for i in (2, 1)]
+
+        class Rows:
+            async def get_last_messages(self, general_limit: int,
+                                        private_limit: int) -> tuple:
+                return [], rows[:private_limit]
+
+        history = HistoryBuffer(private_size=2, private_users=3)
+        await history.prime(Rows())
+        # the messages of a to b were cut off with the oldest rows
+        self.assertIsNone(history.replay_since('a', 1))
+        self.assertIsNone(history.replay('a', start))
+        self.assertEqual([m.id for m in history.replay_since('a', 8)], [9])
+
+    def test_migration_converts_baseline(self) -> None:
+        connection = sqlite3.connect(':memory:')
+        migrate(connection, target=LEGACY_VERSION)
+        # the benchmark's baseline has no indexes yet
+        self.assertEqual(connection.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND sql IS NOT NULL").fetchall(), [])
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        later = start + timedelta(seconds=1, microseconds=250000)
+        with connection:
+            connection.executemany(
+                'INSERT INTO messages (sender, message, send_date) '
+                'VALUES (?, ?, ?)',
+                [('a', 'm1', str(start)), ('b', 'm2', str(later)),
+                 ('a', 'm3', str(later))])
+            connection.execute('DELETE FROM messages WHERE id = 3')
+            connection.executemany(
+                'INSERT INTO registrations (username, reg_date) '
+                'VALUES (?, ?)',
+                [('a', str(start)), ('b', str(later)), ('a', str(later))])
+
+        self.assertEqual(migrate(connection), SCHEMA_VERSION)
+        self.assertEqual(connection.execute(
+            'SELECT id, send_date, typeof(send_date) FROM messages'
+        ).fetchall(), [(1, to_timestamp(start), 'integer'),
+                       (2, to_timestamp(later), 'integer')])
+        # the first registration of a user is kept
+        self.assertEqual(connection.execute(
+            'SELECT id, username, reg_date FROM registrations'
+        ).fetchall(), [(1, 'a', to_timestamp(start)),
+                       (2, 'b', to_timestamp(later))])
+        # the id of the deleted message is not given again
+        with connection:
+            connection.execute(
+                "INSERT INTO messages (sender, message, send_date) "
+                "VALUES ('a', 'm4', 0)")
+        self.assertEqual(connection.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'messages'"
+        ).fetchone(), (4,))
+        connection.close()
+
+    async def test_write_queue_flush_waits_for_the_batch(self) -> None:
+        db_name = 'test_write_queue.db'
+        create_db(db_name)
+        queue = WriteBehindQueue(db_name, ThreadPoolExecutor(1))
+        write = queue._write
+        attempts = []
+
+        def slow_write(groups: list) -> None:
+            attempts.append(groups)
+            time.sleep(0.2)
+            if len(attempts) == 2:
+                raise sqlite3.OperationalError('database is locked')
+            write(groups)
+
+        def stored() -> list[int]:
+            with get_cursor(db_name=db_name) as cursor:
+                return [row[0] for row in cursor.execute(
+                    'SELECT id FROM messages ORDER BY id')]
+
+        queue._write = slow_write
+        await queue.start()
+        try:
+            queue.put(store_message_query, (1, 'm1', 'a', 'all', 1))
+            # the writer task is in the middle of the batch
+            await asyncio.sleep(0.1)
+            await queue.flush()
+            self.assertEqual(stored(), [1])
+
+            # a failed batch is reported and written again
+            queue.put(store_message_query, (2, 'm2', 'a', 'all', 2))
+            with self.assertRaises(StorageError):
+                await queue.flush()
+            await queue.flush()
+            self.assertEqual(stored(), [1, 2])
+            self.assertEqual(len(attempts), 3)
+        finally:
+            await queue.stop()
+            for file_name in (db_name, f'{db_name}-wal', f'{db_name}-shm'):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    async def test_retention_deletes_in_chunks(self) -> None:
+        db_name = 'test_retention.db'
+        create_db(db_name)
+        now = 1672531200 * 1000000
+        with get_cursor(db_name=db_name) as cursor:
+            cursor.executemany(
+                'INSERT INTO messages (sender, message, send_date) '
+                'VALUES (?, ?, ?)',
+                [('a', 'm', now - s * 1000000) for s in range(100)]
+            )
+            cursor.connection.commit()
+        storage = SqliteStorage(db_name)
+        await storage.open()
+        try:
+            retention = RetentionEngine(
+                storage, HistoryBuffer(), lambda: now,
+                lifetime=timedelta(seconds=30.5), chunk_size=16)
+            self.assertEqual(await retention.purge(), 69)
+            self.assertEqual(
+                await retention.seconds_until_next_expiry(), 0.5)
+        finally:
+            await storage.close()
+            for file_name in (db_name, f'{db_name}-wal', f'{db_name}-shm'):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    async def test_log_storage_recovers(self) -> None:
+        path = 'test_log_storage'
+        now = 1672531200 * 1000000
+        storage = LogStorage(path)
+        await storage.open()
+        try:
+            for i in range(1, 11):
+                storage.put(Write.MESSAGE, (
+                    i, f'm{i}', 'a', 'all' if i % 2 else 'b',
+                    now + i * 1000000))
+            storage.put(Write.USER, ('a', now))
+            await storage.snapshot()
+            self.assertEqual(await storage.delete_expired(
+                now + 4500000, 100), 4)
+            storage.put(Write.CURSOR, ('b', 'phone', 7))
+            await storage.flush()
+            # a record torn by a crash
+            with open(storage.writer.path, 'ab') as f:
+                f.write(b'\x00\x00\x01\x00torn')
+
+            recovered = LogStorage(path)
+            await recovered.open()
+            await recovered.close()
+            self.assertEqual(await recovered.get_last_message_id(), 10)
+            self.assertEqual(await recovered.get_cursor('b', 'phone'), 7)
+            self.assertEqual(await recovered.get_user('a'), ('a', now))
+            self.assertEqual(
+                [m.id for m in await recovered.get_unread('b', 4, 10, 3)],
+                [5, 6, 7])
+            self.assertEqual(
+                [m.id for m in await recovered.get_history('b', now)],
+                [5, 6, 7, 8, 9, 10])
+        finally:
+            await storage.close()
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def test_scheduler_batches_and_recovers(self) -> None:
+        path = 'test_scheduler'
+        storage = LogStorage(path)
+        await storage.open()
+        batches = []
+        scheduler = Scheduler(storage, batches.append, now_timestamp,
+                              tick=0.05, user_limit=3)
+        try:
+            # the end of a tick 0.15-0.2 s from now
+            tick = (now_timestamp() // 50000 + 4) * 50000
+            for send_at, text in ((tick - 30000, 'a'), (tick - 10000, 'b'),
+                                  (tick + 5000000, 'c')):
+                scheduler.schedule('Vupsen', 'all', text, send_at)
+            with self.assertRaises(ValueError):
+                scheduler.schedule('Vupsen', 'all', 'd', tick)
+            self.assertFalse(scheduler.cancel('Pupsen', 3))
+            late = scheduler.schedule('Pupsen', 'Vupsen', 'e', tick)
+            self.assertTrue(scheduler.cancel('Pupsen', late.id))
+            await asyncio.sleep(0.3)
+            # the messages due within one tick come in one batch
+            self.assertEqual(
+                [[s.message for s in batch] for batch in batches],
+                [['a', 'b']])
+            self.assertEqual(
+                [s.id for s in scheduler.scheduled('Vupsen')], [3])
+            scheduler.stop()
+            await storage.close()
+
+            storage = LogStorage(path)
+            await storage.open()
+            recovered = Scheduler(storage, batches.append, now_timestamp)
+            await recovered.load(storage)
+            self.assertEqual(list(recovered.pending), [3])
+            self.assertEqual(recovered.last_id, 4)
+            recovered.stop()
+        finally:
+            scheduler.stop()
+            await storage.close()
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def test_file_store_spools_and_expires(self) -> None:
+        path = 'test_files'
+        store = FileStore(path, max_size=10)
+        try:
+            with self.assertRaises(ValueError):
+                await store.upload('Vupsen', 'all', '../')
+            upload = await store.upload('Vupsen', 'Pupsen', '../notes.txt')
+            for chunk in (b'hello ', b'file'):
+                await upload.write(memoryview(chunk))
+            info = await upload.finish()
+            self.assertEqual((info.name, info.size), ('notes.txt', 10))
+            with open(store.path(info.id), 'rb') as f:
+                self.assertEqual(f.read(), b'hello file')
+            stored = await store.get(info.id)
+            self.assertEqual(stored.receiver, 'Pupsen')
+            self.assertTrue(stored.allows('Vupsen'))
+            self.assertFalse(stored.allows('Lupsen'))
+            self.assertIsNone(await store.get('../' + info.id))
+
+            # a file over the limit is dropped as it arrives
+            upload = await store.upload('Vupsen', 'all', 'big.txt')
+            for chunk in (b'too large', b' file'):
+                await upload.write(memoryview(chunk))
+            self.assertIsNone(await upload.finish())
+            self.assertIn('larger than 10 bytes', upload.error)
+            self.assertEqual(sorted(os.listdir(path)),
+                             [info.id, f'{info.id}.json'])
+
+            self.assertEqual(
+                await store.expire(now_timestamp() + 1000000), 1)
+            self.assertIsNone(await store.get(info.id))
+            self.assertEqual(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def test_http_parser_pipelining(self) -> None:
+        parser = RequestParser(max_header_size=64)
+        body = b'{"username": "Vupsen"}'
+        data = b'POST /requests HTTP/1.1\r\nContent-Length: %d\r\n\r\n%b' \
+               b'GET /messages?username=Vupsen&after=3 HTTP/1.0\r\n\r\n' \
+               % (len(body), body)
+        requests = []
+        # the headers and the body are split between reads
+        for start in range(0, len(data), 5):
+            requests.extend(parser.feed(data[start:start + 5]))
+        self.assertEqual([(r.method, r.path) for r in requests],
+                         [('POST', '/requests'), ('GET', '/messages')])
+        self.assertEqual(requests[0].body, body)
+        self.assertTrue(requests[0].keep_alive)
+        self.assertFalse(requests[1].keep_alive)
+        self.assertEqual(requests[1].param('after'), '3')
+        with self.assertRaises(HttpError) as er:
+            parser.feed(b'GET / HTTP/1.1\r\nX-Long: ' + b'a' * 64)
+        self.assertEqual(er.exception.status,
+                         HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    def test_port_conflict(self) -> None:
+        self.assertEqual(port_conflict(4, 8001, 8000, 8080), '')
+        self.assertEqual(port_conflict(4, 0, 8000, 8002), '')
+        self.assertIn('HTTP_PORT 8002', port_conflict(4, 8001, 8000, 8002))
+        self.assertIn('PORT 8001', port_conflict(1, 8001, 8001, 8080))
+
+    async def test_truncated_frame(self) -> None:
+        reader = StreamReader()
+        reader.feed_data(encode_text('truncated')[:-1])
+        reader.feed_eof()
+        with self.assertRaises(FrameError):
+            async for _ in iter_frames(reader):
+                pass
+
+
 if __name__ == '__main__':
     unittest.main()
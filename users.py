@@ -0,0 +1,98 @@
+import asyncio
+
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from config import settings
+from database import StorageError
+from storage import Storage, WriteQueue
+from structs import Write
+from utils import server_logger
+
+
+@dataclass
+class UserRecord:
+    username: str
+    # microseconds since the epoch
+    reg_date: int
+
+
+class UserRegistry:
+    """In-memory source of truth for registered users.
+
+    A user is loaded from the storage on first contact and registered if
+    the storage does not know it. Online users are pinned in memory, the
+    others are kept in an LRU of at most ``capacity`` records.
+    Registrations reach the storage through the write queue, so after the
+    first contact a user costs no queries at all.
+    """
+
+    def __init__(self, storage: Storage, write_queue: WriteQueue,
+                 capacity: int = settings.USER_CACHE_SIZE) -> None:
+        self.storage = storage
+        self.write_queue = write_queue
+        self.capacity = capacity
+        self._online: dict[str, UserRecord] = dict()
+        self._recent: OrderedDict[str, UserRecord] = OrderedDict()
+        self._load_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._online) + len(self._recent)
+
+    async def get(self, username: str, now: int) -> UserRecord:
+        """Cached user record, loaded or registered on a cache miss"""
+        record = self._lookup(username)
+        if record is not None:
+            return record
+        async with self._load_lock:
+            # another request may have loaded the user while we waited
+            record = self._lookup(username)
+            if record is not None:
+                return record
+            try:
+                record = await self._load(username)
+            except StorageError as er:
+                # serve the request, but retry the lookup next time
+                server_logger.error('DB error - get user: %s', er)
+                return UserRecord(username, now)
+            if record is None:
+                record = self._register(username, now)
+            self._remember(record)
+        return record
+
+    def pin(self, username: str) -> None:
+        """Keep the user in memory while it is online"""
+        record = self._recent.pop(username, None)
+        if record is not None:
+            self._online[username] = record
+
+    def unpin(self, username: str) -> None:
+        """Return an offline user to the LRU"""
+        record = self._online.pop(username, None)
+        if record is not None:
+            self._remember(record)
+
+    def _lookup(self, username: str) -> UserRecord | None:
+        record = self._online.get(username)
+        if record is None:
+            record = self._recent.get(username)
+            if record is not None:
+                self._recent.move_to_end(username)
+        return record
+
+    def _remember(self, record: UserRecord) -> None:
+        if record.username in self._online:
+            return
+        self._recent[record.username] = record
+        self._recent.move_to_end(record.username)
+        while len(self._recent) > self.capacity:
+            self._recent.popitem(last=False)
+
+    async def _load(self, username: str) -> UserRecord | None:
+        row = await self.storage.get_user(username)
+        return UserRecord(*row) if row else None
+
+    def _register(self, username: str, now: int) -> UserRecord:
+        self.write_queue.put(Write.USER, (username, now))
+        server_logger.info('Create new user in DB - %s', username)
+        return UserRecord(username, now)
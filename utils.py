@@ -1,22 +1,175 @@
+import atexit
+import json
 import logging
+import os
+import queue
+import threading
 
 from contextlib import contextmanager
+from datetime import datetime
+from typing import TextIO
 from sqlite3 import connect, PARSE_DECLTYPES, PARSE_COLNAMES, DatabaseError
 
 from config import settings
 
 
+# attributes every LogRecord has, the rest came in ``extra``
+RECORD_ATTRIBUTES = frozenset(vars(
+    logging.LogRecord('', 0, '', 0, '', None, None))) | {'message'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone()
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class QueueLogHandler(logging.Handler):
+    """Hands records to a background thread that writes them to a file.
+
+    ``emit`` only puts the record into a bounded queue and drops it when
+    the queue is full. The thread formats the records as JSON lines and
+    writes everything queued at once, starting a new file when the current
+    one would exceed ``max_bytes``; ``backup_count`` old files are kept.
+    """
+
+    def __init__(self, log_file: str,
+                 queue_size: int = settings.LOG_QUEUE_SIZE,
+                 max_bytes: int = settings.LOG_MAX_BYTES,
+                 backup_count: int = settings.LOG_BACKUP_COUNT) -> None:
+        super().__init__()
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._reported = 0
+        self._queue: queue.Queue[logging.LogRecord | None] = \
+            queue.Queue(queue_size)
+        self.setFormatter(JsonFormatter())
+        self._thread = threading.Thread(
+            target=self._run, name=f'log-{log_file}', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        """Write what is queued and stop the thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        super().close()
+
+    def _run(self) -> None:
+        stream = open(self.log_file, 'a', encoding='utf-8')
+        try:
+            while True:
+                batch = self._take_batch()
+                records = [r for r in batch if r is not None]
+                if self.dropped > self._reported:
+                    records.append(self._dropped_record())
+                lines = self._format(records)
+                if lines:
+                    try:
+                        stream = self._write(stream, '\n'.join(lines) + '\n')
+                    except (OSError, ValueError):
+                        self.handleError(records[-1])
+                if batch[-1] is None:
+                    return
+        finally:
+            stream.close()
+
+    def _take_batch(self) -> list[logging.LogRecord | None]:
+        """The records queued, waiting for the first one"""
+        batch = [self._queue.get()]
+        while batch[-1] is not None:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _format(self, records: list[logging.LogRecord]) -> list[str]:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                # e.g. arguments that do not match the message, the thread
+                # goes on with the other records
+                self.handleError(record)
+        return lines
+
+    def _write(self, stream: TextIO, data: str) -> TextIO:
+        """Write ``data``, return the stream for the next batch"""
+        if stream.closed:
+            # the file could not be opened again after the last rotation
+            stream = open(self.log_file, 'a', encoding='utf-8')
+        if self.max_bytes and stream.tell() and \
+                stream.tell() + len(data) > self.max_bytes:
+            stream.close()
+            self._rotate()
+            stream = open(self.log_file, 'a', encoding='utf-8')
+        stream.write(data)
+        stream.flush()
+        return stream
+
+    def _dropped_record(self) -> logging.LogRecord:
+        dropped, self._reported = self.dropped - self._reported, self.dropped
+        return logging.makeLogRecord({
+            'name': __name__, 'levelname': 'WARNING',
+            'msg': 'Dropped %s log records, the queue was full',
+            'args': (dropped,),
+        })
+
+    def _rotate(self) -> None:
+        """log_file.1 becomes log_file.2 and so on, log_file becomes .1"""
+        if not self.backup_count:
+            os.remove(self.log_file)
+            return
+        for number in range(self.backup_count - 1, 0, -1):
+            source = f'{self.log_file}.{number}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.log_file}.{number + 1}')
+        os.replace(self.log_file, f'{self.log_file}.1')
+
+
 def config_logger(
         name: str, log_file: str, level: int = logging.INFO) -> logging.Logger:
-    formatter = logging.Formatter('%(levelname)s %(asctime)s %(message)s')
-    handler = logging.FileHandler(log_file)
-    handler.setFormatter(formatter)
+    handler = QueueLogHandler(log_file)
     logger = logging.getLogger(name)
     logger.setLevel(level)
     logger.addHandler(handler)
     return logger
 
 
+def dropped_log_records() -> int:
+    """Records dropped by all the loggers because their queue was full"""
+    return sum(
+        handler.dropped
+        for logger in (server_logger, client_logger)
+        for handler in logger.handlers
+        if isinstance(handler, QueueLogHandler)
+    )
+
+
 server_logger = config_logger('server_logger', 'server.log')
 client_logger = config_logger('client_logger', 'client.log')
 
@@ -32,7 +185,7 @@ def get_cursor(db_name: str = settings.DB_NAME):
         cursor = connection.cursor()
         yield cursor
     except DatabaseError as er:
-        server_logger.error(f'DB connection error: {er}')
+        server_logger.error('DB connection error: %s', er)
     finally:
         if connection:
             connection.close()
@@ -0,0 +1,90 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import tempfile
+
+from bus import BusClient, Hub
+from config import settings
+from server import Server
+from structs import StorageBackend, now_timestamp
+
+
+def port_conflict(workers: int = settings.WORKERS,
+                  metrics_port: int = settings.METRICS_PORT,
+                  port: int = settings.PORT,
+                  http_port: int = settings.HTTP_PORT) -> str:
+    """Why the server can not listen on its ports, empty if it can"""
+    if not metrics_port:
+        return ''
+    # worker N exports its metrics on ``metrics_port + N``
+    metrics_ports = range(metrics_port, metrics_port + workers)
+    for name, value in (('PORT', port), ('HTTP_PORT', http_port)):
+        if value in metrics_ports:
+            return (f'{name} {value} is taken by the metrics of the '
+                    f'workers on ports {metrics_port}-{metrics_ports[-1]}')
+    return ''
+
+
+def run_worker(path: str, worker: int, host: str, port: int,
+               db_name: str) -> None:
+    """Serve clients in a worker process"""
+    # every worker exports its own metrics
+    metrics_port = settings.METRICS_PORT + worker if settings.METRICS_PORT \
+        else 0
+    server = Server(host, port, db_name, bus=BusClient(path, worker),
+                    metrics_port=metrics_port)
+    try:
+        server.listen()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(workers: int = settings.WORKERS, host: str = settings.HOST,
+                port: int = settings.PORT,
+                db_name: str = settings.DB_NAME) -> None:
+    """Run ``workers`` server processes sharing the port, the hub runs in
+    the calling process"""
+    if settings.STORAGE != StorageBackend.SQLITE:
+        # the workers read the database the hub writes to
+        print(f'Storage "{settings.STORAGE}" does not support several '
+              f'workers, use "{StorageBackend.SQLITE}"')
+        return
+    error = port_conflict(workers, port=port)
+    if error:
+        print(error)
+        return
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bus.sock')
+        processes = [
+            context.Process(target=run_worker,
+                            args=(path, worker, host, port, db_name),
+                            daemon=True)
+            for worker in range(workers)
+        ]
+
+        async def main() -> None:
+            # stop the same way on SIGTERM as on Ctrl+C
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel)
+            hub = Hub(path, db_name, now_timestamp)
+            await hub.start()
+            for process in processes:
+                process.start()
+            await hub.serve()
+
+        print(f'Start {workers} workers on {host}:{port}')
+        try:
+            asyncio.run(main())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print(f'\nStopping server {host}:{port}')
+        finally:
+            for process in processes:
+                process.join(timeout=settings.WRITE_TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+
+
+if __name__ == '__main__':
+    run_workers()